@@ -0,0 +1,287 @@
+"""Микробенчмарки хранилища и маршрутизации без запуска бота.
+
+Каждый сценарий создаёт базы во временном каталоге через storage.py, наполняет их синтетическими
+данными и печатает задержки: было (прежняя реализация, воспроизведённая здесь) и стало.
+
+    python bench.py connections             # соединение на каждый запрос против пула по потокам
+    python bench.py note                    # заметка со счётчиками: четыре запроса против одного
+    python bench.py routing                 # разбор callback_data: цепочка if/elif против таблицы
+    python bench.py search                  # поиск по 100 000 заметок, комментариев и ДЗ
+    python bench.py search --rows 20000     # база поменьше
+    python bench.py search --json           # результат в JSON
+
+Сценарий routing импортирует main.py с временным config.json, остальные — только storage.py.
+Прогон через бота целиком — loadtest.py.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import storage
+
+LETTERS = 'абвгдеёжзийклмнопрстуфхцчшщыэюя'
+ENDINGS = ('', 'а', 'у', 'ы', 'ой', 'ом', 'ами', 'ах', 'ого', 'ему', 'ие', 'ия')
+
+# === ОБЩЕЕ ===
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def measure(case, func, queries, threads=1):
+    # Запросы делятся между потоками поровну; «в секунду» считается по общему времени прогона
+    latencies = []
+
+    def worker(part):
+        local = []
+        for query in part:
+            started = time.perf_counter()
+            func(query)
+            local.append(time.perf_counter() - started)
+        latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(queries[i::threads],)) for i in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {'case': case, 'runs': len(latencies), 'per_sec': round(len(latencies) / elapsed),
+            'p50_us': round(percentile(latencies, 0.50) * 1e6, 1),
+            'p95_us': round(percentile(latencies, 0.95) * 1e6, 1),
+            'max_us': round(max(latencies) * 1e6, 1)}
+
+def open_databases(workdir):
+    notes_db = storage.Database(os.path.join(workdir, 'notes.db'))
+    hw_db = storage.Database(os.path.join(workdir, 'homework.db'))
+    storage.init_notes_db(notes_db)
+    storage.init_hw_db(hw_db)
+    return notes_db, hw_db
+
+def make_words(rng, stems):
+    # Основа с окончаниями, как словоформы в русском тексте: префикс основы раскрывается в десяток слов
+    words = []
+    for _ in range(stems):
+        stem = ''.join(rng.choice(LETTERS) for _ in range(rng.randint(4, 7)))
+        words += [stem + ending for ending in ENDINGS]
+    rng.shuffle(words)
+    # Частоты по закону Ципфа: частые слова есть в тысячах документов
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    return words, weights
+
+def make_text(rng, words, weights, k):
+    return ' '.join(rng.choices(words, cum_weights=weights, k=k))
+
+# === СОЕДИНЕНИЯ ===
+def seed_notes(notes_db, rows):
+    with notes_db.transaction() as c:
+        c.executemany('INSERT INTO notes (title, content, created_at, creator_username) VALUES (?, ?, ?, ?)',
+                      [(f'Заметка {i}', 'x' * 200, '2026-01-01 10:00', 'seed') for i in range(rows)])
+
+def run_connections(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='dz-bench-')
+    notes_db, _ = open_databases(workdir)
+    seed_notes(notes_db, args.rows)
+    query = 'SELECT id, title, content FROM notes WHERE id = ?'
+
+    def connect_per_call(note_id):
+        # Как было: sqlite3.connect и close в каждом обработчике
+        conn = sqlite3.connect(notes_db.path)
+        conn.execute(query, (note_id,)).fetchone()
+        conn.close()
+
+    def pooled(note_id):
+        with notes_db.transaction() as c:
+            c.execute(query, (note_id,))
+            c.fetchone()
+
+    ids = [rng.randint(1, args.rows) for _ in range(args.queries)]
+    results = [measure(case, func, ids, args.threads)
+               for case, func in (('connect на запрос', connect_per_call), ('пул Database', pooled))]
+    return results, workdir
+
+# === ЗАМЕТКА СО СЧЁТЧИКАМИ ===
+def seed_reactions(notes_db, notes, reactions, comments, rng):
+    with notes_db.transaction() as c:
+        c.executemany('INSERT OR IGNORE INTO reactions (note_id, user_id, reaction) VALUES (?, ?, ?)',
+                      [(rng.randint(1, notes), user_id, rng.choice((1, -1))) for user_id in range(reactions)])
+        c.executemany('INSERT INTO comments (note_id, user_identifier, content) VALUES (?, ?, ?)',
+                      [(rng.randint(1, notes), 'seed', 'Комментарий') for _ in range(comments)])
+
+def run_note(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='dz-bench-')
+    notes_db, _ = open_databases(workdir)
+    seed_notes(notes_db, args.rows)
+    seed_reactions(notes_db, args.rows, args.reactions, args.comments, rng)
+    notes_repo = storage.NotesRepository(notes_db)
+    notes_repo.recount_counters()
+
+    def four_queries(note_id):
+        # Как было: строка заметки и три COUNT по реакциям и комментариям
+        with notes_db.transaction() as c:
+            c.execute('SELECT * FROM notes WHERE id = ?', (note_id,))
+            c.fetchone()
+            for sql in ('SELECT COUNT(*) FROM reactions WHERE note_id = ? AND reaction = 1',
+                        'SELECT COUNT(*) FROM reactions WHERE note_id = ? AND reaction = -1',
+                        'SELECT COUNT(*) FROM comments WHERE note_id = ?'):
+                c.execute(sql, (note_id,))
+                c.fetchone()
+
+    ids = [rng.randint(1, args.rows) for _ in range(args.queries)]
+    results = [measure('get_details', notes_repo.get_details, ids),
+               measure('4 запроса, индексы', four_queries, ids)]
+    with notes_db.transaction() as c:
+        c.execute('DROP INDEX idx_reactions_note')
+        c.execute('DROP INDEX idx_comments_note')
+    results.append(measure('4 запроса, без индексов', four_queries, ids))
+    return results, workdir
+
+# === МАРШРУТИЗАЦИЯ ===
+LEGACY_CALLBACKS = (
+    'notes_list_', 'notes_show_', 'notes_like_', 'notes_dislike_', 'notes_view_comments_', 'notes_add_comment_',
+    'hw_list_', 'hw_show_', 'search_', '=back_to_main', '!notes_', '!hw_', '=notes_add', '=notes_add_more_photos',
+    '=notes_add_more_videos', '=notes_add_more_audios', '=notes_add_more_files', '=notes_finish_adding',
+    'notes_edit_title_', 'notes_delete_title_', 'notes_confirm_delete_title_', '=hw_add', '=hw_add_more_photos',
+    '=hw_add_more_videos', '=hw_add_more_audios', '=hw_add_more_files', '=hw_finish_adding', 'hw_edit_subject_',
+    'hw_delete_subject_', 'hw_confirm_delete_subject_', '=cancel',
+)
+CALLBACK_MIX = ('notes_list_3', 'notes_show_42', 'notes_like_42', 'hw_show_7', 'cancel',
+                'hw_confirm_delete_subject_9', 'notes_add_more_files', 'hw_finish_adding')
+
+def legacy_resolve(data):
+    # Как было: callback_handler проверял префиксы по порядку; «=» — точное совпадение,
+    # «!» — проверка прав по префиксу, после которой разбор продолжался
+    for prefix in LEGACY_CALLBACKS:
+        if prefix[0] == '=':
+            if data == prefix[1:]:
+                return prefix
+        elif data.startswith(prefix.lstrip('!')):
+            if prefix[0] == '!':
+                continue
+            return int(data.rsplit('_', 1)[1])
+    return None
+
+def import_main(workdir):
+    # main.py читает config.json и открывает базы относительно текущего каталога
+    os.chdir(workdir)
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump({'token': '1:bench', 'account_ids': [1], 'admin_ids': [1]}, f)
+    import main
+    return main
+
+def run_routing(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='dz-bench-')
+    main = import_main(workdir)
+    unknown = [data for data in CALLBACK_MIX if main.callback_router.resolve(data) is None]
+    if unknown:
+        raise SystemExit(f"Маршруты не найдены: {unknown}")
+    callbacks = [rng.choice(CALLBACK_MIX) for _ in range(args.queries)]
+    results = [measure('if/elif', legacy_resolve, callbacks),
+               measure('CallbackRouter', main.callback_router.resolve, callbacks)]
+    return results, workdir
+
+# === ПОИСК ===
+def seed_search(notes_db, hw_db, rows, words, weights, rng):
+    # Вставка пачкой: триггеры FTS индексируют строки так же, как при обычном сохранении
+    with notes_db.transaction() as c:
+        c.executemany('INSERT INTO notes (title, content, created_at, creator_username) VALUES (?, ?, ?, ?)',
+                      [(make_text(rng, words, weights, 3), make_text(rng, words, weights, 40),
+                        '2026-01-01 10:00', 'seed') for _ in range(rows)])
+        c.executemany('INSERT INTO comments (note_id, user_identifier, content) VALUES (?, ?, ?)',
+                      [(rng.randint(1, rows), 'seed', make_text(rng, words, weights, 12)) for _ in range(rows)])
+    with hw_db.transaction() as c:
+        c.executemany('INSERT INTO homework (subject, task, created_at) VALUES (?, ?, ?)',
+                      [(make_text(rng, words, weights, 2), make_text(rng, words, weights, 30),
+                        '2026-01-01 10:00') for _ in range(rows)])
+
+def run_search(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='dz-bench-')
+    notes_db, hw_db = open_databases(workdir)
+    words, weights = make_words(rng, args.stems)
+    seed_search(notes_db, hw_db, args.rows, words, weights, rng)
+    notes_repo = storage.NotesRepository(notes_db)
+    hw_repo = storage.HomeworkRepository(hw_db)
+
+    def search(text):
+        # Как search_all в main.py на первой странице: по 5 результатов и признак следующей;
+        # префиксный запрос — только если по словам целиком ничего нет
+        for match in (storage.build_fts_query(text), storage.build_fts_query(text, prefix=True)):
+            results = notes_repo.search(match, 6) + hw_repo.search(match, 6)
+            if results:
+                return results
+        return results
+
+    def word():
+        # Ищут по содержательным словам, а не по самым частым вроде «и» или «на»
+        return rng.choice(words)
+
+    def prefix():
+        return word()[:rng.randint(storage.PREFIX_MIN_LENGTH, 5)]
+
+    cases = (('слово', word),
+             ('префикс', prefix),
+             ('два слова', lambda: f'{word()} {word()}'),
+             ('слово и префикс', lambda: f'{word()} {prefix()}'))
+    results = [measure(case, search, [make() for _ in range(args.queries)]) for case, make in cases]
+    return results, workdir
+
+# === ЗАПУСК ===
+SCENARIOS = {'connections': run_connections, 'note': run_note, 'routing': run_routing, 'search': run_search}
+
+def print_report(results):
+    columns = (('case', 'вариант', 26), ('runs', 'запусков', 9), ('per_sec', 'в секунду', 10),
+               ('p50_us', 'p50, мкс', 10), ('p95_us', 'p95, мкс', 10), ('max_us', 'max, мкс', 10))
+    print(''.join(title.rjust(width) if key != 'case' else title.ljust(width) for key, title, width in columns))
+    for result in results:
+        print(''.join(str(result[key]).rjust(width) if key != 'case' else str(result[key]).ljust(width)
+                      for key, _, width in columns))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Микробенчмарки хранилища бота")
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+    connections = subparsers.add_parser('connections', help="соединение на каждый запрос против пула Database")
+    connections.add_argument('--rows', type=int, default=5000, help="заметок в базе")
+    connections.add_argument('--queries', type=int, default=16000, help="запросов по id всего")
+    connections.add_argument('--threads', type=int, default=8)
+    note = subparsers.add_parser('note', help="заметка со счётчиками реакций и комментариев")
+    note.add_argument('--rows', type=int, default=1000, help="заметок в базе")
+    note.add_argument('--reactions', type=int, default=100000)
+    note.add_argument('--comments', type=int, default=20000)
+    note.add_argument('--queries', type=int, default=3000)
+    routing = subparsers.add_parser('routing', help="разбор callback_data")
+    routing.add_argument('--queries', type=int, default=1000000)
+    search = subparsers.add_parser('search', help="полнотекстовый поиск по заметкам, комментариям и ДЗ")
+    search.add_argument('--rows', type=int, default=100000, help="строк в каждой таблице: заметки, комментарии, ДЗ")
+    search.add_argument('--stems', type=int, default=2000, help="основ в словаре, у каждой 12 словоформ")
+    search.add_argument('--queries', type=int, default=300, help="запросов на вид")
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--seed', type=int, default=1)
+        subparser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    return parser.parse_args(argv)
+
+def main_cli(argv):
+    args = parse_args(argv)
+    results, workdir = SCENARIOS[args.scenario](args)
+    if args.json:
+        print(json.dumps({'args': vars(args), 'results': results}, ensure_ascii=False, indent=2))
+    else:
+        print_report(results)
+        print(f"\nБазы прогона: {workdir}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
@@ -0,0 +1,597 @@
+"""Нагрузочный прогон бота без настоящего токена.
+
+Поднимает локальную замену api.telegram.org, запускает обработчики main.py в обычном режиме
+long polling (через ShardedExecutor), в асинхронном (AsyncDispatcher) или в режиме webhook
+и прогоняет синтетический трафик. Для каждого сценария
+печатает пропускную способность и задержку обновления — от выдачи в getUpdates до конца обработки.
+
+    python loadtest.py                                  # все сценарии по очереди
+    python loadtest.py --mix reactions --updates 5000   # один сценарий
+    python loadtest.py --save traffic.ndjson            # сохранить сгенерированный трафик
+    python loadtest.py --replay traffic.ndjson          # прогнать тот же трафик ещё раз
+    python loadtest.py --json > base.json               # результат для сравнения
+    python loadtest.py --baseline base.json             # код выхода 1, если стало медленнее
+    python loadtest.py --transport webhook              # обновления POST-ами в WebhookServer
+    python loadtest.py --transport async --users 500    # режим mode=async, 500 пользователей
+
+В режиме webhook после сценариев проверяется протокол: 403 на чужой секрет, повтор update_id
+не обрабатывается дважды, 503 при полной очереди, drain дорабатывает принятое и отвечает 503 новым.
+
+Работает во временном каталоге: config.json и базы создаются заново при каждом запуске.
+"""
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+TOKEN = '1:loadtest'
+WEBHOOK_PATH = '/loadtest-hook'
+WEBHOOK_SECRET = 'loadtest-secret'
+MIXES = ('list', 'open', 'reactions', 'wizard', 'mixed')
+
+# === ЗАМЕНА BOT API ===
+class FakeBotApi:
+    """Отвечает на методы Bot API, которые вызывает бот, и раздаёт обновления через getUpdates."""
+
+    MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'sendPhoto', 'sendVideo', 'sendAudio',
+                       'sendDocument', 'editMessageReplyMarkup', 'copyMessage', 'forwardMessage'}
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.handed_out = {}     # update_id -> когда выдан боту
+        self._updates = []
+        self._cond = threading.Condition()
+        self._message_ids = itertools.count(1000000)
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler(), bind_and_activate=False)
+        self._httpd.daemon_threads = True
+        self._httpd.request_queue_size = 128
+        self._httpd.server_bind()
+        self._httpd.server_activate()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, name='fake-api', daemon=True).start()
+
+    def push(self, updates):
+        with self._cond:
+            self._updates.extend(updates)
+            self._cond.notify_all()
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                method = parsed.path.rsplit('/', 1)[-1]
+                params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if 'urlencoded' in self.headers.get('Content-Type', ''):
+                    params.update({k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()})
+                out = json.dumps({'ok': True, 'result': api.call(method, params)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        return Handler
+
+    def _message(self, params):
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}, 'text': params.get('text', '')}
+
+    def call(self, method, params):
+        if method == 'getUpdates':
+            return self._get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method in self.MESSAGE_METHODS:
+            return self._message(params)
+        if method == 'sendMediaGroup':
+            return [self._message(params) for _ in json.loads(params.get('media', '[]'))]
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'loadtest', 'username': 'loadtest_bot'}
+        if method == 'getFile':
+            return {'file_id': params.get('file_id'), 'file_unique_id': 'u', 'file_path': 'documents/file'}
+        return True
+
+    def _get_updates(self, offset, timeout):
+        # Длинный опрос: ждём новых обновлений, но не дольше секунды, чтобы быстрее замечать конец прогона
+        deadline = time.monotonic() + min(timeout, 1.0)
+        with self._cond:
+            while True:
+                # Подтверждённые ботом (id < offset) больше не нужны
+                while self._updates and self._updates[0]['update_id'] < offset:
+                    self._updates.pop(0)
+                if self._updates:
+                    batch = self._updates[:100]
+                    now = time.monotonic()
+                    for update in batch:
+                        self.handed_out.setdefault(update['update_id'], now)
+                    return batch
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self._cond.wait(left)
+
+# === ЗАМЕНА TELEGRAM ДЛЯ WEBHOOK ===
+def post_update(url, update, secret):
+    request = Request(url, data=json.dumps(update).encode('utf-8'), method='POST',
+                      headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret})
+    try:
+        with urlopen(request, timeout=30) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+class WebhookSender:
+    """Доставляет обновления POST-ами, как Telegram: до connections соединений сразу, обновления
+    одного пользователя — по очереди через одно соединение, на ответ не 200 — повтор."""
+
+    RETRY_DELAY = 0.1
+
+    def __init__(self, api, url, secret, connections):
+        self.api = api
+        self.url = url
+        self.secret = secret
+        self.connections = connections
+        self.statuses = Counter()
+
+    def feed(self, updates, rate):
+        queues = [queue.Queue() for _ in range(self.connections)]
+        senders = [threading.Thread(target=self._send, args=(q,), daemon=True) for q in queues]
+        for sender in senders:
+            sender.start()
+        started = time.monotonic()
+        for i, update in enumerate(updates):
+            user_id = next(iter(v for k, v in update.items() if k != 'update_id'))['from']['id']
+            queues[user_id % self.connections].put((started + i / rate if rate else 0, update))
+        for q in queues:
+            q.put(None)
+
+    def _send(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            send_at, update = task
+            delay = send_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.api.handed_out.setdefault(update['update_id'], time.monotonic())
+            while True:
+                status = post_update(self.url, update, self.secret)
+                self.statuses[status] += 1
+                if status == 200:
+                    break
+                time.sleep(self.RETRY_DELAY)
+
+# === ТРАФИК ===
+class Traffic:
+    """Синтетические обновления: у каждого пользователя свой сценарий, сценарии перемешаны
+    между собой, но порядок внутри сценария одного пользователя сохраняется."""
+
+    def __init__(self, seed, users, admins, notes):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.admins = admins
+        self.notes = notes
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}', 'username': f'user{user_id}'}
+
+    def message(self, user_id, text=None, **fields):
+        message = {'message_id': next(self._ids), 'date': int(time.time()), 'from': self._user(user_id),
+                   'chat': {'id': user_id, 'type': 'private'}}
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        message.update(fields)
+        return {'message': message}
+
+    def callback(self, user_id, data):
+        return {'callback_query': {
+            'id': str(next(self._ids)), 'chat_instance': 'loadtest', 'data': data, 'from': self._user(user_id),
+            'message': {'message_id': next(self._ids), 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': '.'}}}
+
+    def _note(self):
+        # Популярные заметки открывают чаще: примерно по закону Ципфа
+        return min(int(self.rng.paretovariate(1.2)), self.notes)
+
+    def script(self, mix, user_id):
+        rng = self.rng
+        if mix == 'list':
+            pages = rng.randint(2, 6)
+            return ([self.message(user_id, '/notes_list')] +
+                    [self.callback(user_id, f'notes_list_{page}') for page in range(2, pages + 1)] +
+                    [self.callback(user_id, 'hw_list_1')])
+        if mix == 'open':
+            script = []
+            for _ in range(rng.randint(1, 4)):
+                note_id = self._note()
+                script.append(self.callback(user_id, f'notes_show_{note_id}'))
+                if rng.random() < 0.3:
+                    script.append(self.callback(user_id, f'notes_view_comments_{note_id}'))
+            return script
+        if mix == 'reactions':
+            # Буря на нескольких горячих заметках: нажатия часто повторяются и снимают реакцию
+            hot = rng.randint(1, min(3, self.notes))
+            return [self.callback(user_id, f"notes_{rng.choice(('like', 'dislike'))}_{hot}")
+                    for _ in range(rng.randint(1, 5))]
+        if mix == 'wizard':
+            user_id = self.admins[user_id % len(self.admins)]
+            title = f'Нагрузка {user_id} {next(self._ids)}'
+            script = [self.message(user_id, '/notes_add'), self.message(user_id, title),
+                      self.message(user_id, f'Текст заметки {title}')]
+            for i in range(rng.randint(0, 3)):
+                script.append(self.message(user_id, photo=[{'file_id': f'photo-{user_id}-{i}', 'file_unique_id': 'p',
+                                                             'width': 90, 'height': 90}]))
+            script.append(self.callback(user_id, 'notes_finish_adding'))
+            return script
+        raise ValueError(mix)
+
+    def generate(self, mix, count):
+        # Сценарии пользователей, пока не наберётся count обновлений, затем случайное перемешивание
+        scripts = []
+        total = 0
+        while total < count:
+            user_id = self.rng.randint(1, self.users)
+            kind = self.rng.choices(MIXES[:4], weights=(3, 5, 2, 1))[0] if mix == 'mixed' else mix
+            script = self.script(kind, user_id)
+            scripts.append(script)
+            total += len(script)
+        # Один пользователь не выполняет два сценария одновременно: его сценарии идут друг за другом
+        by_user = {}
+        for script in scripts:
+            user_id = next(iter(script[0].values()))['from']['id']
+            by_user.setdefault(user_id, []).extend(script)
+        queues = [list(reversed(script)) for script in by_user.values()]
+        updates = []
+        while queues:
+            i = self.rng.randrange(len(queues))
+            updates.append(queues[i].pop())
+            if not queues[i]:
+                queues[i] = queues[-1]
+                queues.pop()
+        return updates
+
+# === ПРОГОН ===
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def setup_bot(args, api):
+    # main.py читает config.json и открывает базы относительно текущего каталога
+    workdir = tempfile.mkdtemp(prefix='dz-loadtest-')
+    os.chdir(workdir)
+    admins = list(range(1, args.admins + 1))
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump({'token': TOKEN, 'account_ids': admins, 'admin_ids': admins, 'workers': args.workers,
+                   'state_backend': args.state_backend}, f)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from telebot import apihelper, asyncio_helper
+    import main
+    apihelper.API_URL = asyncio_helper.API_URL = api.url + '/bot{0}/{1}'
+    if not args.telegram_limits:
+        # Лимиты Telegram ограничили бы прогон 30 сообщениями в секунду и ничего не сказали бы о самом боте
+        main.ApiScheduler.CHAT_RATE = main.ApiScheduler.GROUP_RATE = 1e6
+        main.ApiScheduler.CHAT_BURST = main.ApiScheduler.GROUP_BURST = 1e6
+        main.api_scheduler._global = main.TokenBucket(1e6, 1e6)
+    return main, workdir, admins
+
+def seed_data(main, notes, rng):
+    created_at = '2026-01-01 10:00'
+    for i in range(1, notes + 1):
+        photos = [f'seed-photo-{i}-{k}' for k in range(rng.choice((0, 0, 0, 1, 3)))]
+        main.notes_repo.replace(f'Заметка {i:04d}', f'Содержание заметки {i} ' * 5, photos, [], [], [], created_at, 'seed')
+        for k in range(rng.choice((0, 1, 5, 20))):
+            main.comments_repo.add(i, f'user{k}', f'Комментарий {k} к заметке {i}', created_at)
+    for i in range(1, notes // 4 + 1):
+        main.hw_repo.replace(f'Предмет {i:03d}', f'Задание {i}', '01.01.2027', [], [], [], [], created_at, 'seed')
+
+def feed(api, updates, rate):
+    # rate=0 — всё сразу (замер пропускной способности), иначе равномерно rate обновлений в секунду
+    if not rate:
+        api.push(updates)
+        return
+    started = time.monotonic()
+    for i, update in enumerate(updates):
+        delay = started + i / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        api.push([update])
+
+def run_mix(main, api, name, updates, timeout, rate=0, sender=None):
+    done = {}
+    lock = threading.Lock()
+    calls_before = Counter(api.calls)
+    errors_before = sum(main.metrics.counters('update_errors_total').values())
+    for update in updates:
+        update['update_id'] = next(run_mix.update_ids)
+    expected = {update['update_id'] for update in updates}
+
+    original = main.process_update
+    original_async = main.process_update_async
+
+    def finished(update):
+        with lock:
+            done[update.update_id] = time.monotonic()
+
+    def tracked(update):
+        try:
+            original(update)
+        finally:
+            finished(update)
+
+    async def tracked_async(async_bot, update):
+        try:
+            await original_async(async_bot, update)
+        finally:
+            finished(update)
+
+    main.process_update = tracked
+    main.process_update_async = tracked_async
+    started = time.monotonic()
+    if sender is not None:
+        threading.Thread(target=sender.feed, args=(updates, rate), name='feeder', daemon=True).start()
+    else:
+        threading.Thread(target=feed, args=(api, updates, rate), name='feeder', daemon=True).start()
+    deadline = started + timeout
+    while time.monotonic() < deadline:
+        with lock:
+            if expected <= done.keys():
+                break
+        time.sleep(0.01)
+    elapsed = time.monotonic() - started
+    main.process_update = original
+    main.process_update_async = original_async
+
+    latencies = [(done[i] - api.handed_out[i]) * 1000 for i in expected if i in done and i in api.handed_out]
+    calls = api.calls - calls_before
+    return {
+        'mix': name,
+        'updates': len(updates),
+        'processed': len(latencies),
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'api_calls': sum(calls.values()),
+        'errors': sum(main.metrics.counters('update_errors_total').values()) - errors_before,
+    }
+
+run_mix.update_ids = itertools.count(1)
+
+def start_webhook(main, args):
+    main.bot.threaded = False
+    server = main.WebhookServer('127.0.0.1', 0, WEBHOOK_PATH, WEBHOOK_SECRET, args.workers)
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.port}{WEBHOOK_PATH}"
+
+def check_webhook(main, server, url, traffic, workers):
+    # Проверки протокола на уже работающем сервере; последняя, drain, его останавливает.
+    # Обработчики подменены счётчиком: проверяется сервер, а не бот
+    checks = []
+    ids = itertools.count(10 ** 9)
+    processed = Counter()
+    lock = threading.Lock()
+    gate = threading.Event()
+    gate.set()
+
+    def update():
+        return dict(traffic.message(1, '/start'), update_id=next(ids))
+
+    def counting(update):
+        gate.wait()
+        with lock:
+            processed[update.update_id] += 1
+
+    def wait_processed(update_ids, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with lock:
+                if all(processed[i] for i in update_ids):
+                    return True
+            time.sleep(0.01)
+        return False
+
+    original = main.process_update
+    main.process_update = counting
+    try:
+        status = post_update(url, update(), 'wrong-' + WEBHOOK_SECRET)
+        checks.append(('чужой секрет — 403', status == 403, f"ответ {status}"))
+
+        repeated = update()
+        duplicates = server.duplicates
+        statuses = [post_update(url, repeated, WEBHOOK_SECRET) for _ in range(2)]
+        wait_processed([repeated['update_id']])
+        time.sleep(0.2)
+        checks.append(('повтор update_id обработан один раз',
+                       statuses == [200, 200] and processed[repeated['update_id']] == 1
+                       and server.duplicates == duplicates + 1,
+                       f"ответы {statuses}, обработан {processed[repeated['update_id']]} раз"))
+
+        # Обработчики стоят: workers * 4 обновлений занимают все места, следующее ждёт и получает 503
+        gate.clear()
+        accepted = [update() for _ in range(workers * 4)]
+        statuses = Counter(post_update(url, u, WEBHOOK_SECRET) for u in accepted)
+        status = post_update(url, update(), WEBHOOK_SECRET)
+        checks.append(('полная очередь — 503', statuses == Counter({200: len(accepted)}) and status == 503,
+                       f"принято {statuses[200]} из {len(accepted)}, следующее — {status}"))
+
+        # Обновление ждёт места, тем временем начинается drain: место освободится, но ответ — 503
+        pending = {}
+        waiter = threading.Thread(target=lambda: pending.update(status=post_update(url, update(), WEBHOOK_SECRET)))
+        waiter.start()
+        time.sleep(0.3)
+        drainer = threading.Thread(target=server.drain)
+        drainer.start()
+        time.sleep(0.3)
+        gate.set()
+        waiter.join(10)
+        drainer.join(30)
+        done = wait_processed([u['update_id'] for u in accepted], timeout=1)
+        checks.append(('drain дорабатывает принятое, новым — 503',
+                       not drainer.is_alive() and done and pending.get('status') == 503,
+                       f"принятые обработаны: {'да' if done else 'нет'}, ждавшее место — {pending.get('status')}"))
+    finally:
+        gate.set()
+        main.process_update = original
+    return checks
+
+def print_report(results):
+    columns = (('mix', 'сценарий', 10), ('updates', 'обновл.', 8), ('seconds', 'время, с', 9),
+               ('updates_per_sec', 'обновл./с', 10), ('p50_ms', 'p50, мс', 9), ('p95_ms', 'p95, мс', 9),
+               ('p99_ms', 'p99, мс', 9), ('api_calls', 'вызовов API', 12), ('errors', 'ошибок', 7))
+    print(''.join(title.rjust(width) if key != 'mix' else title.ljust(width) for key, title, width in columns))
+    for result in results:
+        print(''.join(str(result[key]).rjust(width) if key != 'mix' else str(result[key]).ljust(width)
+                      for key, _, width in columns))
+        if result['processed'] < result['updates']:
+            print(f"  не дождались {result['updates'] - result['processed']} обновлений")
+
+def compare(results, baseline, tolerance):
+    # Регрессия — p95 вырос или пропускная способность упала больше чем на tolerance
+    previous = {result['mix']: result for result in baseline['results']}
+    problems = []
+    for result in results:
+        before = previous.get(result['mix'])
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            problems.append(f"{result['mix']}: p95 {before['p95_ms']} -> {result['p95_ms']} мс")
+        if result['updates_per_sec'] < before['updates_per_sec'] * (1 - tolerance):
+            problems.append(f"{result['mix']}: {before['updates_per_sec']} -> {result['updates_per_sec']} обновл./с")
+        if result['processed'] < result['updates'] or result['errors']:
+            problems.append(f"{result['mix']}: обработано {result['processed']} из {result['updates']}, ошибок {result['errors']}")
+    return problems
+
+def load_traffic(path):
+    with open(path, encoding='utf-8') as f:
+        meta = json.loads(f.readline())
+        runs = {}
+        for line in f:
+            record = json.loads(line)
+            runs.setdefault(record.pop('mix'), []).append(record)
+    return meta, runs
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на локальной замене Bot API")
+    parser.add_argument('--mix', choices=MIXES, action='append', help="сценарий; по умолчанию все")
+    parser.add_argument('--updates', type=int, default=2000, help="обновлений на сценарий")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--admins', type=int, default=20, help="сколько из пользователей — админы (мастер заметок)")
+    parser.add_argument('--notes', type=int, default=200, help="заметок в базе перед прогоном")
+    parser.add_argument('--rate', type=float, default=0, help="обновлений в секунду; 0 — все сразу")
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--transport', choices=('polling', 'async', 'webhook'), default='polling',
+                        help="как бот получает обновления: getUpdates (polling, async) или POST в WebhookServer")
+    parser.add_argument('--state-backend', choices=('sqlite', 'memory'), default='sqlite')
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument('--telegram-limits', action='store_true', help="не снимать лимиты отправки ApiScheduler")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=300, help="сколько ждать окончания сценария, с")
+    parser.add_argument('--save', help="записать сгенерированный трафик в NDJSON")
+    parser.add_argument('--replay', help="прогнать трафик из файла, записанного --save")
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    parser.add_argument('--baseline', help="JSON прошлого прогона: сравнить и вернуть 1 при регрессии")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    return parser.parse_args(argv)
+
+def main_cli(argv):
+    args = parse_args(argv)
+    # Дальше рабочий каталог меняется на временный
+    for key in ('save', 'replay', 'baseline'):
+        if getattr(args, key):
+            setattr(args, key, os.path.abspath(getattr(args, key)))
+    runs = None
+    if args.replay:
+        # Воспроизводим и данные, и трафик: параметры базы берутся из файла
+        meta, runs = load_traffic(args.replay)
+        if args.mix:
+            runs = {mix: updates for mix, updates in runs.items() if mix in args.mix}
+        for key in ('seed', 'users', 'admins', 'notes'):
+            setattr(args, key, meta[key])
+
+    api = FakeBotApi(args.api_latency)
+    api.start()
+    main, workdir, admins = setup_bot(args, api)
+    seed_data(main, args.notes, random.Random(args.seed))
+
+    if runs is None:
+        traffic = Traffic(args.seed, args.users, admins, args.notes)
+        runs = {mix: traffic.generate(mix, args.updates) for mix in (args.mix or MIXES)}
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'type': 'meta', 'seed': args.seed, 'users': args.users,
+                                'admins': args.admins, 'notes': args.notes}) + '\n')
+            for mix, updates in runs.items():
+                for update in updates:
+                    f.write(json.dumps(dict(update, mix=mix), ensure_ascii=False) + '\n')
+
+    sender = None
+    if args.transport == 'webhook':
+        server, url = start_webhook(main, args)
+        sender = WebhookSender(api, url, WEBHOOK_SECRET, args.workers)
+    else:
+        run = main.run_async if args.transport == 'async' else main.run_polling
+        threading.Thread(target=run, args=(args.workers,), name=args.transport, daemon=True).start()
+    results = [run_mix(main, api, mix, updates, args.timeout, args.rate, sender) for mix, updates in runs.items()]
+    checks = []
+    if sender is not None:
+        checks = check_webhook(main, server, url, Traffic(args.seed, args.users, admins, args.notes), args.workers)
+
+    if args.json:
+        print(json.dumps({'args': {k: v for k, v in vars(args).items() if k not in ('baseline', 'json')},
+                          'results': results,
+                          'webhook_checks': [{'check': name, 'ok': ok, 'details': details} for name, ok, details in checks]},
+                         ensure_ascii=False, indent=2))
+    else:
+        print_report(results)
+        if sender is not None:
+            print(f"\nОтветы webhook: {dict(sender.statuses)}")
+            for name, ok, details in checks:
+                print(f"{'ок    ' if ok else 'ОШИБКА'} {name}: {details}")
+        print(f"\nБазы и config.json прогона: {workdir}")
+    if not all(ok for _, ok, _ in checks):
+        return 1
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"Регрессия: {problem}", file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli(sys.argv[1:]))
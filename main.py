@@ -2,9 +2,31 @@ import telebot
 import sqlite3
 import json
 import os
-from telebot import types
+from telebot import types, apihelper
 from datetime import datetime, timezone, timedelta
 import html
+import threading
+import time
+from collections import OrderedDict, deque
+import atexit
+import heapq
+import itertools
+import bisect
+import functools
+import inspect
+import requests
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import signal
+import queue
+import sys
+import io
+import tempfile
+from storage import (Database, init_notes_db, init_hw_db, init_state_db, LOCAL_TZ, parse_due_date, build_fts_query,
+                     NotesRepository, ReactionsRepository, CommentsRepository, HomeworkRepository, RemindersRepository)
 
 # === ПУТЬ К КОНФИГУ ===
 CONFIG_PATH = 'config.json'
@@ -13,7 +35,18 @@ CONFIG_PATH = 'config.json'
 DEFAULT_CONFIG = {
     "token": "ВАШ_ТОКЕН_ЗДЕСЬ",
     "account_ids": [123456789],  # Для заметок
-    "admin_ids": [123456789]  # Для ДЗ
+    "admin_ids": [123456789],  # Для ДЗ
+    "mode": "polling",  # polling | async | webhook
+    "workers": 16,  # Потоки для обработки обновлений
+    "webhook_url": "",  # Публичный https-адрес, например https://example.com/bot
+    "webhook_listen": "0.0.0.0",
+    "webhook_port": 8443,
+    "webhook_secret": "",  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+    "state_backend": "sqlite",  # sqlite | memory
+    "state_ttl": 86400,  # Через сколько секунд забывать брошенный диалог
+    "metrics_listen": "127.0.0.1",
+    "metrics_port": 0,  # Порт для /metrics в формате Prometheus; 0 — не поднимать
+    "reminder_hours": [24]  # За сколько часов до срока напоминать подписчикам; [] — не напоминать
 }
 
 # === Загрузка или создание config.json ===
@@ -45,96 +78,1130 @@ config = load_config()
 TOKEN = config["token"]
 ACCOUNT_IDS = config["account_ids"]
 ADMIN_IDS = config["admin_ids"]
+RUN_MODE = config.get("mode", "polling")
+WORKERS = config.get("workers", 16)
+WEBHOOK_URL = config.get("webhook_url", "")
+WEBHOOK_LISTEN = config.get("webhook_listen", "0.0.0.0")
+WEBHOOK_PORT = config.get("webhook_port", 8443)
+WEBHOOK_SECRET = config.get("webhook_secret", "")
+STATE_BACKEND = config.get("state_backend", "sqlite")
+STATE_TTL = config.get("state_ttl", 86400)
+METRICS_LISTEN = config.get("metrics_listen", "127.0.0.1")
+METRICS_PORT = config.get("metrics_port", 0)
+REMINDER_HOURS = config.get("reminder_hours", [24])
 
 bot = telebot.TeleBot(TOKEN)
 
-# === БАЗЫ ДАННЫХ ===
-def init_notes_db():
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS notes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            content TEXT NOT NULL,
-            photo_file_ids TEXT,
-            video_file_ids TEXT,
-            audio_file_ids TEXT,
-            file_file_ids TEXT,
-            created_at TEXT,
-            creator_username TEXT,
-            views INTEGER DEFAULT 0
-        )
-    ''')
-    c.execute("PRAGMA table_info(notes)")
-    columns = [info[1] for info in c.fetchall()]
-    if 'photo_file_ids' not in columns:
-        c.execute('ALTER TABLE notes ADD COLUMN photo_file_ids TEXT')
-    if 'video_file_ids' not in columns:
-        c.execute('ALTER TABLE notes ADD COLUMN video_file_ids TEXT')
-    if 'audio_file_ids' not in columns:
-        c.execute('ALTER TABLE notes ADD COLUMN audio_file_ids TEXT')
-    if 'file_file_ids' not in columns:
-        c.execute('ALTER TABLE notes ADD COLUMN file_file_ids TEXT')
-    if 'creator_username' not in columns:
-        c.execute('ALTER TABLE notes ADD COLUMN creator_username TEXT')
-    if 'views' not in columns:
-        c.execute('ALTER TABLE notes ADD COLUMN views INTEGER DEFAULT 0')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS reactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            note_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            reaction INTEGER NOT NULL,
-            UNIQUE(note_id, user_id)
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS comments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            note_id INTEGER NOT NULL,
-            user_identifier TEXT NOT NULL,
-            content TEXT NOT NULL,
-            created_at TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def init_hw_db():
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS homework (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            subject TEXT NOT NULL,
-            task TEXT NOT NULL,
-            due_date TEXT,
-            photo_file_ids TEXT,
-            video_file_ids TEXT,
-            audio_file_ids TEXT,
-            file_file_ids TEXT,
-            created_at TEXT,
-            creator_username TEXT
-        )
-    ''')
-    c.execute("PRAGMA table_info(homework)")
-    columns = [info[1] for info in c.fetchall()]
-    if 'photo_file_ids' not in columns:
-        c.execute('ALTER TABLE homework ADD COLUMN photo_file_ids TEXT')
-    if 'video_file_ids' not in columns:
-        c.execute('ALTER TABLE homework ADD COLUMN video_file_ids TEXT')
-    if 'audio_file_ids' not in columns:
-        c.execute('ALTER TABLE homework ADD COLUMN audio_file_ids TEXT')
-    if 'file_file_ids' not in columns:
-        c.execute('ALTER TABLE homework ADD COLUMN file_file_ids TEXT')
-    if 'creator_username' not in columns:
-        c.execute('ALTER TABLE homework ADD COLUMN creator_username TEXT')
-    conn.commit()
-    conn.close()
-
-init_notes_db()
-init_hw_db()
+# === МЕТРИКИ ===
+class Histogram:
+    """Распределение значений по фиксированным корзинам, как гистограмма Prometheus."""
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — всё, что больше верхней границы
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+
+    def copy(self):
+        result = Histogram(self.buckets)
+        result.merge(self)
+        return result
+
+    def quantile(self, q):
+        # Оценка по корзинам с линейной интерполяцией внутри корзины
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for upper, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return self.buckets[-1] if self.count else 0.0
+
+
+class Metrics:
+    """Счётчики и гистограммы процесса; отдаются в текстовом формате Prometheus."""
+
+    PREFIX = 'dzbot_'
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        self._observe((name, tuple(sorted(labels.items()))), value)
+
+    def _observe(self, key, value):
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def timed(self, name, func, **labels):
+        # Обёртка для горячих путей: без contextmanager и с готовым ключом
+        key = (name, tuple(sorted(labels.items())))
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._observe(key, time.monotonic() - started)
+        return wrapper
+
+    def collect(self, func):
+        # func() при каждом снятии метрик отдаёт пары (имя, тип, метки, значение)
+        self._collectors.append(func)
+
+    def collect_stats(self, prefix, stats, counters=()):
+        # Числа из stats() компонента: ключи из counters — счётчики, остальные — текущие значения
+        def collector():
+            for key, value in stats().items():
+                if key in counters:
+                    yield f'{prefix}_{key}_total', 'counter', {}, value
+                else:
+                    yield f'{prefix}_{key}', 'gauge', {}, value
+        self.collect(collector)
+
+    def counters(self, name):
+        with self._lock:
+            return {labels: value for (n, labels), value in self._counters.items() if n == name}
+
+    def histograms(self, name):
+        with self._lock:
+            return {labels: h.copy() for (n, labels), h in self._histograms.items() if n == name}
+
+    def histogram(self, name):
+        # Все метки вместе
+        total = Histogram()
+        for histogram in self.histograms(name).values():
+            total.merge(histogram)
+        return total
+
+    def samples(self, name):
+        # Текущие значения из сборщиков: [(метки, значение)]
+        return [(labels, value) for n, _, labels, value in self._collected() if n == name]
+
+    def _collected(self):
+        samples = [('uptime_seconds', 'gauge', {}, time.time() - self.started)]
+        for collector in self._collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                print(f"Ошибка сбора метрик: {e}")
+        return samples
+
+    @staticmethod
+    def _labels(labels, **extra):
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, h.copy()) for key, h in self._histograms.items())
+        lines = []
+        typed = set()
+
+        def type_line(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {self.PREFIX}{name} {kind}')
+
+        for (name, labels), value in counters:
+            type_line(name, 'counter')
+            lines.append(f'{self.PREFIX}{name}{self._labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            type_line(name, 'histogram')
+            cumulative = 0
+            for upper, n in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += n
+                le = '+Inf' if upper == float('inf') else repr(upper)
+                lines.append(f'{self.PREFIX}{name}_bucket{self._labels(labels, le=le)} {cumulative}')
+            lines.append(f'{self.PREFIX}{name}_sum{self._labels(labels)} {histogram.sum}')
+            lines.append(f'{self.PREFIX}{name}_count{self._labels(labels)} {histogram.count}')
+        for name, kind, labels, value in sorted(self._collected(), key=lambda s: s[0]):
+            type_line(name, kind)
+            lines.append(f'{self.PREFIX}{name}{self._labels(sorted(labels.items()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def instrumented(cls):
+    # Время каждого публичного метода репозитория — в db_query_seconds{query="Класс.метод"}.
+    # Генераторы пропускаются: их время размазано по всему обходу
+    for name, func in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.isfunction(func) or inspect.isgeneratorfunction(func):
+            continue
+        setattr(cls, name, metrics.timed('db_query_seconds', func, query=f'{cls.__name__}.{name}'))
+    return cls
+
+# === ОГРАНИЧЕНИЕ ЗАПРОСОВ К API ===
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def reserve(self, now):
+        # Берёт токен, при необходимости в долг, и возвращает, сколько ждать своей очереди
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class ApiScheduler:
+    """Пропускает запросы к Bot API через общий и початовые лимиты и повторяет их после 429."""
+
+    GLOBAL_RATE = 30           # сообщений в секунду на бота
+    GLOBAL_BURST = 5
+    CHAT_RATE = 1              # сообщение в секунду в личный чат
+    CHAT_BURST = 3
+    GROUP_RATE = 20 / 60       # 20 сообщений в минуту в группу
+    GROUP_BURST = 5
+    MAX_RETRIES = 3
+    MAX_CHAT_BUCKETS = 2048
+
+    LANE_MESSAGES = 0
+    LANE_BULK = 1
+    BULK_METHODS = {'sendPhoto', 'sendVideo', 'sendAudio', 'sendDocument', 'sendMediaGroup'}
+
+    def __init__(self):
+        self._global = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_BURST)
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._queue = []
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self.throttled = 0
+        self.retries = 0
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def lane_of(self, method_name):
+        # Ответы на нажатия кнопок и инлайн-запросы не ждут в очереди вообще
+        if method_name.startswith('answer'):
+            return None
+        if method_name in self.BULK_METHODS:
+            return self.LANE_BULK
+        if method_name.startswith(('send', 'edit', 'copy', 'forward')):
+            return self.LANE_MESSAGES
+        return None
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                for key in [k for k, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[key]
+            try:
+                is_group = int(chat_id) < 0
+            except ValueError:
+                is_group = True  # @username канала
+            if is_group:
+                bucket = TokenBucket(self.GROUP_RATE, self.GROUP_BURST)
+            else:
+                bucket = TokenBucket(self.CHAT_RATE, self.CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def reserve_chat(self, chat_id):
+        # Взять токен чата заранее; возвращает, через сколько секунд им можно воспользоваться.
+        # Запрос, для которого токен уже взят, отправляется внутри prepaid()
+        with self._lock:
+            now = time.monotonic()
+            wait = self._chat_bucket(str(chat_id), now).reserve(now)
+            if wait > 0:
+                self.throttled += 1
+        return wait
+
+    @contextmanager
+    def prepaid(self):
+        # Первый запрос этого потока не проходит лимит чата: токен взят через reserve_chat()
+        self._local.prepaid = True
+        try:
+            yield
+        finally:
+            self._local.prepaid = False
+
+    def _acquire(self, chat_id, lane):
+        prepaid = getattr(self._local, 'prepaid', False)
+        self._local.prepaid = False
+        if chat_id is not None and not prepaid:
+            wait = self.reserve_chat(chat_id)
+            if wait > 0:
+                time.sleep(wait)
+
+        # Общий лимит: первым токен получает запрос из более приоритетной очереди
+        with self._cond:
+            ticket = (lane, next(self._seq))
+            heapq.heappush(self._queue, ticket)
+            while True:
+                if self._queue[0] == ticket:
+                    wait = self._global.wait_time(time.monotonic())
+                    if wait <= 0:
+                        self._global.tokens -= 1
+                        heapq.heappop(self._queue)
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _retry_after(self, response):
+        if response.status_code != 429:
+            return None
+        try:
+            return response.json().get('parameters', {}).get('retry_after', 1)
+        except ValueError:
+            return 1
+
+    @contextmanager
+    def background(self):
+        # Фоновые рассылки из этого потока идут очередью тяжёлых запросов и уступают ответам пользователям
+        self._local.background = True
+        try:
+            yield
+        finally:
+            self._local.background = False
+
+    def send(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        method_name = url.rsplit('/', 1)[-1]
+        lane = self.lane_of(method_name)
+        if lane == self.LANE_MESSAGES and getattr(self._local, 'background', False):
+            lane = self.LANE_BULK
+        chat_id = (params or {}).get('chat_id')
+        attempt = 0
+        while True:
+            if lane is not None:
+                with metrics.timer('api_wait_seconds', method=method_name):
+                    self._acquire(chat_id, lane)
+            started = time.monotonic()
+            try:
+                response = self._session().request(method, url, params=params, files=files,
+                                                   timeout=timeout, proxies=proxies)
+            except requests.RequestException:
+                metrics.inc('api_errors_total', method=method_name, code='network')
+                raise
+            finally:
+                metrics.observe('api_request_seconds', time.monotonic() - started, method=method_name)
+            if response.status_code != 200:
+                metrics.inc('api_errors_total', method=method_name, code=str(response.status_code))
+            retry_after = self._retry_after(response)
+            if retry_after is None or attempt >= self.MAX_RETRIES:
+                return response
+            attempt += 1
+            # Telegram попросил подождать: тормозим весь чат (или всех, если чата нет), а не только этот запрос
+            with self._lock:
+                self.retries += 1
+                until = time.monotonic() + retry_after
+                bucket = self._chat_bucket(str(chat_id), time.monotonic()) if chat_id is not None else self._global
+                bucket.blocked_until = max(bucket.blocked_until, until)
+            if lane is None:
+                time.sleep(retry_after)
+            # Файлы, переданные объектами, нужно перемотать перед повтором
+            for value in (files or {}).values():
+                stream = value[1] if isinstance(value, tuple) else value
+                if hasattr(stream, 'seek'):
+                    stream.seek(0)
+
+    def stats(self):
+        with self._lock:
+            return {'chats': len(self._chats), 'queued': len(self._queue),
+                    'throttled': self.throttled, 'retries': self.retries}
+
+api_scheduler = ApiScheduler()
+metrics.collect_stats('api', api_scheduler.stats, counters=('throttled', 'retries'))
+apihelper.CUSTOM_REQUEST_SENDER = api_scheduler.send
+
+notes_db = Database('notes.db')
+hw_db = Database('homework.db')
+state_db = Database('state.db')
+atexit.register(notes_db.close_all)
+atexit.register(hw_db.close_all)
+atexit.register(state_db.close_all)
+
+init_notes_db(notes_db)
+init_hw_db(hw_db)
+if STATE_BACKEND == 'sqlite':
+    init_state_db(state_db)
+
+# Время каждого запроса к БД — в метриках db_query_seconds
+for repository_cls in (NotesRepository, ReactionsRepository, CommentsRepository, HomeworkRepository, RemindersRepository):
+    instrumented(repository_cls)
+
+notes_repo = NotesRepository(notes_db)
+reactions_repo = ReactionsRepository(notes_db)
+comments_repo = CommentsRepository(notes_db)
+hw_repo = HomeworkRepository(hw_db)
+reminders_repo = RemindersRepository(hw_db)
+
+# === КЭШ КАРТОЧЕК ===
+class RenderCache:
+    """LRU-кэш готовых карточек заметок и ДЗ с ограниченным временем жизни."""
+
+    def __init__(self, max_size=512, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, generation):
+        # generation берётся до чтения из БД: если за это время была инвалидация,
+        # собранная карточка может быть устаревшей и в кэш не попадает
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def replace(self, key, value, generation):
+        # Новая версия карточки взамен старой; generation берётся до изменения в БД.
+        # Если с тех пор была другая запись, неизвестно, чья версия новее, — просто сбрасываем
+        kind, item_id, _ = key
+        with self._lock:
+            stale = generation != self.generation
+            self.generation += 1
+            self._data.pop((kind, item_id, False), None)
+            self._data.pop((kind, item_id, True), None)
+            if not stale:
+                self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def invalidate(self, kind, item_id):
+        # Ключи: (вид, id, вариант для админа)
+        with self._lock:
+            self.generation += 1
+            self._data.pop((kind, item_id, False), None)
+            self._data.pop((kind, item_id, True), None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+render_cache = RenderCache()
+metrics.collect_stats('render_cache', render_cache.stats, counters=('hits', 'misses'))
+
+# === ОТЛОЖЕННАЯ ЗАПИСЬ ПРОСМОТРОВ ===
+class ViewCounter:
+    """Копит просмотры в памяти и записывает их пачкой по таймеру или по порогу.
+    Пишет фоновый поток: ошибка записи не доходит до обработчика, просмотры ждут следующей попытки."""
+
+    def __init__(self, repo, flush_interval=5.0, flush_threshold=200):
+        self.repo = repo
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = {}
+        self._pending_total = 0
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='view-counter', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Ошибка записи просмотров: {e}")
+                # Не повторять чаще раза в интервал, даже если порог уже набран
+                self._stop.wait(self.flush_interval)
+
+    def increment(self, note_id):
+        with self._lock:
+            self._pending[note_id] = self._pending.get(note_id, 0) + 1
+            self._pending_total += 1
+            full = self._pending_total >= self.flush_threshold
+        if full:
+            # Набрался порог: записать сейчас, но в фоновом потоке, а не в обработчике
+            self._wake.set()
+
+    def pending(self, note_id):
+        # Ещё не записанные просмотры, включая пачку, которая пишется прямо сейчас
+        with self._lock:
+            return self._pending.get(note_id, 0) + self._flushing.get(note_id, 0)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                self._pending_total = 0
+            try:
+                self.repo.add_views(self._flushing.items())
+                # Число просмотров в кэше больше не актуально
+                for note_id in self._flushing:
+                    render_cache.invalidate('note', note_id)
+            except Exception:
+                # Не теряем просмотры: вернуть пачку в очередь до следующей попытки
+                with self._lock:
+                    for note_id, n in self._flushing.items():
+                        self._pending[note_id] = self._pending.get(note_id, 0) + n
+                        self._pending_total += n
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+view_counter = ViewCounter(notes_repo)
+# Регистрируется после закрытия соединений, поэтому при выходе выполняется раньше него
+atexit.register(view_counter.stop)
+
+# === ОТПРАВКА ВЛОЖЕНИЙ ===
+class MediaDelivery:
+    """Отправляет вложения альбомами по 10 штук параллельно, не больше нескольких запросов на чат.
+    Отправки чата ждут своей очереди и его лимита до общего пула, а не в нём: потоки пула
+    не простаивают, пока соседний чат получает сотню вложений."""
+
+    GROUP_SIZE = 10
+    KINDS = (
+        ('photo', 'фото', types.InputMediaPhoto, 'send_photo'),
+        ('video', 'видео', types.InputMediaVideo, 'send_video'),
+        ('audio', 'аудио', types.InputMediaAudio, 'send_audio'),
+        ('file', 'файл', types.InputMediaDocument, 'send_document'),
+    )
+
+    def __init__(self, workers=8, per_chat=3):
+        self.per_chat = per_chat
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media')
+        self._chats = {}  # chat_id -> {'queue': отправки в очереди, 'running': сколько в работе}
+        self._lock = threading.Lock()
+
+    def _submit(self, chat_id, func, *args):
+        future = Future()
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = {'queue': deque(), 'running': 0}
+            chat['queue'].append((future, func, args))
+        self._pump(chat_id)
+        return future
+
+    def _pump(self, chat_id):
+        # В работу берётся не больше per_chat отправок чата. Токен лимита чата берётся сразу,
+        # а если его ждать, отправка ждёт в таймере и попадает в пул, когда токен готов
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            jobs = []
+            while chat is not None and chat['queue'] and chat['running'] < self.per_chat:
+                chat['running'] += 1
+                jobs.append(chat['queue'].popleft())
+        for job in jobs:
+            wait = api_scheduler.reserve_chat(chat_id)
+            if wait > 0:
+                timer = threading.Timer(wait, self._executor.submit, args=(self._run, chat_id, job))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._executor.submit(self._run, chat_id, job)
+
+    def _run(self, chat_id, job):
+        future, func, args = job
+        try:
+            with api_scheduler.prepaid():
+                future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                chat = self._chats[chat_id]
+                chat['running'] -= 1
+                if not chat['running'] and not chat['queue']:
+                    del self._chats[chat_id]
+            self._pump(chat_id)
+
+    def _send_one(self, chat_id, kind, file_id, caption):
+        _, _, _, method = next(k for k in self.KINDS if k[0] == kind)
+        kwargs = {'caption': caption, 'parse_mode': 'HTML'} if caption else {}
+        getattr(bot, method)(chat_id, file_id, **kwargs)
+
+    def _send_chunk(self, chat_id, kind, media_cls, chunk, start, caption):
+        # Возвращает список (номер вложения, ошибка) для того, что отправить не удалось
+        if len(chunk) == 1:
+            try:
+                self._send_one(chat_id, kind, chunk[0], caption)
+                return []
+            except Exception as e:
+                return [(start, e)]
+        media = [media_cls(chunk[0], caption=caption, parse_mode='HTML') if caption else media_cls(chunk[0])]
+        media += [media_cls(file_id) for file_id in chunk[1:]]
+        try:
+            bot.send_media_group(chat_id, media)
+            return []
+        except Exception:
+            pass
+        # Альбом не ушёл: шлём по одному, чтобы понять, какие именно вложения битые
+        failed = []
+        for i, file_id in enumerate(chunk):
+            try:
+                self._send_one(chat_id, kind, file_id, caption if i == 0 else None)
+            except Exception as e:
+                failed.append((start + i, e))
+        return failed
+
+    def deliver(self, chat_id, photos, videos, audios, files, caption=None, on_done=None):
+        """Ставит вложения в очередь и сразу возвращается. Когда уйдёт последнее, отправляет сводку
+        ошибок и вызывает on_done(caption_sent): True, если подпись ушла вместе с первым фото."""
+        items = dict(zip(('photo', 'video', 'audio', 'file'), (photos, videos, audios, files)))
+        chunks = []
+        for kind, label, media_cls, _ in self.KINDS:
+            ids = items[kind] or []
+            for start in range(0, len(ids), self.GROUP_SIZE):
+                chunk_caption = caption if kind == 'photo' and start == 0 else None
+                chunks.append((kind, label, media_cls, ids[start:start + self.GROUP_SIZE], start, chunk_caption))
+        if not chunks:
+            if on_done:
+                on_done(False)
+            return
+        results = [None] * len(chunks)
+        remaining = [len(chunks)]
+
+        def chunk_done(position, label, future):
+            # Итог — отдельной отправкой в очереди чата, когда завершился последний альбом
+            try:
+                results[position] = (label, future.result())
+            except Exception as e:
+                results[position] = (label, [(0, e)])
+            with self._lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                self._submit(chat_id, self._finish, chat_id, chunks, results, bool(photos) and bool(caption), on_done)
+
+        for position, (kind, label, media_cls, chunk, start, chunk_caption) in enumerate(chunks):
+            future = self._submit(chat_id, self._send_chunk, chat_id, kind, media_cls, chunk, start, chunk_caption)
+            future.add_done_callback(functools.partial(chunk_done, position, label))
+
+    def _finish(self, chat_id, chunks, results, with_caption, on_done):
+        failures = []
+        for (kind, _, _, _, _, _), (label, failed) in zip(chunks, results):
+            failures += [(kind, label, index, e) for index, e in failed]
+        try:
+            if failures:
+                lines = [f"{label} №{index + 1}: {html.escape(getattr(e, 'description', None) or str(e))}" for _, label, index, e in failures]
+                bot.send_message(chat_id, "<b>Не удалось отправить вложения:</b>\n" + "\n".join(lines), parse_mode='HTML')
+            if on_done:
+                on_done(with_caption and not any(kind == 'photo' and index == 0 for kind, _, index, _ in failures))
+        except Exception as e:
+            print(f"Ошибка после отправки вложений в чат {chat_id}: {e}")
+
+media_delivery = MediaDelivery()
+
+def send_saved_reply(chat_id, response, markup, caption_sent):
+    # Итог сохранения — после вложений; если текст ушёл подписью к первому фото, не повторяем его
+    if caption_sent:
+        bot.send_message(chat_id, "Готово!", reply_markup=markup)
+    else:
+        bot.send_message(chat_id, response, parse_mode='HTML', reply_markup=markup)
+
+# === ОБЪЕДИНЕНИЕ ПРАВОК СООБЩЕНИЙ ===
+class EditCoalescer:
+    """Склеивает частые правки одного сообщения: первая уходит сразу, остальные в течение
+    окна заменяют друг друга и отправляются одной правкой в конце окна."""
+
+    WINDOW = 0.3
+    MAX_MESSAGES = 4096
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._messages = OrderedDict()  # (chat_id, message_id) -> состояние
+        self._lock = threading.Lock()
+        self.requested = 0
+        self.sent = 0
+        self.unchanged = 0
+        self.coalesced = 0
+
+    def _state(self, key):
+        state = self._messages.get(key)
+        if state is None:
+            state = self._messages[key] = {'sent_hash': None, 'sent_at': 0.0, 'pending': None}
+            # Таймер держит ссылку на своё состояние, поэтому вытеснение ему не мешает
+            while len(self._messages) > self.MAX_MESSAGES:
+                self._messages.popitem(last=False)
+        self._messages.move_to_end(key)
+        return state
+
+    def edit(self, chat_id, message_id, text, reply_markup=None, parse_mode='HTML'):
+        markup_json = reply_markup.to_json() if reply_markup is not None else None
+        edit = {'hash': hash((text, markup_json, parse_mode)), 'chat_id': chat_id, 'message_id': message_id,
+                'text': text, 'reply_markup': reply_markup, 'parse_mode': parse_mode}
+        with self._lock:
+            self.requested += 1
+            state = self._state((chat_id, message_id))
+            latest = state['pending']['hash'] if state['pending'] else state['sent_hash']
+            if edit['hash'] == latest:
+                # Telegram всё равно отклонит правку без изменений
+                self.unchanged += 1
+                return
+            if state['pending'] is not None:
+                self.coalesced += 1
+                state['pending'] = edit
+                return
+            wait = state['sent_at'] + self.window - time.monotonic()
+            if wait > 0:
+                state['pending'] = edit
+                timer = threading.Timer(wait, self._flush, args=(state,))
+                timer.daemon = True
+                timer.start()
+                return
+            self._mark_sent(state, edit)
+        try:
+            self._send(edit)
+        except Exception:
+            self._send_failed(state, edit)
+            raise
+
+    def _mark_sent(self, state, edit):
+        state['sent_hash'] = edit['hash']
+        state['sent_at'] = time.monotonic()
+        self.sent += 1
+
+    def _send_failed(self, state, edit):
+        # Правка не дошла: повторное нажатие с тем же текстом не должно считаться «без изменений»
+        with self._lock:
+            if state['sent_hash'] == edit['hash']:
+                state['sent_hash'] = None
+
+    def _flush(self, state):
+        with self._lock:
+            edit, state['pending'] = state['pending'], None
+            if edit is None or edit['hash'] == state['sent_hash']:
+                return
+            self._mark_sent(state, edit)
+        try:
+            self._send(edit)
+        except Exception as e:
+            self._send_failed(state, edit)
+            print(f"Ошибка отложенной правки сообщения: {e}")
+
+    def _send(self, edit):
+        try:
+            bot.edit_message_text(edit['text'], chat_id=edit['chat_id'], message_id=edit['message_id'],
+                                  parse_mode=edit['parse_mode'], reply_markup=edit['reply_markup'])
+        except telebot.apihelper.ApiTelegramException as e:
+            if 'message is not modified' not in str(e.description):
+                raise
+
+    def stats(self):
+        with self._lock:
+            return {'requested': self.requested, 'sent': self.sent, 'unchanged': self.unchanged,
+                    'coalesced': self.coalesced, 'saved': self.unchanged + self.coalesced}
+
+edit_coalescer = EditCoalescer()
+metrics.collect_stats('edits', edit_coalescer.stats, counters=('requested', 'sent', 'unchanged', 'coalesced', 'saved'))
+
+# === НАПОМИНАНИЯ О СРОКАХ ===
+class ReminderScheduler:
+    """Напоминает подписчикам о сроках ДЗ. Ближайшие события лежат в куче, поток спит до первого
+    из них; курсор в БД позволяет после перезапуска продолжить с того же события и пользователя."""
+
+    LOOKAHEAD = 6 * 3600  # на сколько вперёд читать события из БД
+    MAX_EVENTS = 1000     # и не больше стольких за раз
+    BATCH = 200           # подписчиков в пачке; курсор сохраняется после каждой
+    SENDERS = 8
+
+    def __init__(self, repo, hours):
+        self.repo = repo
+        self.leads = sorted({int(h * 3600) for h in hours})
+        self._heap = []  # (время отправки, id ДЗ, последний получивший пользователь)
+        self._loaded_until = 0
+        self._reload = True
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self.events = 0
+        self.skipped = 0
+        self.sent = 0
+        self.failed = 0
+        self.unsubscribed = 0
+
+    def start(self):
+        if self._thread is None and self.leads:
+            self._executor = ThreadPoolExecutor(max_workers=self.SENDERS, thread_name_prefix='reminder')
+            self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        # ДЗ добавили, изменили или удалили: перечитать ближайшие события
+        with self._cond:
+            self._reload = True
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._executor.shutdown()
+
+    def _load(self, now):
+        cursor = self.repo.get_cursor()
+        if cursor is None:
+            # Первый запуск: о сроках, прошедших до него, не напоминаем
+            cursor = (now, 0, None)
+            self.repo.save_cursor(*cursor)
+        fire_at, hw_id, user_id = cursor
+        until = now + self.LOOKAHEAD
+        events = []
+        for lead in self.leads:
+            rows = self.repo.upcoming(fire_at, hw_id, until, lead, self.MAX_EVENTS)
+            if len(rows) == self.MAX_EVENTS:
+                # Остальные события этого напоминания дочитаем, когда разошлём эти
+                until = min(until, rows[-1][0])
+            events += [(f, h, 0) for f, h in rows]
+        events = [e for e in events if e[0] <= until]
+        if user_id is not None:
+            events.append((fire_at, hw_id, user_id))  # рассылка прервалась посередине
+        heapq.heapify(events)
+        with self._cond:
+            self._heap = events
+            self._loaded_until = until
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = time.time()
+                    if self._reload or (not self._heap and now >= self._loaded_until):
+                        self._reload = False
+                        event = None
+                        break
+                    if self._heap and self._heap[0][0] <= now:
+                        event = heapq.heappop(self._heap)
+                        break
+                    self._cond.wait((self._heap[0][0] if self._heap else self._loaded_until) - now)
+            try:
+                if event is None:
+                    self._load(int(time.time()))
+                else:
+                    self._fire(*event)
+            except Exception as e:
+                print(f"Ошибка рассылки напоминаний: {e}")
+                # Не крутиться на постоянной ошибке: событие остаётся за курсором до следующей попытки
+                with self._cond:
+                    self._reload = True
+                    self._cond.wait(30)
+
+    def _fire(self, fire_at, hw_id, user_id):
+        row = self.repo.get_reminder(hw_id)
+        # ДЗ удалили, срок перенесли или он уже прошёл, пока бот был выключен
+        if row is None or row[2] is None or row[2] - fire_at not in self.leads or row[2] <= time.time():
+            self.skipped += 1
+            self.repo.save_cursor(fire_at, hw_id, None)
+            return
+        subject, due_date, _ = row
+        text = f"⏰ Скоро срок сдачи ДЗ по <b>{html.escape(subject)}</b>: {html.escape(due_date)}"
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("Открыть", callback_data=f"hw_show_{hw_id}"))
+        self.events += 1
+        self.repo.save_cursor(fire_at, hw_id, user_id)
+        while not self._stopping:
+            users = self.repo.subscribers_page(user_id, self.BATCH)
+            if not users:
+                self.repo.save_cursor(fire_at, hw_id, None)
+                return
+            self._send_batch(users, text, markup)
+            user_id = users[-1]
+            self.repo.save_cursor(fire_at, hw_id, user_id)
+
+    def _send_batch(self, users, text, markup):
+        results = list(self._executor.map(lambda u: self._send_one(u, text, markup), users))
+        blocked = [u for u, result in zip(users, results) if result is None]
+        if blocked:
+            self.repo.unsubscribe_many(blocked)
+            self.unsubscribed += len(blocked)
+        self.sent += results.count(True)
+        self.failed += results.count(False)
+
+    def _send_one(self, user_id, text, markup):
+        # True — доставлено, None — пользователь заблокировал бота, False — другая ошибка
+        try:
+            with api_scheduler.background():
+                bot.send_message(user_id, text, parse_mode='HTML', reply_markup=markup)
+            return True
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 403:
+                return None
+            print(f"Не удалось отправить напоминание {user_id}: {e}")
+        except Exception as e:
+            print(f"Не удалось отправить напоминание {user_id}: {e}")
+        return False
+
+    def stats(self):
+        with self._cond:
+            scheduled = len(self._heap)
+        return {'scheduled': scheduled, 'events': self.events, 'skipped': self.skipped, 'sent': self.sent,
+                'failed': self.failed, 'unsubscribed': self.unsubscribed}
+
+reminder_scheduler = ReminderScheduler(reminders_repo, REMINDER_HOURS)
+metrics.collect_stats('reminders', reminder_scheduler.stats,
+                      counters=('events', 'skipped', 'sent', 'failed', 'unsubscribed'))
+
+# === СОСТОЯНИЕ ДИАЛОГОВ ===
+class MemoryStateStore:
+    """Состояние диалогов в памяти процесса: с TTL и ограничением на число пользователей."""
+
+    def __init__(self, ttl=STATE_TTL, max_items=10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()  # user_id -> (expires_at, json)
+        self._lock = threading.Lock()
+
+    def _load(self, user_id, now):
+        item = self._items.get(user_id)
+        if item is None:
+            return None
+        if item[0] <= now:
+            del self._items[user_id]
+            return None
+        return json.loads(item[1])
+
+    def _store(self, user_id, data, now):
+        self._items[user_id] = (now + self.ttl, json.dumps(data, ensure_ascii=False))
+        self._items.move_to_end(user_id)
+        # Вытесняем тех, кто дольше всех не трогал свой диалог
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            data = self._load(user_id, time.time())
+        return default if data is None else data
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def set(self, user_id, data):
+        with self._lock:
+            self._store(user_id, data, time.time())
+
+    def update(self, user_id, func):
+        # Атомарно: func меняет данные на месте; вернёт None, если диалога уже нет
+        with self._lock:
+            now = time.time()
+            data = self._load(user_id, now)
+            if data is None:
+                return None
+            func(data)
+            self._store(user_id, data, now)
+            return data
+
+    def pop(self, user_id, default=None):
+        with self._lock:
+            data = self._load(user_id, time.time())
+            self._items.pop(user_id, None)
+        return default if data is None else data
+
+    def delete(self, user_id):
+        with self._lock:
+            self._items.pop(user_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+class SqliteStateStore:
+    """Состояние диалогов в state.db: переживает перезапуск и общее для нескольких процессов."""
+
+    TRIM_EVERY = 64
+
+    def __init__(self, db, namespace, ttl=STATE_TTL, max_items=10000):
+        self.db = db
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_items = max_items
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _load(self, c, user_id, now):
+        c.execute('SELECT data FROM dialog_state WHERE namespace = ? AND user_id = ? AND expires_at > ?',
+                  (self.namespace, user_id, now))
+        row = c.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store(self, c, user_id, data, now):
+        c.execute('''
+            INSERT INTO dialog_state (namespace, user_id, data, updated_at, expires_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(namespace, user_id) DO UPDATE SET
+                data = excluded.data, updated_at = excluded.updated_at, expires_at = excluded.expires_at
+        ''', (self.namespace, user_id, json.dumps(data, ensure_ascii=False), now, now + self.ttl))
+
+    def _written(self):
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.TRIM_EVERY == 0
+        if due:
+            self.trim()
+
+    def trim(self):
+        # Удаляет просроченные диалоги и самые старые сверх лимита
+        with self.db.transaction() as c:
+            c.execute('DELETE FROM dialog_state WHERE expires_at <= ?', (time.time(),))
+            c.execute('''
+                DELETE FROM dialog_state WHERE namespace = ? AND user_id IN (
+                    SELECT user_id FROM dialog_state WHERE namespace = ?
+                    ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.namespace, self.namespace, self.max_items))
+
+    def get(self, user_id, default=None):
+        data = self._load(self.db.connection().cursor(), user_id, time.time())
+        return default if data is None else data
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def set(self, user_id, data):
+        with self.db.transaction() as c:
+            self._store(c, user_id, data, time.time())
+        self._written()
+
+    def update(self, user_id, func):
+        with self.db.transaction(immediate=True) as c:
+            now = time.time()
+            data = self._load(c, user_id, now)
+            if data is None:
+                return None
+            func(data)
+            self._store(c, user_id, data, now)
+        self._written()
+        return data
+
+    def pop(self, user_id, default=None):
+        with self.db.transaction(immediate=True) as c:
+            data = self._load(c, user_id, time.time())
+            c.execute('DELETE FROM dialog_state WHERE namespace = ? AND user_id = ?', (self.namespace, user_id))
+        return default if data is None else data
+
+    def delete(self, user_id):
+        with self.db.transaction() as c:
+            c.execute('DELETE FROM dialog_state WHERE namespace = ? AND user_id = ?', (self.namespace, user_id))
+
+    def __len__(self):
+        c = self.db.connection().cursor()
+        c.execute('SELECT COUNT(*) FROM dialog_state WHERE namespace = ? AND expires_at > ?',
+                  (self.namespace, time.time()))
+        return c.fetchone()[0]
+
+    @staticmethod
+    def get_many(stores, user_id):
+        # Состояние пользователя сразу в нескольких диалогах одной БД — одним запросом
+        placeholders = ', '.join('?' * len(stores))
+        c = stores[0].db.connection().cursor()
+        c.execute(f'SELECT namespace, data FROM dialog_state WHERE namespace IN ({placeholders}) AND user_id = ? AND expires_at > ?',
+                  [store.namespace for store in stores] + [user_id, time.time()])
+        found = {namespace: json.loads(data) for namespace, data in c.fetchall()}
+        return [found.get(store.namespace) for store in stores]
+
+
+def make_state_store(namespace):
+    if STATE_BACKEND == 'memory':
+        store = MemoryStateStore()
+    else:
+        store = SqliteStateStore(state_db, namespace)
+    metrics.collect(lambda: [('dialog_states', 'gauge', {'dialog': namespace}, len(store))])
+    return store
 
 # === Проверка админа ===
 def is_notes_admin(user_id):
@@ -160,136 +1227,285 @@ def start(message):
         text += "Вы — админ. Можете добавлять и редактировать записи."
     else:
         text += "Просматривайте записи через кнопки ниже."
+    text += "\n\nНапоминания о сроках сдачи ДЗ: /remind_on"
     bot.send_message(message.chat.id, text, reply_markup=main_menu(user_id))
 
 # === Обработка кнопок ===
+class CallbackRouter:
+    """Маршрутизация callback_data вида 'имя_маршрута_число_число' одним поиском в словаре."""
+
+    def __init__(self):
+        self._routes = {}
+
+    def route(self, name, *arg_types, access=None):
+        # access: None — доступно всем, 'notes' / 'hw' — только соответствующим админам
+        def decorator(func):
+            self._routes[name] = (func, arg_types, access)
+            return func
+        return decorator
+
+    def resolve(self, data):
+        # Числовые аргументы идут в конце, имя маршрута — всё, что перед ними
+        parts = data.split('_')
+        split_at = len(parts)
+        while split_at > 1 and parts[split_at - 1].isdigit():
+            split_at -= 1
+        route = self._routes.get('_'.join(parts[:split_at]))
+        if route is None:
+            return None
+        func, arg_types, access = route
+        raw_args = parts[split_at:]
+        if len(raw_args) != len(arg_types):
+            return None
+        return func, [arg_type(raw) for arg_type, raw in zip(arg_types, raw_args)], access
+
+    def dispatch(self, call):
+        resolved = self.resolve(call.data)
+        if resolved is None:
+            return False
+        func, args, access = resolved
+        user_id = call.from_user.id
+        if access == 'notes' and not is_notes_admin(user_id):
+            bot.answer_callback_query(call.id, "Доступ запрещён для заметок.", show_alert=True)
+            return True
+        if access == 'hw' and not is_hw_admin(user_id):
+            bot.answer_callback_query(call.id, "Доступ запрещён для ДЗ.", show_alert=True)
+            return True
+        with metrics.timer('route_seconds', route=func.__name__):
+            func(call, *args)
+        return True
+
+callback_router = CallbackRouter()
+
 @bot.callback_query_handler(func=lambda call: True)
 def callback_handler(call):
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    message_id = call.message.message_id
+    callback_router.dispatch(call)
 
-    if call.data.startswith("notes_list_"):
-        page = int(call.data.split("_", 2)[2])
-        show_notes_titles_list(call.message, user_id, page)
-        return
-    elif call.data.startswith("notes_show_"):
-        note_id = int(call.data.split("_", 2)[2])
-        show_notes_details(call.message, note_id, user_id)
-        return
-    elif call.data.startswith("notes_like_"):
-        note_id = int(call.data.split("_", 2)[2])
-        handle_note_reaction(call, note_id, 1)
-        return
-    elif call.data.startswith("notes_dislike_"):
-        note_id = int(call.data.split("_", 2)[2])
-        handle_note_reaction(call, note_id, -1)
-        return
-    elif call.data.startswith("notes_view_comments_"):
-        note_id = int(call.data.split("_", 3)[3])
-        show_note_comments(call, note_id)
-        return
-    elif call.data.startswith("notes_add_comment_"):
-        note_id = int(call.data.split("_", 3)[3])
-        start_add_comment(call.message, user_id, note_id)
-        return
-    elif call.data.startswith("hw_list_"):
-        page = int(call.data.split("_", 2)[2])
-        show_hw_subjects_list(call.message, user_id, page)
-        return
-    elif call.data.startswith("hw_show_"):
-        hw_id = int(call.data.split("_", 2)[2])
-        show_hw_details(call.message, hw_id, user_id)
-        return
-    elif call.data == "back_to_main":
-        bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                              text="Новости последнего обновления:\nДобавлена поддержка загрузки аудио и видео, а так же изменён вид списка заметок и дз. Good Luck!\n\nГлавное меню:", reply_markup=main_menu(user_id))
-        return
+def creator_identifier_of(user):
+    return user.username if user.username else str(user.id)
 
-    if call.data.startswith("notes_") and not is_notes_admin(user_id):
-        bot.answer_callback_query(call.id, "Доступ запрещён для заметок.", show_alert=True)
-        return
-    if call.data.startswith("hw_") and not is_hw_admin(user_id):
-        bot.answer_callback_query(call.id, "Доступ запрещён для ДЗ.", show_alert=True)
-        return
+@callback_router.route('notes_list', int)
+def _cb_notes_list(call, page):
+    show_notes_titles_list(call.message, call.from_user.id, page)
+
+@callback_router.route('notes_show', int)
+def _cb_notes_show(call, note_id):
+    show_notes_details(call.message, note_id, call.from_user.id)
+
+@callback_router.route('notes_like', int)
+def _cb_notes_like(call, note_id):
+    handle_note_reaction(call, note_id, 1)
+
+@callback_router.route('notes_dislike', int)
+def _cb_notes_dislike(call, note_id):
+    handle_note_reaction(call, note_id, -1)
+
+@callback_router.route('notes_view_comments', int)
+def _cb_notes_view_comments(call, note_id):
+    show_note_comments(call, note_id)
+
+@callback_router.route('notes_comments_next', int, int)
+def _cb_notes_comments_next(call, note_id, after_id):
+    show_note_comments(call, note_id, after_id=after_id)
+
+@callback_router.route('notes_comments_prev', int, int)
+def _cb_notes_comments_prev(call, note_id, before_id):
+    show_note_comments(call, note_id, before_id=before_id)
+
+@callback_router.route('notes_back', int)
+def _cb_notes_back(call, note_id):
+    back_to_note(call, note_id)
+
+@callback_router.route('notes_add_comment', int)
+def _cb_notes_add_comment(call, note_id):
+    start_add_comment(call.message, call.from_user.id, note_id)
 
-    if call.data == "notes_add":
-        creator_identifier = call.from_user.username if call.from_user.username else str(call.from_user.id)
-        notes_start_add_note(call.message, user_id, creator_identifier)
-    elif call.data == "notes_add_more_photos":
-        notes_continue_adding_photos(call, user_id)
-    elif call.data == "notes_add_more_videos":
-        notes_continue_adding_videos(call, user_id)
-    elif call.data == "notes_add_more_audios":
-        notes_continue_adding_audios(call, user_id)
-    elif call.data == "notes_add_more_files":
-        notes_continue_adding_files(call, user_id)
-    elif call.data == "notes_finish_adding":
-        notes_finish_adding_note(call, user_id)
-    elif call.data.startswith("notes_edit_title_"):
-        title_id = call.data.split("_", 3)[3]
-        notes_start_edit_note(call.message, title_id, user_id)
-    elif call.data.startswith("notes_delete_title_"):
-        title_id = call.data.split("_", 3)[3]
-        notes_confirm_delete_by_title_id(call.message, title_id)
-    elif call.data.startswith("notes_confirm_delete_title_"):
-        title_id = call.data.split("_", 4)[4]
-        notes_do_delete_title_by_id(call, title_id)
-    elif call.data == "hw_add":
-        creator_identifier = call.from_user.username if call.from_user.username else str(call.from_user.id)
-        hw_start_add_hw(call.message, user_id, creator_identifier)
-    elif call.data == "hw_add_more_photos":
-        hw_continue_adding_photos(call, user_id)
-    elif call.data == "hw_add_more_videos":
-        hw_continue_adding_videos(call, user_id)
-    elif call.data == "hw_add_more_audios":
-        hw_continue_adding_audios(call, user_id)
-    elif call.data == "hw_add_more_files":
-        hw_continue_adding_files(call, user_id)
-    elif call.data == "hw_finish_adding":
-        hw_finish_adding_hw(call, user_id)
-    elif call.data.startswith("hw_edit_subject_"):
-        subject_id = call.data.split("_", 3)[3]
-        hw_start_edit_hw(call.message, subject_id, user_id)
-    elif call.data.startswith("hw_delete_subject_"):
-        subject_id = call.data.split("_", 3)[3]
-        hw_confirm_delete_by_subject_id(call.message, subject_id)
-    elif call.data.startswith("hw_confirm_delete_subject_"):
-        subject_id = call.data.split("_", 4)[4]
-        hw_do_delete_subject_by_id(call, subject_id)
-    elif call.data == "cancel":
-        if user_id in notes_add_state:
-            del notes_add_state[user_id]
-        if user_id in notes_edit_state:
-            del notes_edit_state[user_id]
-        if user_id in hw_add_state:
-            del hw_add_state[user_id]
-        if user_id in hw_edit_state:
-            del hw_edit_state[user_id]
-        if user_id in comments_add_state:
-            del comments_add_state[user_id]
-        bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                              text="Действие отменено.", reply_markup=None)
-        bot.send_message(chat_id, "Новости последнего обновления:\nДобавлен раздел с заметками! Писать там можно что угодно и когда удобно (эксклюзивно людям из группы МЕХАТРОНИКОВ :). Другим нельзя). Жду мемчики и всякую ересь. Полезной инфы не надо (шутка). Good Luck!\n\nГлавное меню:", reply_markup=main_menu(user_id))
+@callback_router.route('hw_list', int)
+def _cb_hw_list(call, page):
+    show_hw_subjects_list(call.message, call.from_user.id, page)
+
+@callback_router.route('hw_due', int)
+def _cb_hw_due(call, page):
+    show_hw_subjects_list(call.message, call.from_user.id, page, 'due')
+
+@callback_router.route('hw_week', int)
+def _cb_hw_week(call, page):
+    show_hw_subjects_list(call.message, call.from_user.id, page, 'week')
+
+@callback_router.route('hw_overdue', int)
+def _cb_hw_overdue(call, page):
+    show_hw_subjects_list(call.message, call.from_user.id, page, 'overdue')
+
+@callback_router.route('hw_show', int)
+def _cb_hw_show(call, hw_id):
+    show_hw_details(call.message, hw_id, call.from_user.id)
+
+@callback_router.route('search', int)
+def _cb_search(call, page):
+    show_search_results(call.message, call.from_user.id, page, edit=True)
+
+@callback_router.route('back_to_main')
+def _cb_back_to_main(call):
+    edit_coalescer.edit(call.message.chat.id, call.message.message_id,
+                        "Новости последнего обновления:\nДобавлена поддержка загрузки аудио и видео, а так же изменён вид списка заметок и дз. Good Luck!\n\nГлавное меню:",
+                        reply_markup=main_menu(call.from_user.id), parse_mode=None)
+
+@callback_router.route('notes_add', access='notes')
+def _cb_notes_add(call):
+    notes_start_add_note(call.message, call.from_user.id, creator_identifier_of(call.from_user))
+
+@callback_router.route('notes_add_more_photos', access='notes')
+def _cb_notes_add_more_photos(call):
+    notes_continue_adding_photos(call, call.from_user.id)
+
+@callback_router.route('notes_add_more_videos', access='notes')
+def _cb_notes_add_more_videos(call):
+    notes_continue_adding_videos(call, call.from_user.id)
+
+@callback_router.route('notes_add_more_audios', access='notes')
+def _cb_notes_add_more_audios(call):
+    notes_continue_adding_audios(call, call.from_user.id)
+
+@callback_router.route('notes_add_more_files', access='notes')
+def _cb_notes_add_more_files(call):
+    notes_continue_adding_files(call, call.from_user.id)
+
+@callback_router.route('notes_finish_adding', access='notes')
+def _cb_notes_finish_adding(call):
+    notes_finish_adding_note(call, call.from_user.id)
+
+@callback_router.route('notes_edit_title', int, access='notes')
+def _cb_notes_edit_title(call, title_id):
+    notes_start_edit_note(call.message, title_id, call.from_user.id)
+
+@callback_router.route('notes_delete_title', int, access='notes')
+def _cb_notes_delete_title(call, title_id):
+    notes_confirm_delete_by_title_id(call.message, title_id)
+
+@callback_router.route('notes_confirm_delete_title', int, access='notes')
+def _cb_notes_confirm_delete_title(call, title_id):
+    notes_do_delete_title_by_id(call, title_id)
+
+@callback_router.route('hw_add', access='hw')
+def _cb_hw_add(call):
+    hw_start_add_hw(call.message, call.from_user.id, creator_identifier_of(call.from_user))
+
+@callback_router.route('hw_add_more_photos', access='hw')
+def _cb_hw_add_more_photos(call):
+    hw_continue_adding_photos(call, call.from_user.id)
+
+@callback_router.route('hw_add_more_videos', access='hw')
+def _cb_hw_add_more_videos(call):
+    hw_continue_adding_videos(call, call.from_user.id)
+
+@callback_router.route('hw_add_more_audios', access='hw')
+def _cb_hw_add_more_audios(call):
+    hw_continue_adding_audios(call, call.from_user.id)
+
+@callback_router.route('hw_add_more_files', access='hw')
+def _cb_hw_add_more_files(call):
+    hw_continue_adding_files(call, call.from_user.id)
+
+@callback_router.route('hw_finish_adding', access='hw')
+def _cb_hw_finish_adding(call):
+    hw_finish_adding_hw(call, call.from_user.id)
+
+@callback_router.route('hw_edit_subject', int, access='hw')
+def _cb_hw_edit_subject(call, subject_id):
+    hw_start_edit_hw(call.message, subject_id, call.from_user.id)
+
+@callback_router.route('hw_delete_subject', int, access='hw')
+def _cb_hw_delete_subject(call, subject_id):
+    hw_confirm_delete_by_subject_id(call.message, subject_id)
+
+@callback_router.route('hw_confirm_delete_subject', int, access='hw')
+def _cb_hw_confirm_delete_subject(call, subject_id):
+    hw_do_delete_subject_by_id(call, subject_id)
+
+@callback_router.route('cancel')
+def _cb_cancel(call):
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    for state in (notes_add_state, notes_edit_state, hw_add_state, hw_edit_state, comments_add_state, import_state):
+        state.delete(user_id)
+    edit_coalescer.edit(chat_id, call.message.message_id, "Действие отменено.", parse_mode=None)
+    bot.send_message(chat_id, "Новости последнего обновления:\nДобавлен раздел с заметками! Писать там можно что угодно и когда удобно (эксклюзивно людям из группы МЕХАТРОНИКОВ :). Другим нельзя). Жду мемчики и всякую ересь. Полезной инфы не надо (шутка). Good Luck!\n\nГлавное меню:", reply_markup=main_menu(user_id))
+
+# === Обработка сообщений в диалогах ===
+class MessageRouter:
+    """Находит обработчик шага диалога по (диалог, шаг, тип сообщения) вместо перебора предикатов."""
+
+    def __init__(self):
+        self._routes = {}
+        self._stores = []       # в порядке регистрации: он же порядок приоритета
+        self._by_type = {}      # тип сообщения -> диалоги, у которых есть шаги для него
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.lookups = 0
+
+    def route(self, store, step, content_type='text'):
+        # step=None — шаг не важен, достаточно, что пользователь находится в диалоге
+        def decorator(func):
+            self._routes[(store, step, content_type)] = func
+            if store not in self._stores:
+                self._stores.append(store)
+            stores = self._by_type.setdefault(content_type, [])
+            if store not in stores:
+                stores.append(store)
+                stores.sort(key=self._stores.index)
+            return func
+        return decorator
+
+    def content_types(self):
+        return list(self._by_type)
+
+    def _load_states(self, stores, user_id):
+        if stores and all(isinstance(store, SqliteStateStore) and store.db is stores[0].db for store in stores):
+            return SqliteStateStore.get_many(stores, user_id), 1
+        return [store.get(user_id) for store in stores], len(stores)
+
+    def resolve(self, message):
+        stores = self._by_type.get(message.content_type, [])
+        states, lookups = self._load_states(stores, message.from_user.id)
+        func = None
+        for store, state in zip(stores, states):
+            if state is None:
+                continue
+            func = self._routes.get((store, state.get('step'), message.content_type))
+            if func is None:
+                func = self._routes.get((store, None, message.content_type))
+            if func is not None:
+                break
+        with self._lock:
+            self.messages += 1
+            self.lookups += lookups
+        return func
+
+    def stats(self):
+        with self._lock:
+            return {'messages': self.messages, 'lookups': self.lookups,
+                    'lookups_per_message': self.lookups / self.messages if self.messages else 0}
+
+message_router = MessageRouter()
+metrics.collect_stats('dialog_router', message_router.stats, counters=('messages', 'lookups'))
+
+def _match_dialog_step(message):
+    # Найденный обработчик запоминается в сообщении, чтобы не искать его второй раз
+    message.dialog_handler = message_router.resolve(message)
+    return message.dialog_handler is not None
 
 # === ЗАМЕТКИ ===
 
-notes_add_state = {}
-notes_edit_state = {}
-comments_add_state = {}
+notes_add_state = make_state_store('notes_add')
+notes_edit_state = make_state_store('notes_edit')
+comments_add_state = make_state_store('comments_add')
 
 def show_notes_titles_list(message, user_id=None, page=1):
     if user_id is None:
         user_id = message.from_user.id if hasattr(message, 'from_user') else message.chat.id
 
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('SELECT title, MIN(id) as min_id, photo_file_ids, video_file_ids, audio_file_ids, file_file_ids FROM notes GROUP BY title ORDER BY min_id')
-    rows = c.fetchall()
-    conn.close()
-
     ITEMS_PER_PAGE = 5
-    total_items = len(rows)
+    total_items = notes_repo.count_titles()
     total_pages = (total_items + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
 
     if page < 1:
@@ -297,27 +1513,22 @@ def show_notes_titles_list(message, user_id=None, page=1):
     if page > total_pages:
         page = total_pages
 
-    start_idx = (page - 1) * ITEMS_PER_PAGE
-    end_idx = start_idx + ITEMS_PER_PAGE
-    page_rows = rows[start_idx:end_idx]
+    # Из БД читается только текущая страница
+    page_rows = notes_repo.list_titles_page(max(page - 1, 0) * ITEMS_PER_PAGE, ITEMS_PER_PAGE)
 
     markup = types.InlineKeyboardMarkup(row_width=1)
 
-    if not rows:
+    if not total_items:
         text = "Нет заметок."
     else:
         text = f"<b>Выберите заметку (страница {page}/{total_pages}):</b>"
 
-    for title, min_id, photo_json, video_json, audio_json, file_json in page_rows:
-        photos = json.loads(photo_json) if photo_json else []
-        videos = json.loads(video_json) if video_json else []
-        audios = json.loads(audio_json) if audio_json else []
-        files = json.loads(file_json) if file_json else []
+    for title, min_id, photo_count, video_count, audio_count, file_count in page_rows:
         label = title
-        if photos: label += f" (фото: {len(photos)})"
-        if videos: label += f" (видео: {len(videos)})"
-        if audios: label += f" (аудио: {len(audios)})"
-        if files: label += f" (файлы: {len(files)})"
+        if photo_count: label += f" (фото: {photo_count})"
+        if video_count: label += f" (видео: {video_count})"
+        if audio_count: label += f" (аудио: {audio_count})"
+        if file_count: label += f" (файлы: {file_count})"
         btn = types.InlineKeyboardButton(label, callback_data=f"notes_show_{min_id}")
         markup.add(btn)
 
@@ -340,48 +1551,11 @@ def show_notes_titles_list(message, user_id=None, page=1):
     markup.add(btn_back)
 
     if hasattr(message, 'message_id'):
-        bot.edit_message_text(chat_id=message.chat.id, message_id=message.message_id,
-                              text=text, parse_mode='HTML', reply_markup=markup)
+        edit_coalescer.edit(message.chat.id, message.message_id, text, reply_markup=markup)
     else:
         bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=markup)
 
-def get_note_details(note_id, user_id):
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('SELECT id, title, content, photo_file_ids, video_file_ids, audio_file_ids, file_file_ids, created_at, creator_username, views FROM notes WHERE id = ?', (note_id,))
-    row = c.fetchone()
-
-    if not row:
-        return None, None, None, None, None, None, None, None, None, None, None, None, None
-
-    title_id = row[0]
-    title = row[1]
-    content = row[2]
-    photo_json = row[3]
-    video_json = row[4]
-    audio_json = row[5]
-    file_json = row[6]
-    created_at = row[7]
-    creator_identifier = row[8]
-    views = row[9]
-
-    all_photos = json.loads(photo_json) if photo_json else []
-    all_videos = json.loads(video_json) if video_json else []
-    all_audios = json.loads(audio_json) if audio_json else []
-    all_files = json.loads(file_json) if file_json else []
-
-    c.execute('SELECT COUNT(*) FROM reactions WHERE note_id = ? AND reaction = 1', (note_id,))
-    likes = c.fetchone()[0]
-    c.execute('SELECT COUNT(*) FROM reactions WHERE note_id = ? AND reaction = -1', (note_id,))
-    dislikes = c.fetchone()[0]
-    c.execute('SELECT COUNT(*) FROM comments WHERE note_id = ?', (note_id,))
-    comments_count = c.fetchone()[0]
-
-    conn.close()
-
-    return title_id, title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier, views, likes, dislikes, comments_count
-
-def build_note_text(title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier, views, likes, dislikes, comments_count):
+def build_note_header(title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier):
     text = f"<b>Заметка: {html.escape(title)}</b>\n\n"
     photo_mark = f" (фото: {len(all_photos)})" if all_photos else ""
     video_mark = f" (видео: {len(all_videos)})" if all_videos else ""
@@ -394,10 +1568,12 @@ def build_note_text(title, content, all_photos, all_videos, all_audios, all_file
     else:
         creator_display = f"@{html.escape(creator_identifier)}"
     text += f"Создатель: {creator_display} | Дата создания: {html.escape(created_at)}\n"
-    text += f"Просмотры: {views} | Лайки: {likes} | Дизлайки: {dislikes} | Комментарии: {comments_count}\n"
 
     return text
 
+def build_note_stats(views, likes, dislikes, comments_count):
+    return f"Просмотры: {views} | Лайки: {likes} | Дизлайки: {dislikes} | Комментарии: {comments_count}\n"
+
 def build_note_markup(note_id, user_id, likes, dislikes, comments_count):
     markup = types.InlineKeyboardMarkup(row_width=2)
     btn_like = types.InlineKeyboardButton(f"👍 {likes}", callback_data=f"notes_like_{note_id}")
@@ -420,82 +1596,141 @@ def build_note_markup(note_id, user_id, likes, dislikes, comments_count):
 
     return markup
 
-def show_notes_details(message, note_id, user_id):
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('UPDATE notes SET views = views + 1 WHERE id = ?', (note_id,))
-    conn.commit()
-    conn.close()
+def get_note_view(note_id, user_id):
+    # Карточка заметки из кэша; при промахе собирается из БД
+    key = ('note', note_id, is_notes_admin(user_id))
+    view = render_cache.get(key)
+    if view is None:
+        generation = render_cache.generation
+        details = notes_repo.get_details(note_id)
+        if not details:
+            return None
+        _, title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier, views, likes, dislikes, comments_count = details
+        view = {
+            'title': title,
+            'photos': all_photos,
+            'videos': all_videos,
+            'audios': all_audios,
+            'files': all_files,
+            'header': build_note_header(title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier),
+            'views': views,
+            'likes': likes,
+            'dislikes': dislikes,
+            'comments_count': comments_count,
+            'markup': build_note_markup(note_id, user_id, likes, dislikes, comments_count),
+        }
+        render_cache.set(key, view, generation)
+    return view
+
+def note_view_text(note_id, view):
+    # Просмотры подставляются при каждом показе, с учётом ещё не записанных в БД
+    views = view['views'] + view_counter.pending(note_id)
+    return view['header'] + build_note_stats(views, view['likes'], view['dislikes'], view['comments_count'])
 
-    title_id, title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier, views, likes, dislikes, comments_count = get_note_details(note_id, user_id)
+def show_notes_details(message, note_id, user_id):
+    view = get_note_view(note_id, user_id)
 
-    if not title:
+    if not view:
         bot.send_message(message.chat.id, "Заметка не найдена.", parse_mode='HTML')
         return
 
-    text = build_note_text(title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier, views, likes, dislikes, comments_count)
-    markup = build_note_markup(note_id, user_id, likes, dislikes, comments_count)
-
-    bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=markup)
-
-    if all_photos:
-        media = [types.InputMediaPhoto(all_photos[0], caption=f"<b>{html.escape(title)}</b>", parse_mode='HTML')]
-        media += [types.InputMediaPhoto(p) for p in all_photos[1:]]
-        try:
-            bot.send_media_group(message.chat.id, media)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Ошибка отправки фото: {e}")
-
-    for video_id in all_videos:
-        try:
-            bot.send_video(message.chat.id, video_id)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Не удалось отправить видео: {e}")
-
-    for audio_id in all_audios:
-        try:
-            bot.send_audio(message.chat.id, audio_id)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Не удалось отправить аудио: {e}")
-
-    for file_id in all_files:
-        try:
-            bot.send_document(message.chat.id, file_id)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Не удалось отправить файл: {e}")
-
-def show_note_comments(call, note_id):
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('SELECT title FROM notes WHERE id = ?', (note_id,))
-    title_row = c.fetchone()
-    title = title_row[0] if title_row else "Неизвестно"
-    c.execute('SELECT user_identifier, content, created_at FROM comments WHERE note_id = ? ORDER BY id', (note_id,))
-    comments = c.fetchall()
-    conn.close()
-
-    text = f"<b>Комментарии к заметке: {html.escape(title)}</b>\n\n"
-    if not comments:
-        text += "Нет комментариев."
-    else:
-        for i, (user, cont, date) in enumerate(comments, 1):
-            user_disp = f"@{html.escape(user)}" if not user.isdigit() else f"ID {html.escape(user)}"
-            text += f"{i}. {user_disp}: {html.escape(cont)} ({html.escape(date)})\n\n"
+    view_counter.increment(note_id)
+    title = view['title']
+    all_photos = view['photos']
+    all_videos = view['videos']
+    all_audios = view['audios']
+    all_files = view['files']
+
+    bot.send_message(message.chat.id, note_view_text(note_id, view), parse_mode='HTML', reply_markup=view['markup'])
+
+    media_delivery.deliver(message.chat.id, all_photos, all_videos, all_audios, all_files,
+                           caption=f"<b>{html.escape(title)}</b>")
+
+COMMENTS_PAGE_CHARS = 3800  # с запасом до лимита Telegram в 4096 символов
+COMMENTS_FETCH = 50
+COMMENT_NUMBER_RESERVE = 8  # под «123456. »: номер известен только после упаковки страницы
+
+def text_length(text):
+    # Длина так, как её считает Telegram: в UTF-16, по тексту уже без HTML-разметки
+    return len(text.encode('utf-16-le')) // 2
+
+def render_comment(user, content, date, room):
+    # Возвращает HTML комментария и его видимую длину; не влезающий в room текст обрезается
+    user_disp = f"@{user}" if not user.isdigit() else f"ID {user}"
+    prefix = f"{user_disp}: "
+    suffix = f" ({date})\n\n"
+    length = room - text_length(prefix + suffix)
+    if text_length(content) > length:
+        cut = max(0, length - 1)
+        while cut and text_length(content[:cut]) > length - 1:
+            cut -= 1
+        content = content[:cut] + "…"
+    return html.escape(prefix + content + suffix), text_length(prefix + content + suffix)
+
+def pack_comments(rows, room):
+    # Комментарии идут по порядку, пока страница не заполнится; первый попадает всегда, хотя бы обрезанным
+    page = []
+    for comment_id, user, content, date in rows:
+        entry, length = render_comment(user, content, date, room - COMMENT_NUMBER_RESERVE)
+        if page and length + COMMENT_NUMBER_RESERVE > room:
+            break
+        page.append((comment_id, entry))
+        room -= length + COMMENT_NUMBER_RESERVE
+    return page
+
+def show_note_comments(call, note_id, after_id=None, before_id=None):
+    # Страница комментариев выводится на месте того же сообщения
+    title = notes_repo.get_title(note_id)
+    if title is None:
+        bot.answer_callback_query(call.id, "Заметка не найдена.")
+        return
+    header = f"<b>Комментарии к заметке: {html.escape(title)}</b>\n"
+    room = COMMENTS_PAGE_CHARS - text_length(f"Комментарии к заметке: {title}\n")
+    rows = comments_repo.list_page(note_id, after_id, before_id, COMMENTS_FETCH)
+    if before_id is not None and not rows:
+        rows = comments_repo.list_page(note_id, limit=COMMENTS_FETCH)
+        before_id = None
+    page = pack_comments(rows, room)
+    if before_id is not None:
+        page.reverse()
 
     markup = types.InlineKeyboardMarkup()
-    btn_back = types.InlineKeyboardButton("Назад к заметке", callback_data=f"notes_show_{note_id}")
-    markup.add(btn_back)
+    if not page:
+        text = header + "\nНет комментариев."
+    else:
+        before, has_after, total = comments_repo.page_bounds(note_id, page[0][0], page[-1][0])
+        text = header + f"{before + 1}–{before + len(page)} из {max(total, before + len(page))}\n\n"
+        text += ''.join(f"{before + i}. {entry}" for i, (_, entry) in enumerate(page, 1))
+        nav = []
+        if before:
+            nav.append(types.InlineKeyboardButton("« Назад", callback_data=f"notes_comments_prev_{note_id}_{page[0][0]}"))
+        if has_after:
+            nav.append(types.InlineKeyboardButton("Вперёд »", callback_data=f"notes_comments_next_{note_id}_{page[-1][0]}"))
+        if nav:
+            markup.row(*nav)
+    markup.add(types.InlineKeyboardButton("Назад к заметке", callback_data=f"notes_back_{note_id}"))
+
+    edit_coalescer.edit(call.message.chat.id, call.message.message_id, text, reply_markup=markup)
+    bot.answer_callback_query(call.id)
 
-    bot.send_message(call.message.chat.id, text, parse_mode='HTML', reply_markup=markup)
+def back_to_note(call, note_id):
+    # Карточка возвращается в то же сообщение: вложения уже отправлены, просмотр не засчитывается
+    view = get_note_view(note_id, call.from_user.id)
+    if not view:
+        bot.answer_callback_query(call.id, "Заметка не найдена.")
+        return
+    edit_coalescer.edit(call.message.chat.id, call.message.message_id, note_view_text(note_id, view),
+                        reply_markup=view['markup'])
+    bot.answer_callback_query(call.id)
 
 def start_add_comment(message, user_id, note_id):
-    comments_add_state[user_id] = {'note_id': note_id}
+    comments_add_state.set(user_id, {'note_id': note_id})
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
     markup.add(btn_cancel)
     bot.send_message(message.chat.id, "Введите ваш комментарий:", parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: m.from_user.id in comments_add_state)
+@message_router.route(comments_add_state, None)
 def add_comment(message):
     user_id = message.from_user.id
     data = comments_add_state.get(user_id)
@@ -510,73 +1745,57 @@ def add_comment(message):
     local_tz = timezone(timedelta(hours=3))
     created_at = datetime.now(tz=local_tz).strftime('%Y-%m-%d %H:%M')
 
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO comments (note_id, user_identifier, content, created_at) VALUES (?, ?, ?, ?)', (note_id, identifier, content, created_at))
-    conn.commit()
-    conn.close()
+    comments_repo.add(note_id, identifier, content, created_at)
+    render_cache.invalidate('note', note_id)
 
     bot.reply_to(message, "Комментарий добавлен!")
-    del comments_add_state[user_id]
+    comments_add_state.delete(user_id)
 
 def handle_note_reaction(call, note_id, target_reaction):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
     message_id = call.message.message_id
 
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('SELECT reaction FROM reactions WHERE note_id = ? AND user_id = ?', (note_id, user_id))
-    row = c.fetchone()
-    current_reaction = row[0] if row else None
-
-    if current_reaction == target_reaction:
-        # Удалить реакцию
-        c.execute('DELETE FROM reactions WHERE note_id = ? AND user_id = ?', (note_id, user_id))
-    else:
-        if current_reaction is not None:
-            # Обновить реакцию
-            c.execute('UPDATE reactions SET reaction = ? WHERE note_id = ? AND user_id = ?', (target_reaction, note_id, user_id))
-        else:
-            # Добавить новую реакцию
-            c.execute('INSERT INTO reactions (note_id, user_id, reaction) VALUES (?, ?, ?)', (note_id, user_id, target_reaction))
-
-    conn.commit()
-    conn.close()
-
-    # Перезагрузить детали
-    title_id, title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier, views, likes, dislikes, comments_count = get_note_details(note_id, user_id)
+    generation = render_cache.generation
+    counts = reactions_repo.toggle(note_id, user_id, target_reaction)
+    view = get_note_view(note_id, user_id) if counts else None
+    if not view:
+        bot.answer_callback_query(call.id, "Заметка не найдена.")
+        return
 
-    text = build_note_text(title, content, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier, views, likes, dislikes, comments_count)
-    markup = build_note_markup(note_id, user_id, likes, dislikes, comments_count)
+    # Карточка не перечитывается из БД: меняются только счётчики и кнопки
+    likes, dislikes, comments_count = counts
+    view = dict(view, likes=likes, dislikes=dislikes, comments_count=comments_count,
+                markup=build_note_markup(note_id, user_id, likes, dislikes, comments_count))
+    render_cache.replace(('note', note_id, is_notes_admin(user_id)), view, generation)
 
-    bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode='HTML', reply_markup=markup)
+    edit_coalescer.edit(chat_id, message_id, note_view_text(note_id, view), reply_markup=view['markup'])
     bot.answer_callback_query(call.id)
 
 def notes_start_add_note(message, user_id, creator_identifier):
-    notes_add_state[user_id] = {'step': 'title', 'photos': [], 'videos': [], 'audios': [], 'files': [], 'creator_identifier': creator_identifier}
+    notes_add_state.set(user_id, {'step': 'title', 'photos': [], 'videos': [], 'audios': [], 'files': [], 'creator_identifier': creator_identifier})
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
     markup.add(btn_cancel)
     bot.send_message(message.chat.id, "Введите <b>заголовок</b> заметки:", parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: notes_add_state.get(m.from_user.id, {}).get('step') == 'title')
+@message_router.route(notes_add_state, 'title')
 def notes_get_title(message):
     user_id = message.from_user.id
     if not is_notes_admin(user_id): return
-    notes_add_state[user_id]['title'] = message.text.strip()
-    notes_add_state[user_id]['step'] = 'content'
+    title = message.text.strip()
+    if notes_add_state.update(user_id, lambda d: d.update(title=title, step='content')) is None: return
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
     markup.add(btn_cancel)
     bot.send_message(message.chat.id, "Введите <b>содержание</b> заметки:", parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: notes_add_state.get(m.from_user.id, {}).get('step') == 'content', content_types=['text'])
+@message_router.route(notes_add_state, 'content')
 def notes_get_content(message):
     user_id = message.from_user.id
     if not is_notes_admin(user_id): return
-    notes_add_state[user_id]['content'] = message.text
-    notes_add_state[user_id]['step'] = 'attachments'
+    content = message.text
+    if notes_add_state.update(user_id, lambda d: d.update(content=content, step='attachments')) is None: return
 
     markup = types.InlineKeyboardMarkup(row_width=2)
     btn_photo = types.InlineKeyboardButton("Фото", callback_data="notes_add_more_photos")
@@ -593,7 +1812,7 @@ def notes_get_content(message):
     sent = bot.send_message(message.chat.id,
                             "Добавьте <b>фото</b>, <b>видео</b>, <b>аудио</b> или <b>файлы</b> (PDF, DOC, ZIP и др.)\n"
                             "или нажмите <b>Готово</b>", parse_mode='HTML', reply_markup=markup)
-    notes_add_state[user_id]['last_msg_id'] = sent.message_id
+    notes_add_state.update(user_id, lambda d: d.update(last_msg_id=sent.message_id))
 
 def notes_continue_adding_photos(call, user_id):
     if notes_add_state.get(user_id, {}).get('step') != 'attachments': return
@@ -611,44 +1830,50 @@ def notes_continue_adding_files(call, user_id):
     if notes_add_state.get(user_id, {}).get('step') != 'attachments': return
     bot.answer_callback_query(call.id, "Отправьте файлы...")
 
-@bot.message_handler(func=lambda m: notes_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['photo'])
+@message_router.route(notes_add_state, 'attachments', 'photo')
 def notes_get_photos(message):
     user_id = message.from_user.id
     if not is_notes_admin(user_id): return
     file_id = message.photo[-1].file_id
-    notes_add_state[user_id]['photos'].append(file_id)
-    count = len(notes_add_state[user_id]['photos'])
+    data = notes_add_state.update(user_id, lambda d: d['photos'].append(file_id))
+    if data is None: return
+    count = len(data['photos'])
     bot.reply_to(message, f"Добавлено фото: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
-@bot.message_handler(func=lambda m: notes_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['video'])
+@message_router.route(notes_add_state, 'attachments', 'video')
 def notes_get_videos(message):
     user_id = message.from_user.id
     if not is_notes_admin(user_id): return
     file_id = message.video.file_id
-    notes_add_state[user_id]['videos'].append(file_id)
-    count = len(notes_add_state[user_id]['videos'])
+    data = notes_add_state.update(user_id, lambda d: d['videos'].append(file_id))
+    if data is None: return
+    count = len(data['videos'])
     bot.reply_to(message, f"Добавлено видео: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
-@bot.message_handler(func=lambda m: notes_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['audio'])
+@message_router.route(notes_add_state, 'attachments', 'audio')
 def notes_get_audios(message):
     user_id = message.from_user.id
     if not is_notes_admin(user_id): return
     file_id = message.audio.file_id
-    notes_add_state[user_id]['audios'].append(file_id)
-    count = len(notes_add_state[user_id]['audios'])
+    data = notes_add_state.update(user_id, lambda d: d['audios'].append(file_id))
+    if data is None: return
+    count = len(data['audios'])
     bot.reply_to(message, f"Добавлено аудио: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
-@bot.message_handler(func=lambda m: notes_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['document'])
+@message_router.route(notes_add_state, 'attachments', 'document')
 def notes_get_files(message):
     user_id = message.from_user.id
     if not is_notes_admin(user_id): return
     file_id = message.document.file_id
-    notes_add_state[user_id]['files'].append(file_id)
-    count = len(notes_add_state[user_id]['files'])
+    data = notes_add_state.update(user_id, lambda d: d['files'].append(file_id))
+    if data is None: return
+    count = len(data['files'])
     bot.reply_to(message, f"Добавлен файл: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
 def notes_finish_adding_note(call, user_id):
-    data = notes_add_state[user_id]
+    # Забираем состояние сразу, чтобы повторное нажатие «Готово» не сохранило запись дважды
+    data = notes_add_state.pop(user_id)
+    if data is None: return
     title = data['title']
     content = data['content']
     photos = data['photos']
@@ -656,88 +1881,36 @@ def notes_finish_adding_note(call, user_id):
     audios = data['audios']
     files = data['files']
     creator_identifier = data['creator_identifier']
-    photo_json = json.dumps(photos) if photos else None
-    video_json = json.dumps(videos) if videos else None
-    audio_json = json.dumps(audios) if audios else None
-    file_json = json.dumps(files) if files else None
     local_tz = timezone(timedelta(hours=3))
     created_at = datetime.now(tz=local_tz).strftime('%Y-%m-%d %H:%M')
 
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-
-    # УДАЛЯЕМ СТАРУЮ ЗАМЕТКУ
-    c.execute('DELETE FROM notes WHERE title = ?', (title,))
-    deleted = c.rowcount
+    # Старая заметка с тем же заголовком заменяется новой
+    deleted = notes_repo.replace(title, content, photos, videos, audios, files, created_at, creator_identifier)
+    for note_id in deleted:
+        render_cache.invalidate('note', note_id)
 
-    # ДОБАВЛЯЕМ НОВУЮ
-    c.execute('''
-        INSERT INTO notes (title, content, photo_file_ids, video_file_ids, audio_file_ids, file_file_ids, created_at, creator_username)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (title, content, photo_json, video_json, audio_json, file_json, created_at, creator_identifier))
-    conn.commit()
-    conn.close()
-
-    action = "обновлена" if deleted > 0 else "добавлена"
+    action = "обновлена" if deleted else "добавлена"
     response = f"<b>Заметка <code>{html.escape(title)}</code> {action}!</b>\n\n<b>{html.escape(content)}</b>"
     markup = types.InlineKeyboardMarkup()
     btn_back = types.InlineKeyboardButton("Назад к списку", callback_data="notes_list_1")
     markup.add(btn_back)
 
-    sent_text = False
-
-    if photos:
-        media = [types.InputMediaPhoto(photos[0], caption=response, parse_mode='HTML')]
-        media += [types.InputMediaPhoto(p) for p in photos[1:]]
-        try:
-            bot.send_media_group(call.message.chat.id, media)
-            sent_text = True
-        except Exception as e:
-            bot.send_message(call.message.chat.id, f"Ошибка при отправке фото: {e}")
-
-    for video_id in videos:
-        try:
-            bot.send_video(call.message.chat.id, video_id)
-        except Exception as e:
-            bot.send_message(call.message.chat.id, f"Ошибка при отправке видео: {e}")
-
-    for audio_id in audios:
-        try:
-            bot.send_audio(call.message.chat.id, audio_id)
-        except Exception as e:
-            bot.send_message(call.message.chat.id, f"Ошибка при отправке аудио: {e}")
-
-    if files:
-        for file_id in files:
-            try:
-                bot.send_document(call.message.chat.id, file_id)
-            except Exception as e:
-                bot.send_message(call.message.chat.id, f"Ошибка при отправке файла: {e}")
-
-    if not sent_text:
-        bot.send_message(call.message.chat.id, response, parse_mode='HTML', reply_markup=markup)
-    else:
-        bot.send_message(call.message.chat.id, "Готово!", reply_markup=markup)
-
-    del notes_add_state[user_id]
+    media_delivery.deliver(call.message.chat.id, photos, videos, audios, files, caption=response,
+                           on_done=functools.partial(send_saved_reply, call.message.chat.id, response, markup))
 
 def notes_start_edit_note(message, title_id, user_id):
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('SELECT title, content FROM notes WHERE id = ?', (title_id,))
-    row = c.fetchone()
-    conn.close()
+    row = notes_repo.get_title_and_content(title_id)
 
     if not row:
         bot.send_message(message.chat.id, "Заметка не найдена.")
         return
 
     title, content = row
-    notes_edit_state[user_id] = {
+    notes_edit_state.set(user_id, {
         'title': title,
         'step': 'edit_content',
         'old_content': content
-    }
+    })
 
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
@@ -746,35 +1919,27 @@ def notes_start_edit_note(message, title_id, user_id):
                      f"Редактируем: <b>{html.escape(title)}</b>\nТекущее содержание:\n<code>{html.escape(content)}</code>\n\nВведите новое:",
                      parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: notes_edit_state.get(m.from_user.id, {}).get('step') == 'edit_content')
+@message_router.route(notes_edit_state, 'edit_content')
 def notes_edit_content(message):
     user_id = message.from_user.id
     if not is_notes_admin(user_id): return
-    data = notes_edit_state[user_id]
+    data = notes_edit_state.pop(user_id)
+    if data is None: return
     content = message.text
 
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('UPDATE notes SET content = ? WHERE title = ?', (content, data['title']))
-    conn.commit()
-    conn.close()
+    for note_id in notes_repo.update_content(data['title'], content):
+        render_cache.invalidate('note', note_id)
 
     bot.send_message(message.chat.id, f"Заметка <b>{html.escape(data['title'])}</b> обновлена!", parse_mode='HTML')
     show_notes_titles_list(message, user_id)
-    del notes_edit_state[user_id]
 
 def notes_confirm_delete_by_title_id(message, title_id):
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('SELECT title FROM notes WHERE id = ?', (title_id,))
-    row = c.fetchone()
-    conn.close()
+    title = notes_repo.get_title(title_id)
 
-    if not row:
+    if not title:
         bot.send_message(message.chat.id, "Заметка не найдена.")
         return
 
-    title = row[0]
     markup = types.InlineKeyboardMarkup()
     btn_yes = types.InlineKeyboardButton("Да, удалить", callback_data=f"notes_confirm_delete_title_{title_id}")
     btn_no = types.InlineKeyboardButton("Отмена", callback_data="cancel")
@@ -785,51 +1950,50 @@ def notes_do_delete_title_by_id(call, title_id):
     user_id = call.from_user.id
     if not is_notes_admin(user_id): return
 
-    conn = sqlite3.connect('notes.db')
-    c = conn.cursor()
-    c.execute('SELECT title FROM notes WHERE id = ?', (title_id,))
-    row = c.fetchone()
-    title = row[0] if row else "Неизвестно"
-
-    # Get all note ids with this title
-    c.execute('SELECT id FROM notes WHERE title = ?', (title,))
-    note_ids = [r[0] for r in c.fetchall()]
-
-    # Delete reactions and comments
-    for nid in note_ids:
-        c.execute('DELETE FROM reactions WHERE note_id = ?', (nid,))
-        c.execute('DELETE FROM comments WHERE note_id = ?', (nid,))
-
-    c.execute('DELETE FROM notes WHERE title = ?', (title,))
-    deleted = c.rowcount
-    conn.commit()
-    conn.close()
-
-    bot.edit_message_text(
-        chat_id=call.message.chat.id,
-        message_id=call.message.message_id,
-        text=f"Удалено {deleted} записей по <b>{html.escape(title)}</b>." if deleted else "Ничего не удалено.",
-        parse_mode='HTML'
-    )
+    title = notes_repo.get_title(title_id) or "Неизвестно"
+    deleted_ids = notes_repo.delete_by_title(title)
+    for note_id in deleted_ids:
+        render_cache.invalidate('note', note_id)
+    deleted = len(deleted_ids)
+
+    edit_coalescer.edit(call.message.chat.id, call.message.message_id,
+                        f"Удалено {deleted} записей по <b>{html.escape(title)}</b>." if deleted else "Ничего не удалено.")
     show_notes_titles_list(call.message, user_id)
 
 # === ДОМАШНИЕ ЗАДАНИЯ ===
 
-hw_add_state = {}
-hw_edit_state = {}
+hw_add_state = make_state_store('hw_add')
+hw_edit_state = make_state_store('hw_edit')
 
-def show_hw_subjects_list(message, user_id=None, page=1):
+DUE_WEEKDAY_NAMES = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+
+def format_due(due_at, now):
+    # Срок для кнопки: «пт 09.01», со временем, если оно указано, и с годом, если он не текущий
+    moment = datetime.fromtimestamp(due_at, LOCAL_TZ)
+    text = f"{DUE_WEEKDAY_NAMES[moment.weekday()]} {moment:%d.%m}"
+    if moment.year != datetime.fromtimestamp(now, LOCAL_TZ).year:
+        text += f".{moment:%Y}"
+    if (moment.hour, moment.minute) != (23, 59):
+        text += f" {moment:%H:%M}"
+    return text
+
+# Виды списка ДЗ: префикс callback_data, заголовок и подпись кнопки фильтра
+HW_VIEWS = {
+    'all': ('hw_list', 'Выберите предмет', 'Все'),
+    'due': ('hw_due', 'ДЗ по сроку сдачи', 'По сроку'),
+    'week': ('hw_week', 'Сдать в ближайшие 7 дней', 'На неделю'),
+    'overdue': ('hw_overdue', 'Просроченные ДЗ', 'Просрочено'),
+}
+
+def show_hw_subjects_list(message, user_id=None, page=1, view='all'):
     if user_id is None:
         user_id = message.from_user.id if hasattr(message, 'from_user') else message.chat.id
 
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
-    c.execute('SELECT subject, MIN(id) as min_id, photo_file_ids, video_file_ids, audio_file_ids, file_file_ids FROM homework GROUP BY subject ORDER BY min_id')
-    rows = c.fetchall()
-    conn.close()
-
     ITEMS_PER_PAGE = 5
-    total_items = len(rows)
+    prefix, title, _ = HW_VIEWS[view]
+    # Одно «сейчас» на счётчик и страницу, чтобы граница недели не сдвинулась между запросами
+    now = int(time.time())
+    total_items = hw_repo.count_subjects(view, now)
     total_pages = (total_items + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
 
     if page < 1:
@@ -837,27 +2001,27 @@ def show_hw_subjects_list(message, user_id=None, page=1):
     if page > total_pages:
         page = total_pages
 
-    start_idx = (page - 1) * ITEMS_PER_PAGE
-    end_idx = start_idx + ITEMS_PER_PAGE
-    page_rows = rows[start_idx:end_idx]
+    # Из БД читается только текущая страница, фильтр и сортировка по сроку — тоже в SQL
+    page_rows = hw_repo.list_subjects_page(max(page - 1, 0) * ITEMS_PER_PAGE, ITEMS_PER_PAGE, view, now)
 
     markup = types.InlineKeyboardMarkup(row_width=1)
 
-    if not rows:
-        text = "Нет ДЗ."
+    if not total_items:
+        text = "Нет ДЗ." if view == 'all' else f"<b>{title}:</b> ничего нет."
     else:
-        text = f"<b>Выберите предмет (страница {page}/{total_pages}):</b>"
+        text = f"<b>{title} (страница {page}/{total_pages}):</b>"
 
-    for subject, min_id, photo_json, video_json, audio_json, file_json in page_rows:
-        photos = json.loads(photo_json) if photo_json else []
-        videos = json.loads(video_json) if video_json else []
-        audios = json.loads(audio_json) if audio_json else []
-        files = json.loads(file_json) if file_json else []
+    for subject, min_id, photo_count, video_count, audio_count, file_count, due_date, due_at in page_rows:
         label = subject
-        if photos: label += f" (фото: {len(photos)})"
-        if videos: label += f" (видео: {len(videos)})"
-        if audios: label += f" (аудио: {len(audios)})"
-        if files: label += f" (файлы: {len(files)})"
+        if view != 'all' and due_at:
+            label = f"{'⚠️ ' if view == 'overdue' else ''}{subject} — до {format_due(due_at, now)}"
+        elif view != 'all' and due_date:
+            # Срок не разобран — показываем как ввели
+            label = f"{subject} — {due_date}"
+        if photo_count: label += f" (фото: {photo_count})"
+        if video_count: label += f" (видео: {video_count})"
+        if audio_count: label += f" (аудио: {audio_count})"
+        if file_count: label += f" (файлы: {file_count})"
         btn = types.InlineKeyboardButton(label, callback_data=f"hw_show_{min_id}")
         markup.add(btn)
 
@@ -868,44 +2032,32 @@ def show_hw_subjects_list(message, user_id=None, page=1):
     # Пагинация
     nav_row = []
     if page > 1:
-        btn_prev = types.InlineKeyboardButton("◀️ Предыдущая", callback_data=f"hw_list_{page-1}")
+        btn_prev = types.InlineKeyboardButton("◀️ Предыдущая", callback_data=f"{prefix}_{page-1}")
         nav_row.append(btn_prev)
     if page < total_pages:
-        btn_next = types.InlineKeyboardButton("Следующая ▶️", callback_data=f"hw_list_{page+1}")
+        btn_next = types.InlineKeyboardButton("Следующая ▶️", callback_data=f"{prefix}_{page+1}")
         nav_row.append(btn_next)
     if nav_row:
         markup.row(*nav_row)
 
+    # Переключение вида списка
+    markup.row(*[types.InlineKeyboardButton(caption, callback_data=f"{other_prefix}_1")
+                 for key, (other_prefix, _, caption) in HW_VIEWS.items() if key != view])
+
     btn_back = types.InlineKeyboardButton("Назад", callback_data="back_to_main")
     markup.add(btn_back)
 
     if hasattr(message, 'message_id'):
-        bot.edit_message_text(chat_id=message.chat.id, message_id=message.message_id,
-                              text=text, parse_mode='HTML', reply_markup=markup)
+        edit_coalescer.edit(message.chat.id, message.message_id, text, reply_markup=markup)
     else:
         bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=markup)
 
-def show_hw_details(message, hw_id, user_id):
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
-    c.execute('SELECT id, subject, task, due_date, photo_file_ids, video_file_ids, audio_file_ids, file_file_ids, created_at, creator_username FROM homework WHERE id = ?', (hw_id,))
-    row = c.fetchone()
-    conn.close()
-
-    if not row:
-        bot.send_message(message.chat.id, "ДЗ не найдено.", parse_mode='HTML')
-        return
+def build_hw_view(hw_id, user_id):
+    details = hw_repo.get_details(hw_id)
+    if not details:
+        return None
 
-    subject_id = row[0]
-    subject = row[1]
-    task = row[2]
-    due = row[3]
-    all_photos = json.loads(row[4]) if row[4] else []
-    all_videos = json.loads(row[5]) if row[5] else []
-    all_audios = json.loads(row[6]) if row[6] else []
-    all_files = json.loads(row[7]) if row[7] else []
-    created_at = row[8]
-    creator_identifier = row[9]
+    subject_id, subject, task, due, all_photos, all_videos, all_audios, all_files, created_at, creator_identifier = details
 
     text = f"<b>ДЗ по предмету: {html.escape(subject)}</b>\n\n"
     due_text = f"Срок: {html.escape(due)}" if due else "Срок: Не указано"
@@ -931,70 +2083,90 @@ def show_hw_details(message, hw_id, user_id):
         btn_delete = types.InlineKeyboardButton("Удалить", callback_data=f"hw_delete_subject_{subject_id}")
         markup.add(btn_edit, btn_delete)
 
-    bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=markup)
+    return {
+        'subject': subject,
+        'photos': all_photos,
+        'videos': all_videos,
+        'audios': all_audios,
+        'files': all_files,
+        'text': text,
+        'markup': markup,
+    }
 
-    if all_photos:
-        media = [types.InputMediaPhoto(all_photos[0], caption=f"<b>{html.escape(subject)}</b>", parse_mode='HTML')]
-        media += [types.InputMediaPhoto(p) for p in all_photos[1:]]
-        try:
-            bot.send_media_group(message.chat.id, media)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Ошибка отправки фото: {e}")
+def get_hw_view(hw_id, user_id):
+    key = ('hw', hw_id, is_hw_admin(user_id))
+    view = render_cache.get(key)
+    if view is None:
+        generation = render_cache.generation
+        view = build_hw_view(hw_id, user_id)
+        if not view:
+            return None
+        render_cache.set(key, view, generation)
+    return view
 
-    for video_id in all_videos:
-        try:
-            bot.send_video(message.chat.id, video_id)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Не удалось отправить видео: {e}")
+def show_hw_details(message, hw_id, user_id):
+    view = get_hw_view(hw_id, user_id)
 
-    for audio_id in all_audios:
-        try:
-            bot.send_audio(message.chat.id, audio_id)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Не удалось отправить аудио: {e}")
+    if not view:
+        bot.send_message(message.chat.id, "ДЗ не найдено.", parse_mode='HTML')
+        return
 
-    for file_id in all_files:
-        try:
-            bot.send_document(message.chat.id, file_id)
-        except Exception as e:
-            bot.send_message(message.chat.id, f"Не удалось отправить файл: {e}")
+    subject = view['subject']
+    all_photos = view['photos']
+    all_videos = view['videos']
+    all_audios = view['audios']
+    all_files = view['files']
+
+    bot.send_message(message.chat.id, view['text'], parse_mode='HTML', reply_markup=view['markup'])
+
+    media_delivery.deliver(message.chat.id, all_photos, all_videos, all_audios, all_files,
+                           caption=f"<b>{html.escape(subject)}</b>")
 
 def hw_start_add_hw(message, user_id, creator_identifier):
-    hw_add_state[user_id] = {'step': 'subject', 'photos': [], 'videos': [], 'audios': [], 'files': [], 'creator_identifier': creator_identifier}
+    hw_add_state.set(user_id, {'step': 'subject', 'photos': [], 'videos': [], 'audios': [], 'files': [], 'creator_identifier': creator_identifier})
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
     markup.add(btn_cancel)
     bot.send_message(message.chat.id, "Введите <b>предмет</b>:", parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: hw_add_state.get(m.from_user.id, {}).get('step') == 'subject')
+@message_router.route(hw_add_state, 'subject')
 def hw_get_subject(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
-    hw_add_state[user_id]['subject'] = message.text.strip()
-    hw_add_state[user_id]['step'] = 'task'
+    subject = message.text.strip()
+    if hw_add_state.update(user_id, lambda d: d.update(subject=subject, step='task')) is None: return
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
     markup.add(btn_cancel)
     bot.send_message(message.chat.id, "Введите <b>задание</b>:", parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: hw_add_state.get(m.from_user.id, {}).get('step') == 'task', content_types=['text'])
+@message_router.route(hw_add_state, 'task')
 def hw_get_task(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
-    hw_add_state[user_id]['task'] = message.text
-    hw_add_state[user_id]['step'] = 'due_date'
+    task = message.text
+    if hw_add_state.update(user_id, lambda d: d.update(task=task, step='due_date')) is None: return
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
     markup.add(btn_cancel)
-    bot.send_message(message.chat.id, "Введите <b>срок сдачи</b> (или `нет`):", parse_mode='HTML', reply_markup=markup)
+    bot.send_message(message.chat.id, "Введите <b>срок сдачи</b> (или `нет`):\n" + DUE_FORMATS_HINT, parse_mode='HTML', reply_markup=markup)
+
+DUE_FORMATS_HINT = "<i>Например: 25.12, 2024-12-25, завтра, в пятницу 18:00</i>"
 
-@bot.message_handler(func=lambda m: hw_add_state.get(m.from_user.id, {}).get('step') == 'due_date')
+def warn_unparsed_due(message, due):
+    # Нераспознанный срок сохраняется текстом, но в видах «по сроку» окажется в конце
+    if due and parse_due_date(due) is None:
+        bot.send_message(message.chat.id, "Дату в сроке не удалось распознать: он сохранится как текст "
+                                          "и не попадёт в списки «На неделю» и «Просрочено».")
+
+@message_router.route(hw_add_state, 'due_date')
 def hw_get_due_date(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
     due = message.text.strip()
-    hw_add_state[user_id]['due_date'] = due if due.lower() != 'нет' else None
-    hw_add_state[user_id]['step'] = 'attachments'
+    due = due if due.lower() != 'нет' else None
+    if hw_add_state.update(user_id, lambda d: d.update(due_date=due, step='attachments')) is None: return
+    warn_unparsed_due(message, due)
 
     markup = types.InlineKeyboardMarkup(row_width=2)
     btn_photo = types.InlineKeyboardButton("Фото", callback_data="hw_add_more_photos")
@@ -1011,7 +2183,7 @@ def hw_get_due_date(message):
     sent = bot.send_message(message.chat.id,
                             "Добавьте <b>фото</b>, <b>видео</b>, <b>аудио</b> или <b>файлы</b> (PDF, DOC, ZIP и др.)\n"
                             "или нажмите <b>Готово</b>", parse_mode='HTML', reply_markup=markup)
-    hw_add_state[user_id]['last_msg_id'] = sent.message_id
+    hw_add_state.update(user_id, lambda d: d.update(last_msg_id=sent.message_id))
 
 def hw_continue_adding_photos(call, user_id):
     if hw_add_state.get(user_id, {}).get('step') != 'attachments': return
@@ -1029,44 +2201,50 @@ def hw_continue_adding_files(call, user_id):
     if hw_add_state.get(user_id, {}).get('step') != 'attachments': return
     bot.answer_callback_query(call.id, "Отправьте файлы...")
 
-@bot.message_handler(func=lambda m: hw_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['photo'])
+@message_router.route(hw_add_state, 'attachments', 'photo')
 def hw_get_photos(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
     file_id = message.photo[-1].file_id
-    hw_add_state[user_id]['photos'].append(file_id)
-    count = len(hw_add_state[user_id]['photos'])
+    data = hw_add_state.update(user_id, lambda d: d['photos'].append(file_id))
+    if data is None: return
+    count = len(data['photos'])
     bot.reply_to(message, f"Добавлено фото: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
-@bot.message_handler(func=lambda m: hw_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['video'])
+@message_router.route(hw_add_state, 'attachments', 'video')
 def hw_get_videos(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
     file_id = message.video.file_id
-    hw_add_state[user_id]['videos'].append(file_id)
-    count = len(hw_add_state[user_id]['videos'])
+    data = hw_add_state.update(user_id, lambda d: d['videos'].append(file_id))
+    if data is None: return
+    count = len(data['videos'])
     bot.reply_to(message, f"Добавлено видео: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
-@bot.message_handler(func=lambda m: hw_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['audio'])
+@message_router.route(hw_add_state, 'attachments', 'audio')
 def hw_get_audios(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
     file_id = message.audio.file_id
-    hw_add_state[user_id]['audios'].append(file_id)
-    count = len(hw_add_state[user_id]['audios'])
+    data = hw_add_state.update(user_id, lambda d: d['audios'].append(file_id))
+    if data is None: return
+    count = len(data['audios'])
     bot.reply_to(message, f"Добавлено аудио: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
-@bot.message_handler(func=lambda m: hw_add_state.get(m.from_user.id, {}).get('step') == 'attachments', content_types=['document'])
+@message_router.route(hw_add_state, 'attachments', 'document')
 def hw_get_files(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
     file_id = message.document.file_id
-    hw_add_state[user_id]['files'].append(file_id)
-    count = len(hw_add_state[user_id]['files'])
+    data = hw_add_state.update(user_id, lambda d: d['files'].append(file_id))
+    if data is None: return
+    count = len(data['files'])
     bot.reply_to(message, f"Добавлен файл: {count}. Отправьте ещё или нажмите <b>Готово</b>.", parse_mode='HTML')
 
 def hw_finish_adding_hw(call, user_id):
-    data = hw_add_state[user_id]
+    # Забираем состояние сразу, чтобы повторное нажатие «Готово» не сохранило запись дважды
+    data = hw_add_state.pop(user_id)
+    if data is None: return
     subject = data['subject']
     task = data['task']
     due_date = data['due_date']
@@ -1075,89 +2253,38 @@ def hw_finish_adding_hw(call, user_id):
     audios = data['audios']
     files = data['files']
     creator_identifier = data['creator_identifier']
-    photo_json = json.dumps(photos) if photos else None
-    video_json = json.dumps(videos) if videos else None
-    audio_json = json.dumps(audios) if audios else None
-    file_json = json.dumps(files) if files else None
     local_tz = timezone(timedelta(hours=3))
     created_at = datetime.now(tz=local_tz).strftime('%Y-%m-%d %H:%M')
 
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
+    # Старое ДЗ по тому же предмету заменяется новым
+    deleted = hw_repo.replace(subject, task, due_date, photos, videos, audios, files, created_at, creator_identifier)
+    for hw_id in deleted:
+        render_cache.invalidate('hw', hw_id)
+    reminder_scheduler.wake()
 
-    # УДАЛЯЕМ СТАРОЕ ДЗ
-    c.execute('DELETE FROM homework WHERE subject = ?', (subject,))
-    deleted = c.rowcount
-
-    # ДОБАВЛЯЕМ НОВОЕ
-    c.execute('''
-        INSERT INTO homework (subject, task, due_date, photo_file_ids, video_file_ids, audio_file_ids, file_file_ids, created_at, creator_username)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (subject, task, due_date, photo_json, video_json, audio_json, file_json, created_at, creator_identifier))
-    conn.commit()
-    conn.close()
-
-    action = "обновлено" if deleted > 0 else "добавлено"
+    action = "обновлено" if deleted else "добавлено"
     response = f"<b>ДЗ по предмету <code>{html.escape(subject)}</code> {action}!</b>\n\n<b>{html.escape(task)}</b>\nСрок: {html.escape(due_date or 'Не указано')}"
     markup = types.InlineKeyboardMarkup()
     btn_back = types.InlineKeyboardButton("Назад к списку", callback_data="hw_list_1")
     markup.add(btn_back)
 
-    sent_text = False
-
-    if photos:
-        media = [types.InputMediaPhoto(photos[0], caption=response, parse_mode='HTML')]
-        media += [types.InputMediaPhoto(p) for p in photos[1:]]
-        try:
-            bot.send_media_group(call.message.chat.id, media)
-            sent_text = True
-        except Exception as e:
-            bot.send_message(call.message.chat.id, f"Ошибка при отправке фото: {e}")
-
-    for video_id in videos:
-        try:
-            bot.send_video(call.message.chat.id, video_id)
-        except Exception as e:
-            bot.send_message(call.message.chat.id, f"Ошибка при отправке видео: {e}")
-
-    for audio_id in audios:
-        try:
-            bot.send_audio(call.message.chat.id, audio_id)
-        except Exception as e:
-            bot.send_message(call.message.chat.id, f"Ошибка при отправке аудио: {e}")
-
-    if files:
-        for file_id in files:
-            try:
-                bot.send_document(call.message.chat.id, file_id)
-            except Exception as e:
-                bot.send_message(call.message.chat.id, f"Ошибка при отправке файла: {e}")
-
-    if not sent_text:
-        bot.send_message(call.message.chat.id, response, parse_mode='HTML', reply_markup=markup)
-    else:
-        bot.send_message(call.message.chat.id, "Готово!", reply_markup=markup)
-
-    del hw_add_state[user_id]
+    media_delivery.deliver(call.message.chat.id, photos, videos, audios, files, caption=response,
+                           on_done=functools.partial(send_saved_reply, call.message.chat.id, response, markup))
 
 def hw_start_edit_hw(message, subject_id, user_id):
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
-    c.execute('SELECT subject, task, due_date FROM homework WHERE id = ?', (subject_id,))
-    row = c.fetchone()
-    conn.close()
+    row = hw_repo.get_for_edit(subject_id)
 
     if not row:
         bot.send_message(message.chat.id, "ДЗ не найдено.")
         return
 
     subject, task, due = row
-    hw_edit_state[user_id] = {
+    hw_edit_state.set(user_id, {
         'subject': subject,
         'step': 'edit_task',
         'old_task': task,
         'old_due': due
-    }
+    })
 
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
@@ -1166,49 +2293,44 @@ def hw_start_edit_hw(message, subject_id, user_id):
                      f"Редактируем: <b>{html.escape(subject)}</b>\nТекущее задание:\n<code>{html.escape(task)}</code>\n\nВведите новое:",
                      parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: hw_edit_state.get(m.from_user.id, {}).get('step') == 'edit_task')
+@message_router.route(hw_edit_state, 'edit_task')
 def hw_edit_task(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
-    hw_edit_state[user_id]['task'] = message.text
-    hw_edit_state[user_id]['step'] = 'edit_due'
+    task = message.text
+    data = hw_edit_state.update(user_id, lambda d: d.update(task=task, step='edit_due'))
+    if data is None: return
     markup = types.InlineKeyboardMarkup()
     btn_cancel = types.InlineKeyboardButton("Отмена", callback_data="cancel")
     markup.add(btn_cancel)
     bot.send_message(message.chat.id,
-                     f"Текущий срок: <code>{html.escape(hw_edit_state[user_id]['old_due'] or 'Не указано')}</code>\nВведите новый (или `нет`):",
+                     f"Текущий срок: <code>{html.escape(data['old_due'] or 'Не указано')}</code>\nВведите новый (или `нет`):\n" + DUE_FORMATS_HINT,
                      parse_mode='HTML', reply_markup=markup)
 
-@bot.message_handler(func=lambda m: hw_edit_state.get(m.from_user.id, {}).get('step') == 'edit_due')
+@message_router.route(hw_edit_state, 'edit_due')
 def hw_edit_due(message):
     user_id = message.from_user.id
     if not is_hw_admin(user_id): return
-    data = hw_edit_state[user_id]
+    data = hw_edit_state.pop(user_id)
+    if data is None: return
     due = message.text.strip()
     due = due if due.lower() != 'нет' else None
+    warn_unparsed_due(message, due)
 
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
-    c.execute('UPDATE homework SET task = ?, due_date = ? WHERE subject = ?', (data['task'], due, data['subject']))
-    conn.commit()
-    conn.close()
+    for hw_id in hw_repo.update_task(data['subject'], data['task'], due):
+        render_cache.invalidate('hw', hw_id)
+    reminder_scheduler.wake()
 
     bot.send_message(message.chat.id, f"ДЗ по <b>{html.escape(data['subject'])}</b> обновлено!", parse_mode='HTML')
     show_hw_subjects_list(message, user_id)
-    del hw_edit_state[user_id]
 
 def hw_confirm_delete_by_subject_id(message, subject_id):
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
-    c.execute('SELECT subject FROM homework WHERE id = ?', (subject_id,))
-    row = c.fetchone()
-    conn.close()
+    subject = hw_repo.get_subject(subject_id)
 
-    if not row:
+    if not subject:
         bot.send_message(message.chat.id, "Предмет не найден.")
         return
 
-    subject = row[0]
     markup = types.InlineKeyboardMarkup()
     btn_yes = types.InlineKeyboardButton("Да, удалить", callback_data=f"hw_confirm_delete_subject_{subject_id}")
     btn_no = types.InlineKeyboardButton("Отмена", callback_data="cancel")
@@ -1219,25 +2341,102 @@ def hw_do_delete_subject_by_id(call, subject_id):
     user_id = call.from_user.id
     if not is_hw_admin(user_id): return
 
-    conn = sqlite3.connect('homework.db')
-    c = conn.cursor()
-    c.execute('SELECT subject FROM homework WHERE id = ?', (subject_id,))
-    row = c.fetchone()
-    subject = row[0] if row else "Неизвестно"
-
-    c.execute('DELETE FROM homework WHERE subject = ?', (subject,))
-    deleted = c.rowcount
-    conn.commit()
-    conn.close()
-
-    bot.edit_message_text(
-        chat_id=call.message.chat.id,
-        message_id=call.message.message_id,
-        text=f"Удалено {deleted} записей по <b>{html.escape(subject)}</b>." if deleted else "Ничего не удалено.",
-        parse_mode='HTML'
-    )
+    subject = hw_repo.get_subject(subject_id) or "Неизвестно"
+    deleted_ids = hw_repo.delete_by_subject(subject)
+    for hw_id in deleted_ids:
+        render_cache.invalidate('hw', hw_id)
+    deleted = len(deleted_ids)
+
+    edit_coalescer.edit(call.message.chat.id, call.message.message_id,
+                        f"Удалено {deleted} записей по <b>{html.escape(subject)}</b>." if deleted else "Ничего не удалено.")
     show_hw_subjects_list(call.message, user_id)
 
+# Один обработчик на все шаги диалогов; регистрируется до команд, как раньше регистрировались сами шаги
+@bot.message_handler(func=_match_dialog_step, content_types=message_router.content_types())
+def dialog_step_handler(message):
+    with metrics.timer('route_seconds', route=message.dialog_handler.__name__):
+        message.dialog_handler(message)
+
+# === ПОИСК ===
+
+search_state = make_state_store('search')
+SEARCH_PER_PAGE = 5
+
+def search_all(text, offset, limit):
+    # Заметки и ДЗ лежат в разных БД: берём из каждой первые offset + limit + 1
+    # результатов и сливаем по рангу; лишний элемент говорит о наличии следующей страницы.
+    # Префиксный запрос ранжирует все словоформы и заметно дороже, поэтому он только запасной:
+    # когда по словам целиком ничего нет (последнее слово не дописано). Выбор не зависит от
+    # страницы, так что страницы одного запроса не перемешиваются
+    match = build_fts_query(text)
+    if not match:
+        return [], False
+    need = offset + limit + 1
+    results = []
+    for match in dict.fromkeys((match, build_fts_query(text, prefix=True))):
+        results = [('note',) + row for row in notes_repo.search(match, need)]
+        results += [('hw',) + row for row in hw_repo.search(match, need)]
+        if results:
+            break
+    results.sort(key=lambda r: r[4])
+    return results[offset:offset + limit], len(results) > offset + limit
+
+def show_search_results(message, user_id, page=1, edit=False):
+    text_query = search_state.get(user_id)
+    if not text_query:
+        bot.send_message(message.chat.id, "Введите запрос: /search <текст>")
+        return
+    page = max(page, 1)
+    results, has_next = search_all(text_query, (page - 1) * SEARCH_PER_PAGE, SEARCH_PER_PAGE)
+
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    if not results:
+        text = f"По запросу <b>{html.escape(text_query)}</b> ничего не найдено."
+    else:
+        text = f"<b>Результаты поиска «{html.escape(text_query)}» (страница {page}):</b>\n\n"
+        for i, (kind, item_id, title, snippet, rank) in enumerate(results, (page - 1) * SEARCH_PER_PAGE + 1):
+            label = "Заметка" if kind == 'note' else "ДЗ"
+            text += f"{i}. {label}: <b>{html.escape(title)}</b>\n{html.escape(snippet)}\n\n"
+            callback = f"notes_show_{item_id}" if kind == 'note' else f"hw_show_{item_id}"
+            markup.add(types.InlineKeyboardButton(f"{i}. {label}: {title}", callback_data=callback))
+
+    nav_row = []
+    if page > 1:
+        nav_row.append(types.InlineKeyboardButton("◀️ Предыдущая", callback_data=f"search_{page-1}"))
+    if has_next:
+        nav_row.append(types.InlineKeyboardButton("Следующая ▶️", callback_data=f"search_{page+1}"))
+    if nav_row:
+        markup.row(*nav_row)
+    markup.add(types.InlineKeyboardButton("Назад", callback_data="back_to_main"))
+
+    if edit:
+        edit_coalescer.edit(message.chat.id, message.message_id, text, reply_markup=markup)
+    else:
+        bot.send_message(message.chat.id, text, parse_mode='HTML', reply_markup=markup)
+
+@bot.message_handler(commands=['search'])
+def search_cmd(message):
+    query = message.text.split(maxsplit=1)
+    if len(query) < 2 or not query[1].strip():
+        bot.reply_to(message, "Использование: /search <текст>")
+        return
+    search_state.set(message.from_user.id, query[1].strip())
+    show_search_results(message, message.from_user.id)
+
+@bot.inline_handler(func=lambda query: True)
+def search_inline(inline_query):
+    offset = int(inline_query.offset or 0)
+    results, has_next = search_all(inline_query.query, offset, 20)
+    articles = []
+    for kind, item_id, title, snippet, rank in results:
+        label = "Заметка" if kind == 'note' else "ДЗ"
+        content = f"<b>{label}: {html.escape(title)}</b>\n{html.escape(snippet)}"
+        articles.append(types.InlineQueryResultArticle(
+            id=f"{kind}_{item_id}", title=f"{label}: {title}", description=snippet,
+            input_message_content=types.InputTextMessageContent(content, parse_mode='HTML')))
+    bot.answer_inline_query(inline_query.id, articles, cache_time=10,
+                            next_offset=str(offset + 20) if has_next else "")
+
 # === Команды ===
 @bot.message_handler(commands=['notes_list'])
 def notes_list_cmd(message):
@@ -1250,20 +2449,659 @@ def hw_list_cmd(message):
 @bot.message_handler(commands=['notes_add'])
 def notes_add_cmd(message):
     if is_notes_admin(message.from_user.id):
-        creator_identifier = message.from_user.username if message.from_user.username else str(message.from_user.id)
-        notes_start_add_note(message, message.from_user.id, creator_identifier)
+        notes_start_add_note(message, message.from_user.id, creator_identifier_of(message.from_user))
     else:
         bot.reply_to(message, "Доступ запрещён для заметок.")
 
 @bot.message_handler(commands=['hw_add'])
 def hw_add_cmd(message):
     if is_hw_admin(message.from_user.id):
-        creator_identifier = message.from_user.username if message.from_user.username else str(message.from_user.id)
-        hw_start_add_hw(message, message.from_user.id, creator_identifier)
+        hw_start_add_hw(message, message.from_user.id, creator_identifier_of(message.from_user))
     else:
         bot.reply_to(message, "Доступ запрещён для ДЗ.")
 
+@bot.message_handler(commands=['remind_on'])
+def remind_on_cmd(message):
+    if not reminder_scheduler.leads:
+        bot.reply_to(message, "Напоминания о сроках отключены в настройках бота.")
+        return
+    hours = ", ".join(f"{lead / 3600:g}" for lead in reminder_scheduler.leads)
+    if reminders_repo.subscribe(message.from_user.id):
+        bot.reply_to(message, f"Напоминания включены: пришлю сообщение за {hours} ч до срока сдачи ДЗ. Отключить — /remind_off")
+    else:
+        bot.reply_to(message, "Напоминания уже включены. Отключить — /remind_off")
+
+@bot.message_handler(commands=['remind_off'])
+def remind_off_cmd(message):
+    if reminders_repo.unsubscribe(message.from_user.id):
+        bot.reply_to(message, "Напоминания отключены. Включить снова — /remind_on")
+    else:
+        bot.reply_to(message, "Напоминания и так выключены. Включить — /remind_on")
+
+# === ИМПОРТ И ЭКСПОРТ ===
+# Формат — NDJSON: по одному JSON-объекту на строку, поле type: note, comment, reaction или homework.
+# Записи с id заменяют существующие с тем же id, без id — добавляются.
+EXPORT_VERSION = 1
+IMPORT_CHUNK = 5000
+
+def export_ndjson(out):
+    out.write(json.dumps({'type': 'meta', 'version': EXPORT_VERSION,
+                          'exported_at': datetime.now(timezone.utc).isoformat()}, ensure_ascii=False) + '\n')
+    count = 0
+    for rows in (notes_repo.export_notes(), comments_repo.export_comments(),
+                 reactions_repo.export_reactions(), hw_repo.export_homework()):
+        for row in rows:
+            out.write(json.dumps(row, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+def import_ndjson(lines, chunk=IMPORT_CHUNK):
+    # Каждая пачка пишется своей транзакцией; при ошибке уже записанные пачки остаются
+    importers = {
+        'note': notes_repo.import_notes,
+        'comment': comments_repo.import_comments,
+        'reaction': reactions_repo.import_reactions,
+        'homework': hw_repo.import_homework,
+    }
+    pending = {kind: [] for kind in importers}
+    counts = {kind: 0 for kind in importers}
+    try:
+        for lineno, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                kind = row['type']
+            except (ValueError, KeyError, TypeError):
+                raise ValueError(f"строка {lineno}: не удалось разобрать запись")
+            if kind == 'meta':
+                continue
+            if kind not in importers:
+                raise ValueError(f"строка {lineno}: неизвестный тип записи {kind!r}")
+            pending[kind].append(row)
+            if len(pending[kind]) >= chunk:
+                importers[kind](pending[kind])
+                counts[kind] += len(pending[kind])
+                pending[kind] = []
+        for kind, rows in pending.items():
+            if rows:
+                importers[kind](rows)
+                counts[kind] += len(rows)
+    finally:
+        notes_repo.recount_counters()
+        render_cache.clear()
+        reminder_scheduler.wake()
+    return counts
+
+def can_import(user_id):
+    return is_notes_admin(user_id) and is_hw_admin(user_id)
+
+import_state = make_state_store('import')
+
+# Выгрузка и загрузка идут в своём потоке по одной: поток ShardedExecutor сразу освобождается,
+# а ответ администратор получает по готовности
+transfer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='transfer')
+DOWNLOAD_CHUNK = 1 << 16
+
+def download_to(file_id, out):
+    # Как bot.download_file, но по частям: выгрузка большой базы не должна целиком лежать в памяти
+    file_path = bot.get_file(file_id).file_path
+    url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, file_path)
+    with requests.get(url, stream=True, proxies=apihelper.proxy,
+                      timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)) as response:
+        if response.status_code != 200:
+            raise apihelper.ApiHTTPException('Download file', response)
+        for chunk in response.iter_content(DOWNLOAD_CHUNK):
+            out.write(chunk)
+
+def run_export(chat_id):
+    try:
+        with tempfile.TemporaryFile('w+b') as f:
+            text = io.TextIOWrapper(f, encoding='utf-8')
+            count = export_ndjson(text)
+            text.flush()
+            f.seek(0)
+            name = f"dz-bot-{datetime.now().strftime('%Y%m%d-%H%M')}.ndjson"
+            bot.send_document(chat_id, types.InputFile(f, file_name=name), caption=f"Записей: {count}")
+            text.detach()
+    except Exception as e:
+        print(f"Ошибка выгрузки: {e}")
+        bot.send_message(chat_id, f"Выгрузка не удалась: {html.escape(str(e))}", parse_mode='HTML')
+
+def run_import(message):
+    try:
+        with tempfile.TemporaryFile('w+b') as f:
+            download_to(message.document.file_id, f)
+            f.seek(0)
+            counts = import_ndjson(io.TextIOWrapper(f, encoding='utf-8'))
+    except (ValueError, KeyError, sqlite3.IntegrityError) as e:
+        bot.reply_to(message, f"Импорт прерван: {html.escape(str(e))}", parse_mode='HTML')
+        return
+    except (requests.RequestException, apihelper.ApiException) as e:
+        # В том числе файлы больше 20 МБ: Bot API не отдаёт их ботам
+        print(f"Не удалось скачать файл импорта: {e}")
+        bot.reply_to(message, "Не удалось скачать файл. Отправьте его ещё раз через /import.")
+        return
+    except sqlite3.OperationalError as e:
+        # Например, database is locked: записанные пачки остаются, повторный импорт заменит их по id
+        bot.reply_to(message, f"Импорт прерван ошибкой базы: {html.escape(str(e))}. "
+                              f"Отправьте файл ещё раз через /import.", parse_mode='HTML')
+        return
+    except Exception as e:
+        print(f"Ошибка импорта: {e}")
+        bot.reply_to(message, f"Импорт не удался: {html.escape(str(e))}", parse_mode='HTML')
+        return
+    bot.reply_to(message, f"Импортировано: заметок {counts['note']}, комментариев {counts['comment']}, "
+                          f"реакций {counts['reaction']}, ДЗ {counts['homework']}.")
+
+@bot.message_handler(commands=['export'])
+def export_cmd(message):
+    if not (is_notes_admin(message.from_user.id) or is_hw_admin(message.from_user.id)):
+        bot.reply_to(message, "Доступ запрещён.")
+        return
+    bot.reply_to(message, "Готовлю выгрузку, пришлю файл, когда будет готов.")
+    transfer_executor.submit(run_export, message.chat.id)
+
+@bot.message_handler(commands=['import'])
+def import_cmd(message):
+    if not can_import(message.from_user.id):
+        bot.reply_to(message, "Доступ запрещён.")
+        return
+    import_state.set(message.from_user.id, {'step': 'file'})
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Отмена", callback_data="cancel"))
+    bot.send_message(message.chat.id, "Отправьте файл выгрузки (<code>.ndjson</code>).", parse_mode='HTML', reply_markup=markup)
+
+@message_router.route(import_state, 'file', 'document')
+def import_get_file(message):
+    user_id = message.from_user.id
+    if not can_import(user_id): return
+    import_state.delete(user_id)
+    bot.reply_to(message, "Файл принят, импортирую. Пришлю итог, когда закончу.")
+    transfer_executor.submit(run_import, message)
+
+# === СТАТИСТИКА ===
+def format_ms(seconds):
+    return f"{seconds * 1000:.1f} мс" if seconds < 0.01 else f"{seconds * 1000:.0f} мс"
+
+def format_duration(seconds):
+    minutes = int(seconds) // 60
+    return f"{minutes // 1440} д {minutes // 60 % 24} ч {minutes % 60} мин"
+
+def format_slowest(title, histograms, limit=5):
+    # Самые медленные по p95 — метка у этих гистограмм одна
+    ranked = sorted(histograms.items(), key=lambda item: item[1].quantile(0.95), reverse=True)[:limit]
+    lines = [title]
+    for labels, histogram in ranked:
+        name = labels[0][1] if labels else '—'
+        lines.append(f"  {html.escape(str(name))}: {format_ms(histogram.quantile(0.95))} (n={histogram.count})")
+    return lines if ranked else []
+
+def format_stats():
+    updates = metrics.histogram('update_seconds')
+    api = metrics.histogram('api_request_seconds')
+    api_wait = metrics.histogram('api_wait_seconds')
+    cache = render_cache.stats()
+    lookups = cache['hits'] + cache['misses']
+    edits = edit_coalescer.stats()
+    reminders = reminder_scheduler.stats()
+    lines = [
+        "<b>Статистика</b>",
+        f"Работает: {format_duration(time.time() - metrics.started)}",
+        f"Обновления: {updates.count}, ошибок {sum(metrics.counters('update_errors_total').values())}; "
+        f"p50 {format_ms(updates.quantile(0.5))}, p95 {format_ms(updates.quantile(0.95))}, p99 {format_ms(updates.quantile(0.99))}",
+        f"Bot API: {api.count} запросов, ошибок {sum(metrics.counters('api_errors_total').values())}; "
+        f"p95 {format_ms(api.quantile(0.95))}, ожидание лимитов p95 {format_ms(api_wait.quantile(0.95))}",
+        f"Кэш карточек: попаданий {cache['hits'] / lookups if lookups else 0:.0%}, записей {cache['size']}",
+        f"Правки сообщений: отправлено {edits['sent']} из {edits['requested']}",
+        f"Напоминания: подписчиков {reminders_repo.count_subscribers()}, в очереди {reminders['scheduled']}, "
+        f"разослано {reminders['sent']}, ошибок {reminders['failed']}",
+        "Диалоги: " + ", ".join(f"{labels['dialog']} {value}" for labels, value in metrics.samples('dialog_states')),
+        "",
+    ]
+    lines += format_slowest("Медленные обработчики (p95):", metrics.histograms('route_seconds'))
+    lines += format_slowest("Медленные запросы к БД (p95):", metrics.histograms('db_query_seconds'))
+    lines += format_slowest("Медленные потоки обработки (p95):", metrics.histograms('shard_update_seconds'))
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['stats'])
+def stats_cmd(message):
+    if not (is_notes_admin(message.from_user.id) or is_hw_admin(message.from_user.id)):
+        bot.reply_to(message, "Доступ запрещён.")
+        return
+    bot.send_message(message.chat.id, format_stats(), parse_mode='HTML')
+
+class MetricsServer:
+    """Отдаёт метрики по HTTP на /metrics для Prometheus.
+
+    Запросы обслуживает один долгоживущий поток: сборщики метрик ходят в базы через его
+    соединения, а не открывают новое на каждое снятие. Prometheus и так снимает по очереди."""
+
+    def __init__(self, listen, port):
+        self._httpd = HTTPServer((listen, port), self._make_handler())
+
+    def _make_handler(self):
+        class Handler(BaseHTTPRequestHandler):
+            # Зависший клиент не должен держать единственный поток дольше этого
+            timeout = 10
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if urlparse(self.path).path != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, name='metrics', daemon=True).start()
+
+def instrument_handlers():
+    # Время каждого зарегистрированного обработчика TeleBot — в handler_seconds{handler="имя"}
+    for handlers in (bot.message_handlers, bot.callback_query_handlers, bot.inline_handlers):
+        for handler in handlers:
+            func = handler['function']
+            handler['function'] = metrics.timed('handler_seconds', func, handler=func.__name__)
+
+instrument_handlers()
+
+# === ОБРАБОТКА ОБНОВЛЕНИЙ ===
+def event_kind(name, event):
+    # Тип события для метрик; сообщения с командой считаются отдельно
+    if name == 'message' and (getattr(event, 'text', None) or '').startswith('/'):
+        return 'command'
+    return name
+
+def update_kind(update):
+    for name, event in vars(update).items():
+        if name == 'update_id' or event is None:
+            continue
+        return event_kind(name, event)
+    return 'unknown'
+
+def process_update(update):
+    kind = update_kind(update)
+    try:
+        with metrics.timer('update_seconds', kind=kind):
+            bot.process_new_updates([update])
+    except Exception as e:
+        metrics.inc('update_errors_total', kind=kind)
+        print(f"Ошибка обработки обновления {update.update_id}: {e}")
+
+class ShardedExecutor:
+    """Раскладывает обновления по потокам по пользователю: обновления одного пользователя
+    обрабатываются строго по очереди, разных пользователей — параллельно."""
+
+    def __init__(self, workers=WORKERS):
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._stats = [{'processed': 0, 'busy': 0.0, 'wait': 0.0, 'max': 0.0} for _ in range(workers)]
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, args=(shard,), name=f'update-{shard}', daemon=True)
+                         for shard in range(workers)]
+        for thread in self._threads:
+            thread.start()
+        metrics.collect(self._collect)
+
+    @staticmethod
+    def shard_key(update):
+        # Автор события, а если его нет — чат; иначе обновление ни с чем не связано
+        for name, event in vars(update).items():
+            if name == 'update_id' or event is None:
+                continue
+            user = getattr(event, 'from_user', None)
+            if user is not None:
+                return user.id
+            chat = getattr(event, 'chat', None)
+            if chat is not None:
+                return chat.id
+        return update.update_id
+
+    def submit(self, update, done=None):
+        # done вызывается в потоке обработчика после обработки обновления
+        shard = self.shard_key(update) % len(self._queues)
+        self._queues[shard].put((update, done, time.monotonic()))
+
+    def _run(self, shard):
+        tasks = self._queues[shard]
+        stats = self._stats[shard]
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            update, done, queued_at = task
+            started = time.monotonic()
+            metrics.observe('update_queue_seconds', started - queued_at)
+            metrics.observe('shard_wait_seconds', started - queued_at, shard=shard)
+            try:
+                process_update(update)
+            finally:
+                elapsed = time.monotonic() - started
+                # Распределение по шардам показывает, не застрял ли один поток за медленным пользователем
+                metrics.observe('shard_update_seconds', elapsed, shard=shard)
+                with self._lock:
+                    stats['processed'] += 1
+                    stats['busy'] += elapsed
+                    stats['wait'] += started - queued_at
+                    stats['max'] = max(stats['max'], elapsed)
+                if done is not None:
+                    done()
+
+    def stats(self):
+        with self._lock:
+            return [{'shard': shard, 'depth': tasks.qsize(), 'processed': stats['processed'],
+                     'avg_ms': stats['busy'] / stats['processed'] * 1000 if stats['processed'] else 0,
+                     'avg_wait_ms': stats['wait'] / stats['processed'] * 1000 if stats['processed'] else 0,
+                     'max_ms': stats['max'] * 1000}
+                    for shard, (tasks, stats) in enumerate(zip(self._queues, self._stats))]
+
+    def _collect(self):
+        for shard in self.stats():
+            labels = {'shard': shard['shard']}
+            yield 'shard_queue_depth', 'gauge', labels, shard['depth']
+            yield 'shard_processed_total', 'counter', labels, shard['processed']
+            yield 'shard_update_max_seconds', 'gauge', labels, shard['max_ms'] / 1000
+
+    def shutdown(self):
+        # Уже поставленные в очередь обновления дорабатываются
+        for tasks in self._queues:
+            tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+def run_polling(workers=WORKERS):
+    # Обработчики выполняются в потоках ShardedExecutor, а не во внутреннем пуле TeleBot
+    bot.threaded = False
+    executor = ShardedExecutor(workers)
+    # Не набирать больше обновлений, чем потоки успевают обработать
+    slots = threading.Semaphore(workers * 4)
+    offset = None
+    webhook_removed = False
+    try:
+        while True:
+            try:
+                if not webhook_removed:
+                    # После режима webhook getUpdates отвечает 409, пока вебхук не снят
+                    bot.remove_webhook()
+                    webhook_removed = True
+                updates = bot.get_updates(offset=offset, timeout=25, long_polling_timeout=20)
+            except Exception as e:
+                print(f"Ошибка получения обновлений: {e}")
+                time.sleep(3)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                slots.acquire()
+                executor.submit(update, slots.release)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown()
+
+# === АСИНХРОННЫЙ РЕЖИМ ===
+class AsyncDispatcher:
+    """Обновления получает и раскладывает по обработчикам AsyncTeleBot. Обработчики — те же
+    функции, что и в обычном режиме: их фильтры и тела с вызовами SQLite и Bot API выполняются
+    в пуле потоков, поэтому цикл событий не блокируется. Обновления одного пользователя
+    обрабатываются строго по очереди, разных — параллельно, и медленная отправка медиа занимает
+    один поток пула, а не очередь всех пользователей своего шарда."""
+
+    HANDLERS = (('message', 'message_handlers'), ('callback_query', 'callback_query_handlers'),
+                ('inline_query', 'inline_handlers'))
+
+    def __init__(self, workers=WORKERS):
+        from telebot.async_telebot import AsyncTeleBot
+
+        self.bot = AsyncTeleBot(TOKEN)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='async-worker')
+        # Не набирать больше обновлений, чем пул успевает обработать
+        self._slots = asyncio.Semaphore(workers * 4)
+        self._tails = {}     # пользователь -> его последняя задача
+        self._running = set()
+        for update_type, attr in self.HANDLERS:
+            for handler in getattr(bot, attr):
+                filters = dict(handler['filters'])
+                if 'func' in filters:
+                    filters['func'] = self._offloaded(filters['func'])
+                getattr(self.bot, attr).append({'function': self._handler(handler['function'], update_type),
+                                                'pass_bot': False, 'filters': filters})
+        metrics.collect(self._collect)
+
+    def _offloaded(self, func):
+        async def call(event):
+            return await asyncio.get_running_loop().run_in_executor(self._pool, func, event)
+        return call
+
+    def _handler(self, func, update_type):
+        offloaded = self._offloaded(func)
+
+        async def handle(event):
+            # AsyncTeleBot только пишет исключения в лог, поэтому ошибки считаются здесь
+            try:
+                await offloaded(event)
+            except Exception as e:
+                metrics.inc('update_errors_total', kind=event_kind(update_type, event))
+                print(f"Ошибка обработчика {func.__name__}: {e}")
+        return handle
+
+    def submit(self, update, done=None):
+        # Задача пользователя начинается, когда закончилась его предыдущая
+        key = ShardedExecutor.shard_key(update)
+        task = asyncio.create_task(self._run(update, self._tails.get(key), done))
+        self._tails[key] = task
+        self._running.add(task)
+        task.add_done_callback(functools.partial(self._forget, key))
+
+    def _forget(self, key, task):
+        self._running.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, update, previous, done):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await process_update_async(self.bot, update)
+        finally:
+            if done is not None:
+                done()
+
+    def _collect(self):
+        yield 'async_updates_in_flight', 'gauge', {}, len(self._running)
+
+    async def poll(self):
+        offset = None
+        webhook_removed = False
+        try:
+            while True:
+                try:
+                    if not webhook_removed:
+                        # После режима webhook getUpdates отвечает 409, пока вебхук не снят
+                        await self.bot.remove_webhook()
+                        webhook_removed = True
+                    updates = await self.bot.get_updates(offset=offset, timeout=20)
+                except Exception as e:
+                    print(f"Ошибка получения обновлений: {e}")
+                    await asyncio.sleep(3)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    await self._slots.acquire()
+                    self.submit(update, self._slots.release)
+        finally:
+            # Уже полученные обновления дорабатываются
+            if self._running:
+                await asyncio.wait(list(self._running))
+            await self.bot.close_session()
+            self._pool.shutdown()
+
+async def process_update_async(async_bot, update):
+    with metrics.timer('update_seconds', kind=update_kind(update)):
+        await async_bot.process_new_updates([update])
+
+def run_async(workers=WORKERS):
+    async def main():
+        await AsyncDispatcher(workers).poll()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+# === РЕЖИМ WEBHOOK ===
+class WebhookServer:
+    """Принимает обновления от Telegram по HTTP и обрабатывает их в ShardedExecutor."""
+
+    SEEN_LIMIT = 10000
+
+    def __init__(self, listen, port, path, secret='', workers=WORKERS):
+        self.path = path
+        self.secret = secret
+        self._executor = ShardedExecutor(workers)
+        # Не принимать больше обновлений, чем потоки успевают обработать: остальные Telegram пришлёт повторно
+        self._slots = threading.Semaphore(workers * 4)
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._draining = False
+        self.duplicates = 0
+        self._httpd = ThreadingHTTPServer((listen, port), self._make_handler(), bind_and_activate=False)
+        self._httpd.daemon_threads = True
+        # Telegram держит до max_connections соединений одновременно; очереди по умолчанию (5) не хватает
+        self._httpd.request_queue_size = 128
+        self._httpd.server_bind()
+        self._httpd.server_activate()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                self.send_response(server.accept(self))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return Handler
+
+    def _remember(self, update_id):
+        # Telegram повторяет обновление, если не дождался ответа: второй раз его не обрабатываем
+        with self._lock:
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._seen[update_id] = True
+            if len(self._seen) > self.SEEN_LIMIT:
+                self._seen.popitem(last=False)
+            return True
+
+    def _forget(self, update_id):
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+    def accept(self, request):
+        if request.path != self.path:
+            return 404
+        if self.secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            return 403
+        if self._draining:
+            return 503
+        try:
+            length = int(request.headers.get('Content-Length') or 0)
+            update = types.Update.de_json(request.rfile.read(length).decode('utf-8'))
+        except Exception:
+            return 400
+        if not self._remember(update.update_id):
+            return 200
+        if not self._slots.acquire(timeout=5):
+            self._forget(update.update_id)
+            return 503
+        # Пока ждали слот, мог начаться drain: после остановки executor обновление потерялось бы,
+        # хотя Telegram получил бы 200. Проверка и submit — под тем же замком, что и начало drain
+        with self._lock:
+            if not self._draining:
+                self._executor.submit(update, self._slots.release)
+                return 200
+        self._slots.release()
+        self._forget(update.update_id)
+        return 503
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        # Можно звать из обработчика сигнала: shutdown() ждёт serve_forever, поэтому в отдельном потоке
+        threading.Thread(target=self._httpd.shutdown).start()
+
+    def drain(self):
+        # Новые обновления получают 503 (Telegram пришлёт их позже), принятые — дорабатываются
+        with self._lock:
+            self._draining = True
+        self._httpd.shutdown()
+        self._executor.shutdown()
+        self._httpd.server_close()
+
+def run_webhook(workers=WORKERS):
+    path = urlparse(WEBHOOK_URL).path or '/'
+    bot.threaded = False
+    server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, path, WEBHOOK_SECRET, workers)
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                    max_connections=min(workers, 100))
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.drain()
+
 # === Запуск ===
+def run_cli(args):
+    # python main.py export [файл] | python main.py import файл
+    command = args[0]
+    if command == 'export':
+        if len(args) > 1:
+            with open(args[1], 'w', encoding='utf-8') as f:
+                count = export_ndjson(f)
+        else:
+            count = export_ndjson(sys.stdout)
+        print(f"Выгружено записей: {count}", file=sys.stderr)
+    elif command == 'import' and len(args) > 1:
+        with open(args[1], 'r', encoding='utf-8') as f:
+            counts = import_ndjson(f)
+        print(f"Импортировано: {counts}", file=sys.stderr)
+    else:
+        exit("Использование: python main.py export [файл] | python main.py import файл")
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+        sys.exit()
     print("Бот запущен: настройки из config.json")
-    bot.infinity_polling()
\ No newline at end of file
+    view_counter.start()
+    reminder_scheduler.start()
+    # systemctl stop и docker stop шлют SIGTERM: завершаемся как по Ctrl+C, чтобы отработали finally
+    # и atexit — дописать просмотры и закрыть базы. Режим webhook ставит свой обработчик
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if METRICS_PORT:
+        MetricsServer(METRICS_LISTEN, METRICS_PORT).start()
+    if RUN_MODE == 'async':
+        run_async()
+    elif RUN_MODE == 'webhook':
+        run_webhook()
+    else:
+        run_polling()
@@ -0,0 +1,967 @@
+"""Хранилище бота: подключения к SQLite, схема баз и репозитории.
+
+Модуль ничего не делает при импорте: базы открывает и схему создаёт вызывающий код,
+поэтому репозитории можно использовать и замерять отдельно от бота.
+"""
+import sqlite3
+import json
+import re
+import threading
+import time
+import weakref
+from datetime import datetime, timezone, timedelta
+from contextlib import contextmanager
+
+# === ПОДКЛЮЧЕНИЯ К БД ===
+class _ThreadConnection:
+    """Соединение потока в threading.local: когда поток завершается, объект удаляется
+    вместе с его данными, и финализатор закрывает соединение."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+class Database:
+    """Долгоживущие соединения с одной БД: по одному на поток, в режиме WAL."""
+
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-16000',
+        'PRAGMA mmap_size=134217728',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA busy_timeout=5000',
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def connection(self):
+        holder = getattr(self._local, 'conn', None)
+        if holder is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            holder = self._local.conn = _ThreadConnection(conn)
+            # Короткоживущие потоки (HTTP-запросы, таймеры) не должны копить открытые соединения
+            weakref.finalize(holder, self._release, conn)
+            with self._lock:
+                self._connections.append(conn)
+        return holder.conn
+
+    def _release(self, conn):
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        # Коммит при успешном выходе, откат при исключении.
+        # immediate=True сразу берёт блокировку на запись: для чтения с последующей записью
+        conn = self.connection()
+        with conn:
+            cursor = conn.cursor()
+            if immediate:
+                cursor.execute('BEGIN IMMEDIATE')
+            yield cursor
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+# === СРОКИ СДАЧИ ===
+LOCAL_TZ = timezone(timedelta(hours=3))
+DUE_RELATIVE = {'сегодня': 0, 'завтра': 1, 'послезавтра': 2}
+DUE_WEEKDAYS = {
+    'пн': 0, 'понедельник': 0, 'понедельника': 0, 'понедельнику': 0,
+    'вт': 1, 'вторник': 1, 'вторника': 1, 'вторнику': 1,
+    'ср': 2, 'среда': 2, 'среду': 2, 'среды': 2, 'среде': 2,
+    'чт': 3, 'четверг': 3, 'четверга': 3, 'четвергу': 3,
+    'пт': 4, 'пятница': 4, 'пятницу': 4, 'пятницы': 4, 'пятнице': 4,
+    'сб': 5, 'суббота': 5, 'субботу': 5, 'субботы': 5, 'субботе': 5,
+    'вс': 6, 'воскресенье': 6, 'воскресенья': 6, 'воскресенью': 6,
+}
+DUE_ISO_RE = re.compile(r'(?<!\d)(\d{4})-(\d{1,2})-(\d{1,2})(?!\d)')
+DUE_DATE_RE = re.compile(r'(?<![\d.])(\d{1,2})[./](\d{1,2})(?:[./](\d{4}|\d{2}))?(?![\d])')
+DUE_TIME_RE = re.compile(r'(\d{1,2}):(\d{2})')
+DUE_BEFORE_RE = re.compile(r'\bдо\b')
+
+def _nearest_day(today, month, day):
+    # Год не указан: ближайшая к сегодняшнему дню дата — и вперёд, и назад. При равенстве — будущая
+    candidates = []
+    for year in (today.year - 1, today.year, today.year + 1):
+        try:
+            candidates.append(datetime(year, month, day))
+        except ValueError:
+            pass
+    return min(candidates, key=lambda d: (abs(d - today), d < today), default=None)
+
+def _due_mentions(lowered, today):
+    # Все упоминания дня в тексте как (позиция, день); несуществующие даты вроде 31.02 пропускаются
+    mentions = []
+    for m in DUE_ISO_RE.finditer(lowered):
+        try:
+            mentions.append((m.start(), datetime(int(m[1]), int(m[2]), int(m[3]))))
+        except ValueError:
+            pass
+    for m in DUE_DATE_RE.finditer(lowered):
+        d, month, year = int(m[1]), int(m[2]), m[3]
+        try:
+            day = datetime(int(year) + (2000 if len(year) == 2 else 0), month, d) if year else _nearest_day(today, month, d)
+        except ValueError:
+            day = None
+        if day:
+            mentions.append((m.start(), day))
+    for m in re.finditer(r'[а-яё]+', lowered):
+        word = m[0]
+        if word in DUE_RELATIVE:
+            mentions.append((m.start(), today + timedelta(days=DUE_RELATIVE[word])))
+        elif word in DUE_WEEKDAYS:
+            mentions.append((m.start(), today + timedelta(days=(DUE_WEEKDAYS[word] - today.weekday()) % 7)))
+    return sorted(mentions)
+
+def parse_due_date(text, now=None):
+    # Срок сдачи из свободного текста как момент времени (epoch) или None, если дату не узнать.
+    # Понимает ГГГГ-ММ-ДД, дд.мм, дд.мм.гг(гг), «сегодня», «завтра», «послезавтра» и дни недели,
+    # а также время чч:мм; без времени срок — конец дня. Год для дд.мм — ближайший к сегодня.
+    # Если дат несколько («упр 5.3, до 12.01»), срок — первая после «до», иначе последняя
+    if not text:
+        return None
+    now = now or datetime.now(LOCAL_TZ)
+    today = datetime(now.year, now.month, now.day)
+    lowered = text.strip().lower()
+    mentions = _due_mentions(lowered, today)
+    if not mentions:
+        return None
+    day = mentions[-1][1]
+    for before in reversed([m.end() for m in DUE_BEFORE_RE.finditer(lowered)]):
+        following = [mention for mention in mentions if mention[0] >= before]
+        if following:
+            day = following[0][1]
+            break
+    clock = DUE_TIME_RE.search(lowered)
+    if clock and int(clock[1]) < 24 and int(clock[2]) < 60:
+        moment = day.replace(hour=int(clock[1]), minute=int(clock[2]))
+    else:
+        moment = day + timedelta(days=1, seconds=-1)
+    return int(moment.replace(tzinfo=LOCAL_TZ).timestamp())
+
+def due_reference(created_at):
+    # Относительные сроки («завтра») в старых записях отсчитываются от даты добавления
+    try:
+        return datetime.strptime(created_at, '%Y-%m-%d %H:%M').replace(tzinfo=LOCAL_TZ)
+    except (TypeError, ValueError):
+        return None
+
+# === БАЗЫ ДАННЫХ ===
+ATTACHMENT_KINDS = ('photo', 'video', 'audio', 'file')
+
+def _add_attachment_count_columns(c, table, columns):
+    # Число вложений хранится числом, чтобы список не разбирал JSON
+    for kind in ATTACHMENT_KINDS:
+        if f'{kind}_count' not in columns:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {kind}_count INTEGER NOT NULL DEFAULT 0')
+            c.execute(f'UPDATE {table} SET {kind}_count = COALESCE(json_array_length({kind}_file_ids), 0)')
+
+def _init_attachments(c, table, owner_type):
+    # Вложения хранятся строками отдельной таблицы, а не JSON-массивами в колонках владельца
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_type TEXT NOT NULL,
+            owner_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            position INTEGER NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_attachments_owner ON attachments(owner_type, owner_id, kind, position)')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_attachments_delete AFTER DELETE ON {table} BEGIN
+            DELETE FROM attachments WHERE owner_type = '{owner_type}' AND owner_id = OLD.id;
+        END
+    ''')
+    # Миграция: перенести оставшиеся JSON-массивы в таблицу и очистить колонки.
+    # Выполняется при каждом запуске и трогает только ещё не перенесённые строки.
+    for kind in ATTACHMENT_KINDS:
+        c.execute(f'''
+            INSERT INTO attachments (owner_type, owner_id, kind, file_id, position)
+            SELECT '{owner_type}', t.id, '{kind}', j.value, j.key
+            FROM {table} t, json_each(t.{kind}_file_ids) j
+            WHERE t.{kind}_file_ids IS NOT NULL
+        ''')
+        c.execute(f'UPDATE {table} SET {kind}_file_ids = NULL WHERE {kind}_file_ids IS NOT NULL')
+
+def _create_fts_row_triggers(c, fts_table, table, fields):
+    # Построчная синхронизация индекса при вставке и удалении
+    columns = ', '.join(fields)
+    new_values = ', '.join(f'NEW.{f}' for f in fields)
+    old_values = ', '.join(f'OLD.{f}' for f in fields)
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts_table} (rowid, {columns}) VALUES (NEW.id, {new_values});
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts_table} ({fts_table}, rowid, {columns}) VALUES ('delete', OLD.id, {old_values});
+        END
+    ''')
+
+def _bulk_replace_indexed(c, fts_table, table, fields, replaced_ids, insert):
+    # Пакетная замена строк: вместо построчных триггеров индекс обновляется двумя запросами —
+    # до удаления строк с replaced_ids и после вставки (insert() удаляет, вставляет и возвращает id).
+    # Только внутри transaction(immediate=True): иначе DROP TRIGGER выполнится вне транзакции
+    # и другие соединения увидят таблицу без триггеров
+    columns = ', '.join(fields)
+    c.execute(f'''
+        INSERT INTO {fts_table} ({fts_table}, rowid, {columns})
+        SELECT 'delete', id, {columns} FROM {table} WHERE id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(replaced_ids),))
+    c.execute(f'DROP TRIGGER IF EXISTS trg_{fts_table}_insert')
+    c.execute(f'DROP TRIGGER IF EXISTS trg_{fts_table}_delete')
+    ids = insert()
+    c.execute(f'''
+        INSERT INTO {fts_table} (rowid, {columns})
+        SELECT id, {columns} FROM {table} WHERE id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(ids),))
+    _create_fts_row_triggers(c, fts_table, table, fields)
+
+def _init_fts(c, fts_table, table, fields, rank):
+    # Полнотекстовый индекс FTS5 поверх таблицы; триггеры держат его в синхронизации
+    c.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (fts_table,))
+    exists = c.fetchone()
+    columns = ', '.join(fields)
+    new_values = ', '.join(f'NEW.{f}' for f in fields)
+    old_values = ', '.join(f'OLD.{f}' for f in fields)
+    c.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+            {columns}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    _create_fts_row_triggers(c, fts_table, table, fields)
+    # Только изменения текста: счётчики и просмотры индекс не трогают
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{fts_table}_update AFTER UPDATE OF {columns} ON {table} BEGIN
+            INSERT INTO {fts_table} ({fts_table}, rowid, {columns}) VALUES ('delete', OLD.id, {old_values});
+            INSERT INTO {fts_table} (rowid, {columns}) VALUES (NEW.id, {new_values});
+        END
+    ''')
+    if not exists:
+        c.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+        c.execute(f"INSERT INTO {fts_table} ({fts_table}, rank) VALUES ('rank', ?)", (rank,))
+
+def init_notes_db(db):
+    with db.transaction() as c:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS notes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                content TEXT NOT NULL,
+                photo_file_ids TEXT,
+                video_file_ids TEXT,
+                audio_file_ids TEXT,
+                file_file_ids TEXT,
+                created_at TEXT,
+                creator_username TEXT,
+                views INTEGER DEFAULT 0
+            )
+        ''')
+        c.execute("PRAGMA table_info(notes)")
+        columns = [info[1] for info in c.fetchall()]
+        if 'photo_file_ids' not in columns:
+            c.execute('ALTER TABLE notes ADD COLUMN photo_file_ids TEXT')
+        if 'video_file_ids' not in columns:
+            c.execute('ALTER TABLE notes ADD COLUMN video_file_ids TEXT')
+        if 'audio_file_ids' not in columns:
+            c.execute('ALTER TABLE notes ADD COLUMN audio_file_ids TEXT')
+        if 'file_file_ids' not in columns:
+            c.execute('ALTER TABLE notes ADD COLUMN file_file_ids TEXT')
+        if 'creator_username' not in columns:
+            c.execute('ALTER TABLE notes ADD COLUMN creator_username TEXT')
+        if 'views' not in columns:
+            c.execute('ALTER TABLE notes ADD COLUMN views INTEGER DEFAULT 0')
+        _add_attachment_count_columns(c, 'notes', columns)
+        # Денормализованные счётчики реакций и комментариев
+        counters_missing = 'likes' not in columns
+        if counters_missing:
+            c.execute('ALTER TABLE notes ADD COLUMN likes INTEGER NOT NULL DEFAULT 0')
+            c.execute('ALTER TABLE notes ADD COLUMN dislikes INTEGER NOT NULL DEFAULT 0')
+            c.execute('ALTER TABLE notes ADD COLUMN comments_count INTEGER NOT NULL DEFAULT 0')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS reactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                note_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                reaction INTEGER NOT NULL,
+                UNIQUE(note_id, user_id)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS comments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                note_id INTEGER NOT NULL,
+                user_identifier TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TEXT
+            )
+        ''')
+        _init_attachments(c, 'notes', 'note')
+        # Индекс для постраничного списка: первая заметка каждого заголовка
+        c.execute('CREATE INDEX IF NOT EXISTS idx_notes_title ON notes(title, id)')
+        # Индексы для подсчёта реакций и комментариев по заметке
+        c.execute('CREATE INDEX IF NOT EXISTS idx_reactions_note ON reactions(note_id, reaction)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_comments_note ON comments(note_id, id)')
+        # Поиск: совпадение в заголовке весит больше, чем в тексте
+        _init_fts(c, 'notes_fts', 'notes', ('title', 'content'), 'bm25(10.0, 1.0)')
+        _init_fts(c, 'comments_fts', 'comments', ('content',), 'bm25()')
+        if counters_missing:
+            # Миграция: заполнить счётчики по уже накопленным данным
+            c.execute('''
+                UPDATE notes SET
+                    likes = (SELECT COUNT(*) FROM reactions WHERE note_id = notes.id AND reaction = 1),
+                    dislikes = (SELECT COUNT(*) FROM reactions WHERE note_id = notes.id AND reaction = -1),
+                    comments_count = (SELECT COUNT(*) FROM comments WHERE note_id = notes.id)
+            ''')
+        # Триггеры держат счётчики в той же транзакции, что и запись реакции/комментария
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_reactions_insert AFTER INSERT ON reactions BEGIN
+                UPDATE notes SET likes = likes + (NEW.reaction = 1), dislikes = dislikes + (NEW.reaction = -1)
+                WHERE id = NEW.note_id;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_reactions_delete AFTER DELETE ON reactions BEGIN
+                UPDATE notes SET likes = likes - (OLD.reaction = 1), dislikes = dislikes - (OLD.reaction = -1)
+                WHERE id = OLD.note_id;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_reactions_update AFTER UPDATE OF reaction ON reactions BEGIN
+                UPDATE notes SET likes = likes - (OLD.reaction = 1) + (NEW.reaction = 1),
+                                 dislikes = dislikes - (OLD.reaction = -1) + (NEW.reaction = -1)
+                WHERE id = NEW.note_id;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_comments_insert AFTER INSERT ON comments BEGIN
+                UPDATE notes SET comments_count = comments_count + 1 WHERE id = NEW.note_id;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_comments_delete AFTER DELETE ON comments BEGIN
+                UPDATE notes SET comments_count = comments_count - 1 WHERE id = OLD.note_id;
+            END
+        ''')
+
+def init_hw_db(db):
+    with db.transaction() as c:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS homework (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                subject TEXT NOT NULL,
+                task TEXT NOT NULL,
+                due_date TEXT,
+                photo_file_ids TEXT,
+                video_file_ids TEXT,
+                audio_file_ids TEXT,
+                file_file_ids TEXT,
+                created_at TEXT,
+                creator_username TEXT
+            )
+        ''')
+        c.execute("PRAGMA table_info(homework)")
+        columns = [info[1] for info in c.fetchall()]
+        if 'photo_file_ids' not in columns:
+            c.execute('ALTER TABLE homework ADD COLUMN photo_file_ids TEXT')
+        if 'video_file_ids' not in columns:
+            c.execute('ALTER TABLE homework ADD COLUMN video_file_ids TEXT')
+        if 'audio_file_ids' not in columns:
+            c.execute('ALTER TABLE homework ADD COLUMN audio_file_ids TEXT')
+        if 'file_file_ids' not in columns:
+            c.execute('ALTER TABLE homework ADD COLUMN file_file_ids TEXT')
+        if 'creator_username' not in columns:
+            c.execute('ALTER TABLE homework ADD COLUMN creator_username TEXT')
+        _add_attachment_count_columns(c, 'homework', columns)
+        if 'due_at' not in columns:
+            # Разобранный срок сдачи; исходный текст остаётся в due_date для показа
+            c.execute('ALTER TABLE homework ADD COLUMN due_at INTEGER')
+            c.execute('SELECT id, due_date, created_at FROM homework WHERE due_date IS NOT NULL')
+            c.executemany('UPDATE homework SET due_at = ? WHERE id = ?',
+                          [(parse_due_date(due, due_reference(created_at)), hw_id) for hw_id, due, created_at in c.fetchall()])
+        c.execute('CREATE INDEX IF NOT EXISTS idx_homework_subject ON homework(subject, id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_homework_due ON homework(due_at, id)')
+        c.execute('CREATE TABLE IF NOT EXISTS reminder_subscribers (user_id INTEGER PRIMARY KEY, subscribed_at TEXT)')
+        # Докуда дошла рассылка напоминаний: событие (время, ДЗ) и последний получивший его пользователь
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS reminder_cursor (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                fire_at INTEGER NOT NULL,
+                hw_id INTEGER NOT NULL,
+                user_id INTEGER
+            )
+        ''')
+        _init_attachments(c, 'homework', 'hw')
+        _init_fts(c, 'homework_fts', 'homework', ('subject', 'task'), 'bm25(5.0, 1.0)')
+
+def init_state_db(db):
+    with db.transaction() as c:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS dialog_state (
+                namespace TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, user_id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_dialog_state_updated ON dialog_state(namespace, updated_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_dialog_state_expires ON dialog_state(expires_at)')
+
+# === РЕПОЗИТОРИИ ===
+# Весь SQL живёт здесь: обработчики работают только через методы репозиториев.
+
+def _save_attachments(c, owner_type, owner_id, photos, videos, audios, files):
+    rows = []
+    for kind, ids in zip(ATTACHMENT_KINDS, (photos, videos, audios, files)):
+        rows += [(owner_type, owner_id, kind, file_id, position) for position, file_id in enumerate(ids)]
+    c.executemany('INSERT INTO attachments (owner_type, owner_id, kind, file_id, position) VALUES (?, ?, ?, ?, ?)', rows)
+
+def _load_attachments(c, owner_type, owner_id):
+    # Возвращает списки file_id в порядке ATTACHMENT_KINDS: фото, видео, аудио, файлы
+    found = {kind: [] for kind in ATTACHMENT_KINDS}
+    c.execute('SELECT kind, file_id FROM attachments WHERE owner_type = ? AND owner_id = ? ORDER BY kind, position', (owner_type, owner_id))
+    for kind, file_id in c.fetchall():
+        found[kind].append(file_id)
+    return tuple(found[kind] for kind in ATTACHMENT_KINDS)
+
+def _load_attachments_range(c, owner_type, first_id, last_id):
+    # Вложения сразу для диапазона владельцев: {owner_id: {'photos': [...], 'videos': [...], ...}}
+    found = {}
+    c.execute('''
+        SELECT owner_id, kind, file_id FROM attachments
+        WHERE owner_type = ? AND owner_id BETWEEN ? AND ? ORDER BY owner_id, kind, position
+    ''', (owner_type, first_id, last_id))
+    for owner_id, kind, file_id in c.fetchall():
+        lists = found.setdefault(owner_id, {f'{k}s': [] for k in ATTACHMENT_KINDS})
+        lists[f'{kind}s'].append(file_id)
+    return found
+
+def _attachment_rows(owner_type, owner_id, row):
+    # Строки таблицы attachments для записи выгрузки с полями photos/videos/audios/files
+    return [(owner_type, owner_id, kind, file_id, position)
+            for kind in ATTACHMENT_KINDS
+            for position, file_id in enumerate(row.get(f'{kind}s') or [])]
+
+def _attachment_counts(row):
+    return tuple(len(row.get(f'{kind}s') or []) for kind in ATTACHMENT_KINDS)
+
+PREFIX_MIN_LENGTH = 3
+
+def build_fts_query(text, prefix=False):
+    # Слова ищутся целиком; с prefix=True последнее — ещё и как префикс: его могли не дописать.
+    # Короткий префикс совпадает с тысячами документов, поэтому только от PREFIX_MIN_LENGTH букв.
+    # Кавычки защищают от синтаксиса FTS5
+    words = re.findall(r'\w+', text)
+    terms = [f'"{w}"' for w in words]
+    if prefix and words and len(words[-1]) >= PREFIX_MIN_LENGTH:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+class CachedCount:
+    """Число, которое дорого пересчитывать на каждый показ списка. Запись в этом процессе
+    сбрасывает его сразу, запись из другого процесса (импорт из консоли) видна через ttl секунд."""
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._value = None
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, load):
+        with self._lock:
+            if self._value is not None and self._expires_at > time.monotonic():
+                return self._value
+            generation = self._generation
+        value = load()
+        with self._lock:
+            # Пока считали, была запись: результат мог устареть и в кэш не попадает
+            if generation == self._generation:
+                self._value = value
+                self._expires_at = time.monotonic() + self.ttl
+        return value
+
+    def invalidate(self):
+        # Вызывать после коммита записи
+        with self._lock:
+            self._generation += 1
+            self._value = None
+
+class NotesRepository:
+    def __init__(self, db):
+        self.db = db
+        self._title_count = CachedCount()
+
+    def count_titles(self):
+        return self._title_count.get(self._count_titles)
+
+    def _count_titles(self):
+        with self.db.transaction() as c:
+            c.execute('SELECT COUNT(DISTINCT title) FROM notes')
+            return c.fetchone()[0]
+
+    def list_titles_page(self, offset, limit):
+        # Первая (минимальная по id) заметка каждого заголовка; обход идёт по первичному ключу
+        # и останавливается на offset + limit строках, проверка заголовка идёт по idx_notes_title
+        with self.db.transaction() as c:
+            c.execute('''
+                SELECT title, id, photo_count, video_count, audio_count, file_count FROM notes n
+                WHERE NOT EXISTS (SELECT 1 FROM notes d WHERE d.title = n.title AND d.id < n.id)
+                ORDER BY id LIMIT ? OFFSET ?
+            ''', (limit, offset))
+            return c.fetchall()
+
+    def get_details(self, note_id):
+        # Счётчики хранятся в самой заметке, поэтому чтение не зависит от числа реакций
+        with self.db.transaction() as c:
+            c.execute('''
+                SELECT id, title, content, created_at, creator_username, views, likes, dislikes, comments_count
+                FROM notes WHERE id = ?
+            ''', (note_id,))
+            row = c.fetchone()
+            if not row:
+                return None
+            photos, videos, audios, files = _load_attachments(c, 'note', note_id)
+        return (row[0], row[1], row[2], photos, videos, audios, files,
+                row[3], row[4], row[5], row[6], row[7], row[8])
+
+    def search(self, match, limit):
+        # Совпадения в заметках и в комментариях к ним; у заметки остаётся лучший ранг
+        with self.db.transaction() as c:
+            c.execute('''
+                SELECT n.id, n.title, snippet(notes_fts, 1, '', '', '…', 10), rank
+                FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid
+                WHERE notes_fts MATCH ? ORDER BY rank LIMIT ?
+            ''', (match, limit))
+            rows = c.fetchall()
+            c.execute('''
+                SELECT n.id, n.title, snippet(comments_fts, 0, '', '', '…', 10), rank
+                FROM comments_fts JOIN comments cm ON cm.id = comments_fts.rowid JOIN notes n ON n.id = cm.note_id
+                WHERE comments_fts MATCH ? ORDER BY rank LIMIT ?
+            ''', (match, limit))
+            rows += c.fetchall()
+        best = {}
+        for row in rows:
+            if row[0] not in best or row[3] < best[row[0]][3]:
+                best[row[0]] = row
+        return sorted(best.values(), key=lambda r: r[3])[:limit]
+
+    def get_title(self, note_id):
+        with self.db.transaction() as c:
+            c.execute('SELECT title FROM notes WHERE id = ?', (note_id,))
+            row = c.fetchone()
+        return row[0] if row else None
+
+    def get_title_and_content(self, note_id):
+        with self.db.transaction() as c:
+            c.execute('SELECT title, content FROM notes WHERE id = ?', (note_id,))
+            return c.fetchone()
+
+    def add_views(self, increments):
+        # increments: пары (note_id, сколько добавить)
+        with self.db.transaction() as c:
+            c.executemany('UPDATE notes SET views = views + ? WHERE id = ?', [(n, note_id) for note_id, n in increments])
+
+    def replace(self, title, content, photos, videos, audios, files, created_at, creator_identifier):
+        # Заметка с тем же заголовком заменяется новой; возвращает id удалённых строк
+        with self.db.transaction() as c:
+            c.execute('SELECT id FROM notes WHERE title = ?', (title,))
+            deleted = [r[0] for r in c.fetchall()]
+            c.execute('DELETE FROM notes WHERE title = ?', (title,))
+            c.execute('''
+                INSERT INTO notes (title, content, photo_count, video_count, audio_count, file_count, created_at, creator_username)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (title, content, len(photos), len(videos), len(audios), len(files), created_at, creator_identifier))
+            _save_attachments(c, 'note', c.lastrowid, photos, videos, audios, files)
+        self._title_count.invalidate()
+        return deleted
+
+    def update_content(self, title, content):
+        with self.db.transaction() as c:
+            c.execute('SELECT id FROM notes WHERE title = ?', (title,))
+            updated = [r[0] for r in c.fetchall()]
+            c.execute('UPDATE notes SET content = ? WHERE title = ?', (content, title))
+        return updated
+
+    def delete_by_title(self, title):
+        # Реакции и комментарии удаляются вместе с заметками, одной транзакцией
+        with self.db.transaction() as c:
+            c.execute('SELECT id FROM notes WHERE title = ?', (title,))
+            deleted = [r[0] for r in c.fetchall()]
+            c.execute('DELETE FROM reactions WHERE note_id IN (SELECT id FROM notes WHERE title = ?)', (title,))
+            c.execute('DELETE FROM comments WHERE note_id IN (SELECT id FROM notes WHERE title = ?)', (title,))
+            c.execute('DELETE FROM notes WHERE title = ?', (title,))
+        self._title_count.invalidate()
+        return deleted
+
+    def export_notes(self, chunk=1000):
+        # Постранично по id, чтобы не держать всю таблицу в памяти
+        last_id = 0
+        while True:
+            with self.db.transaction() as c:
+                c.execute('''
+                    SELECT id, title, content, created_at, creator_username, views FROM notes
+                    WHERE id > ? ORDER BY id LIMIT ?
+                ''', (last_id, chunk))
+                rows = c.fetchall()
+                if not rows:
+                    return
+                attachments = _load_attachments_range(c, 'note', rows[0][0], rows[-1][0])
+            for note_id, title, content, created_at, creator, views in rows:
+                yield dict({'type': 'note', 'id': note_id, 'title': title, 'content': content,
+                            'created_at': created_at, 'creator': creator, 'views': views},
+                           **attachments.get(note_id, {f'{k}s': [] for k in ATTACHMENT_KINDS}))
+            last_id = rows[-1][0]
+
+    def import_notes(self, rows):
+        # Записи с тем же id заменяются; счётчики реакций и комментариев пересчитывает recount_counters()
+        sql = '''
+            INSERT INTO notes (id, title, content, photo_count, video_count, audio_count, file_count, created_at, creator_username, views)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        def values(r):
+            return (r.get('id'), r['title'], r['content'], *_attachment_counts(r), r.get('created_at'), r.get('creator'), r.get('views') or 0)
+        with_id = [r for r in rows if r.get('id') is not None]
+        replaced = [r['id'] for r in with_id]
+        def insert():
+            c.executemany('DELETE FROM notes WHERE id = ?', [(i,) for i in replaced])
+            c.executemany(sql, [values(r) for r in with_id])
+            ids = list(replaced)
+            attachments = [a for r in with_id for a in _attachment_rows('note', r['id'], r)]
+            for r in rows:
+                if r.get('id') is None:
+                    c.execute(sql, values(r))
+                    ids.append(c.lastrowid)
+                    attachments += _attachment_rows('note', c.lastrowid, r)
+            c.executemany('INSERT INTO attachments (owner_type, owner_id, kind, file_id, position) VALUES (?, ?, ?, ?, ?)', attachments)
+            return ids
+        with self.db.transaction(immediate=True) as c:
+            _bulk_replace_indexed(c, 'notes_fts', 'notes', ('title', 'content'), replaced, insert)
+        self._title_count.invalidate()
+
+    def recount_counters(self):
+        with self.db.transaction() as c:
+            c.execute('''
+                UPDATE notes SET
+                    likes = (SELECT COUNT(*) FROM reactions r WHERE r.note_id = notes.id AND r.reaction = 1),
+                    dislikes = (SELECT COUNT(*) FROM reactions r WHERE r.note_id = notes.id AND r.reaction = -1),
+                    comments_count = (SELECT COUNT(*) FROM comments m WHERE m.note_id = notes.id)
+            ''')
+
+class ReactionsRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def toggle(self, note_id, user_id, target_reaction):
+        # Повторное нажатие снимает реакцию, иначе она ставится или заменяется.
+        # Счётчики в notes обновляют триггеры; возвращает новые (likes, dislikes, comments_count)
+        # или None, если заметки нет
+        with self.db.transaction(immediate=True) as c:
+            c.execute('DELETE FROM reactions WHERE note_id = ? AND user_id = ? AND reaction = ?',
+                      (note_id, user_id, target_reaction))
+            if c.rowcount == 0:
+                c.execute('''
+                    INSERT INTO reactions (note_id, user_id, reaction)
+                    SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM notes WHERE id = ?)
+                    ON CONFLICT(note_id, user_id) DO UPDATE SET reaction = excluded.reaction
+                ''', (note_id, user_id, target_reaction, note_id))
+            c.execute('SELECT likes, dislikes, comments_count FROM notes WHERE id = ?', (note_id,))
+            return c.fetchone()
+
+    def export_reactions(self, chunk=1000):
+        last_id = 0
+        while True:
+            with self.db.transaction() as c:
+                c.execute('SELECT id, note_id, user_id, reaction FROM reactions WHERE id > ? ORDER BY id LIMIT ?', (last_id, chunk))
+                rows = c.fetchall()
+            if not rows:
+                return
+            for _, note_id, user_id, reaction in rows:
+                yield {'type': 'reaction', 'note_id': note_id, 'user_id': user_id, 'reaction': reaction}
+            last_id = rows[-1][0]
+
+    def import_reactions(self, rows):
+        with self.db.transaction() as c:
+            c.executemany('''
+                INSERT INTO reactions (note_id, user_id, reaction) VALUES (?, ?, ?)
+                ON CONFLICT(note_id, user_id) DO UPDATE SET reaction = excluded.reaction
+            ''', [(r['note_id'], r['user_id'], r['reaction']) for r in rows])
+
+class CommentsRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, note_id, user_identifier, content, created_at):
+        with self.db.transaction() as c:
+            c.execute('INSERT INTO comments (note_id, user_identifier, content, created_at) VALUES (?, ?, ?, ?)', (note_id, user_identifier, content, created_at))
+
+    def list_page(self, note_id, after_id=None, before_id=None, limit=50):
+        # Keyset по индексу (note_id, id): комментарии после after_id по возрастанию id
+        # или перед before_id по убыванию — ближайшие к границе страницы идут первыми
+        with self.db.transaction() as c:
+            if before_id is not None:
+                c.execute('''
+                    SELECT id, user_identifier, content, created_at FROM comments
+                    WHERE note_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+                ''', (note_id, before_id, limit))
+            else:
+                c.execute('''
+                    SELECT id, user_identifier, content, created_at FROM comments
+                    WHERE note_id = ? AND id > ? ORDER BY id LIMIT ?
+                ''', (note_id, after_id or 0, limit))
+            return c.fetchall()
+
+    def page_bounds(self, note_id, first_id, last_id):
+        # Сколько комментариев до страницы (для нумерации), есть ли после неё и сколько всего
+        with self.db.transaction() as c:
+            c.execute('''
+                SELECT (SELECT COUNT(*) FROM comments WHERE note_id = ? AND id < ?),
+                       EXISTS (SELECT 1 FROM comments WHERE note_id = ? AND id > ?),
+                       (SELECT comments_count FROM notes WHERE id = ?)
+            ''', (note_id, first_id, note_id, last_id, note_id))
+            before, has_after, total = c.fetchone()
+        return before, bool(has_after), total or 0
+
+    def export_comments(self, chunk=1000):
+        last_id = 0
+        while True:
+            with self.db.transaction() as c:
+                c.execute('SELECT id, note_id, user_identifier, content, created_at FROM comments WHERE id > ? ORDER BY id LIMIT ?', (last_id, chunk))
+                rows = c.fetchall()
+            if not rows:
+                return
+            for comment_id, note_id, user, content, created_at in rows:
+                yield {'type': 'comment', 'id': comment_id, 'note_id': note_id, 'user': user, 'content': content, 'created_at': created_at}
+            last_id = rows[-1][0]
+
+    def import_comments(self, rows):
+        sql = 'INSERT INTO comments (id, note_id, user_identifier, content, created_at) VALUES (?, ?, ?, ?, ?)'
+        def values(r):
+            return (r.get('id'), r['note_id'], r['user'], r['content'], r.get('created_at'))
+        with_id = [r for r in rows if r.get('id') is not None]
+        replaced = [r['id'] for r in with_id]
+        def insert():
+            c.executemany('DELETE FROM comments WHERE id = ?', [(i,) for i in replaced])
+            c.executemany(sql, [values(r) for r in with_id])
+            ids = list(replaced)
+            for r in rows:
+                if r.get('id') is None:
+                    c.execute(sql, values(r))
+                    ids.append(c.lastrowid)
+            return ids
+        with self.db.transaction(immediate=True) as c:
+            _bulk_replace_indexed(c, 'comments_fts', 'comments', ('content',), replaced, insert)
+
+class HomeworkRepository:
+    def __init__(self, db):
+        self.db = db
+        self._subject_count = CachedCount()
+
+    # Виды списка предметов: (условие на срок, порядок). Сравнения идут по индексу (due_at, id)
+    VIEWS = {
+        'all': ('', 'id'),
+        'due': ('', 'due_at IS NULL, due_at, id'),
+        'week': ('AND due_at >= :now AND due_at < :now + 7 * 86400', 'due_at, id'),
+        'overdue': ('AND due_at < :now', 'due_at DESC, id DESC'),
+    }
+    FIRST_OF_SUBJECT = 'NOT EXISTS (SELECT 1 FROM homework d WHERE d.subject = h.subject AND d.id < h.id)'
+
+    def count_subjects(self, view='all', now=None):
+        # Кэшируется только полный список: остальные зависят от текущего времени
+        if view != 'all':
+            with self.db.transaction() as c:
+                c.execute(f'SELECT COUNT(*) FROM homework h WHERE {self.FIRST_OF_SUBJECT} {self.VIEWS[view][0]}',
+                          {'now': int(now or time.time())})
+                return c.fetchone()[0]
+        return self._subject_count.get(self._count_subjects)
+
+    def _count_subjects(self):
+        with self.db.transaction() as c:
+            c.execute('SELECT COUNT(DISTINCT subject) FROM homework')
+            return c.fetchone()[0]
+
+    def list_subjects_page(self, offset, limit, view='all', now=None):
+        condition, order = self.VIEWS[view]
+        with self.db.transaction() as c:
+            c.execute(f'''
+                SELECT subject, id, photo_count, video_count, audio_count, file_count, due_date, due_at FROM homework h
+                WHERE {self.FIRST_OF_SUBJECT} {condition}
+                ORDER BY {order} LIMIT :limit OFFSET :offset
+            ''', {'limit': limit, 'offset': offset, 'now': int(now or time.time())})
+            return c.fetchall()
+
+    def get_details(self, hw_id):
+        with self.db.transaction() as c:
+            c.execute('SELECT id, subject, task, due_date, created_at, creator_username FROM homework WHERE id = ?', (hw_id,))
+            row = c.fetchone()
+            if not row:
+                return None
+            photos, videos, audios, files = _load_attachments(c, 'hw', hw_id)
+        return (row[0], row[1], row[2], row[3], photos, videos, audios, files, row[4], row[5])
+
+    def search(self, match, limit):
+        with self.db.transaction() as c:
+            c.execute('''
+                SELECT h.id, h.subject, snippet(homework_fts, 1, '', '', '…', 10), rank
+                FROM homework_fts JOIN homework h ON h.id = homework_fts.rowid
+                WHERE homework_fts MATCH ? ORDER BY rank LIMIT ?
+            ''', (match, limit))
+            return c.fetchall()
+
+    def get_subject(self, hw_id):
+        with self.db.transaction() as c:
+            c.execute('SELECT subject FROM homework WHERE id = ?', (hw_id,))
+            row = c.fetchone()
+        return row[0] if row else None
+
+    def get_for_edit(self, hw_id):
+        with self.db.transaction() as c:
+            c.execute('SELECT subject, task, due_date FROM homework WHERE id = ?', (hw_id,))
+            return c.fetchone()
+
+    def replace(self, subject, task, due_date, photos, videos, audios, files, created_at, creator_identifier):
+        with self.db.transaction() as c:
+            c.execute('SELECT id FROM homework WHERE subject = ?', (subject,))
+            deleted = [r[0] for r in c.fetchall()]
+            c.execute('DELETE FROM homework WHERE subject = ?', (subject,))
+            c.execute('''
+                INSERT INTO homework (subject, task, due_date, due_at, photo_count, video_count, audio_count, file_count, created_at, creator_username)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (subject, task, due_date, parse_due_date(due_date), len(photos), len(videos), len(audios), len(files), created_at, creator_identifier))
+            _save_attachments(c, 'hw', c.lastrowid, photos, videos, audios, files)
+        self._subject_count.invalidate()
+        return deleted
+
+    def update_task(self, subject, task, due_date):
+        with self.db.transaction() as c:
+            c.execute('SELECT id FROM homework WHERE subject = ?', (subject,))
+            updated = [r[0] for r in c.fetchall()]
+            c.execute('UPDATE homework SET task = ?, due_date = ?, due_at = ? WHERE subject = ?',
+                      (task, due_date, parse_due_date(due_date), subject))
+        return updated
+
+    def delete_by_subject(self, subject):
+        with self.db.transaction() as c:
+            c.execute('SELECT id FROM homework WHERE subject = ?', (subject,))
+            deleted = [r[0] for r in c.fetchall()]
+            c.execute('DELETE FROM homework WHERE subject = ?', (subject,))
+        self._subject_count.invalidate()
+        return deleted
+
+    def export_homework(self, chunk=1000):
+        last_id = 0
+        while True:
+            with self.db.transaction() as c:
+                c.execute('''
+                    SELECT id, subject, task, due_date, created_at, creator_username FROM homework
+                    WHERE id > ? ORDER BY id LIMIT ?
+                ''', (last_id, chunk))
+                rows = c.fetchall()
+                if not rows:
+                    return
+                attachments = _load_attachments_range(c, 'hw', rows[0][0], rows[-1][0])
+            for hw_id, subject, task, due_date, created_at, creator in rows:
+                yield dict({'type': 'homework', 'id': hw_id, 'subject': subject, 'task': task, 'due_date': due_date,
+                            'created_at': created_at, 'creator': creator},
+                           **attachments.get(hw_id, {f'{k}s': [] for k in ATTACHMENT_KINDS}))
+            last_id = rows[-1][0]
+
+    def import_homework(self, rows):
+        sql = '''
+            INSERT INTO homework (id, subject, task, due_date, due_at, photo_count, video_count, audio_count, file_count, created_at, creator_username)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        def values(r):
+            due_at = parse_due_date(r.get('due_date'), due_reference(r.get('created_at')))
+            return (r.get('id'), r['subject'], r['task'], r.get('due_date'), due_at, *_attachment_counts(r), r.get('created_at'), r.get('creator'))
+        with_id = [r for r in rows if r.get('id') is not None]
+        replaced = [r['id'] for r in with_id]
+        def insert():
+            c.executemany('DELETE FROM homework WHERE id = ?', [(i,) for i in replaced])
+            c.executemany(sql, [values(r) for r in with_id])
+            ids = list(replaced)
+            attachments = [a for r in with_id for a in _attachment_rows('hw', r['id'], r)]
+            for r in rows:
+                if r.get('id') is None:
+                    c.execute(sql, values(r))
+                    ids.append(c.lastrowid)
+                    attachments += _attachment_rows('hw', c.lastrowid, r)
+            c.executemany('INSERT INTO attachments (owner_type, owner_id, kind, file_id, position) VALUES (?, ?, ?, ?, ?)', attachments)
+            return ids
+        with self.db.transaction(immediate=True) as c:
+            _bulk_replace_indexed(c, 'homework_fts', 'homework', ('subject', 'task'), replaced, insert)
+        self._subject_count.invalidate()
+
+class RemindersRepository:
+    def __init__(self, db):
+        self.db = db
+
+    def subscribe(self, user_id):
+        with self.db.transaction() as c:
+            c.execute('INSERT OR IGNORE INTO reminder_subscribers (user_id, subscribed_at) VALUES (?, ?)',
+                      (user_id, datetime.now().strftime('%Y-%m-%d %H:%M')))
+            return c.rowcount == 1
+
+    def unsubscribe(self, user_id):
+        with self.db.transaction() as c:
+            c.execute('DELETE FROM reminder_subscribers WHERE user_id = ?', (user_id,))
+            return c.rowcount == 1
+
+    def unsubscribe_many(self, user_ids):
+        with self.db.transaction() as c:
+            c.executemany('DELETE FROM reminder_subscribers WHERE user_id = ?', [(u,) for u in user_ids])
+
+    def count_subscribers(self):
+        with self.db.transaction() as c:
+            c.execute('SELECT COUNT(*) FROM reminder_subscribers')
+            return c.fetchone()[0]
+
+    def subscribers_page(self, after_user_id, limit):
+        with self.db.transaction() as c:
+            c.execute('SELECT user_id FROM reminder_subscribers WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                      (after_user_id, limit))
+            return [r[0] for r in c.fetchall()]
+
+    def upcoming(self, after_fire_at, after_hw_id, until, lead, limit):
+        # События «за lead секунд до срока» строго после курсора и не позже until — по индексу (due_at, id)
+        with self.db.transaction() as c:
+            c.execute(f'''
+                SELECT due_at - :lead, id FROM homework h
+                WHERE (due_at, id) > (:fire_at + :lead, :hw_id) AND due_at <= :until + :lead
+                  AND {HomeworkRepository.FIRST_OF_SUBJECT}
+                ORDER BY due_at, id LIMIT :limit
+            ''', {'lead': lead, 'fire_at': after_fire_at, 'hw_id': after_hw_id, 'until': until, 'limit': limit})
+            return c.fetchall()
+
+    def get_reminder(self, hw_id):
+        with self.db.transaction() as c:
+            c.execute('SELECT subject, due_date, due_at FROM homework WHERE id = ?', (hw_id,))
+            return c.fetchone()
+
+    def get_cursor(self):
+        with self.db.transaction() as c:
+            c.execute('SELECT fire_at, hw_id, user_id FROM reminder_cursor WHERE id = 1')
+            return c.fetchone()
+
+    def save_cursor(self, fire_at, hw_id, user_id):
+        with self.db.transaction() as c:
+            c.execute('INSERT OR REPLACE INTO reminder_cursor (id, fire_at, hw_id, user_id) VALUES (1, ?, ?, ?)',
+                      (fire_at, hw_id, user_id))
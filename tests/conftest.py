@@ -0,0 +1,5 @@
+import os
+import sys
+
+# storage.py лежит в корне репозитория, рядом с main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
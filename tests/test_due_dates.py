@@ -0,0 +1,66 @@
+from datetime import datetime
+
+import pytest
+
+from storage import LOCAL_TZ, parse_due_date
+
+# Понедельник
+NOW = datetime(2026, 1, 5, 12, 0, tzinfo=LOCAL_TZ)
+
+def due(text, now=NOW):
+    moment = parse_due_date(text, now)
+    return datetime.fromtimestamp(moment, LOCAL_TZ).strftime('%Y-%m-%d %H:%M') if moment else None
+
+@pytest.mark.parametrize('text, expected', [
+    ('2026-02-10', '2026-02-10 23:59'),
+    ('12.01', '2026-01-12 23:59'),
+    ('12/01', '2026-01-12 23:59'),
+    ('12.01.27', '2027-01-12 23:59'),
+    ('12.01.2027', '2027-01-12 23:59'),
+    ('12.01 18:30', '2026-01-12 18:30'),
+    ('сегодня', '2026-01-05 23:59'),
+    ('Завтра к 9:00', '2026-01-06 09:00'),
+    ('послезавтра', '2026-01-07 23:59'),
+])
+def test_formats(text, expected):
+    assert due(text) == expected
+
+@pytest.mark.parametrize('text, expected', [
+    # Недавно прошедшая дата ближе, чем та же дата через год
+    ('31.12', '2025-12-31 23:59'),
+    ('20.12', '2025-12-20 23:59'),
+    ('01.06', '2026-06-01 23:59'),
+    ('03.01', '2026-01-03 23:59'),
+])
+def test_year_is_nearest_in_both_directions(text, expected):
+    assert due(text) == expected
+
+def test_year_rolls_forward_in_december():
+    assert due('10.01', datetime(2026, 12, 28, tzinfo=LOCAL_TZ)) == '2027-01-10 23:59'
+
+@pytest.mark.parametrize('text, expected', [
+    ('пятница', '2026-01-09 23:59'),
+    ('в пятницу', '2026-01-09 23:59'),
+    ('до пятницы', '2026-01-09 23:59'),
+    ('к пятнице', '2026-01-09 23:59'),
+    ('до среды', '2026-01-07 23:59'),
+    ('до понедельника', '2026-01-05 23:59'),
+    ('до воскресенья', '2026-01-11 23:59'),
+    ('пт', '2026-01-09 23:59'),
+])
+def test_weekdays(text, expected):
+    assert due(text) == expected
+
+@pytest.mark.parametrize('text, expected', [
+    ('упр 5.3, до 12.01', '2026-01-12 23:59'),
+    ('до 12.01, упр 5.3', '2026-01-12 23:59'),
+    ('упр 5.3 до пятницы', '2026-01-09 23:59'),
+    ('упр 5.3, 12.01', '2026-01-12 23:59'),
+    ('задачи 1.2 и 1.3 сдать до 14.01 в 10:00', '2026-01-14 10:00'),
+])
+def test_prefers_date_after_do_then_last(text, expected):
+    assert due(text) == expected
+
+@pytest.mark.parametrize('text', ['', None, 'без срока', '31.02', '45.13', 'стр 123.45'])
+def test_no_date(text):
+    assert due(text) is None